@@ -1,8 +1,65 @@
+from array import array
+from collections import deque, namedtuple
 from datetime import datetime
 import math
 
+from util import from_epoch, to_epoch
+
 BITTREX_FEE = 0.0025
 
+# a buy (or part of one) that has been sold, gain is normalized to the
+# amount invested and includes fees
+Lot = namedtuple('Lot', ['coin', 'amount', 'buy_price', 'sell_price',
+                         'opened', 'closed', 'gain'])
+
+
+class TxnLog(object):
+    """Append-only log of (coin, amount, price, period) trades. Stored as
+    typed arrays with interned coin ids, so big backtests can hold and pickle
+    it cheaply. Reads give back the same tuples as a plain list would.
+    """
+
+    def __init__(self, txns=()):
+        self.coin_ids = {}
+        self.coin_names = []
+        self.coins = array('i')
+        self.amounts = array('d')
+        self.prices = array('d')
+        self.periods = array('q')  # microseconds since the unix epoch
+        for txn in txns:
+            self.append(txn)
+
+    def append(self, txn):
+        coin, amount, price, period = txn
+        coin_id = self.coin_ids.get(coin)
+        if coin_id is None:
+            coin_id = self.coin_ids[coin] = len(self.coin_names)
+            self.coin_names.append(coin)
+        self.coins.append(coin_id)
+        self.amounts.append(amount)
+        self.prices.append(price)
+        self.periods.append(to_epoch(period))
+
+    def __len__(self):
+        return len(self.coins)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return (self.coin_names[self.coins[i]], self.amounts[i],
+                self.prices[i],
+                from_epoch(self.periods[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "TxnLog({})".format(list(self))
+
 
 class Account(object):
     def __init__(self, initial_balances={}, period=None, opens=None, coins=[]):
@@ -12,7 +69,7 @@ class Account(object):
         for coin in coins:
             if coin not in self.balances:
                 self.balances[coin] = 0.0
-        self.txns = []
+        self.txns = TxnLog()
         self.last_txns = {}
         if opens is None:
             self.position_open_datetimes = {
@@ -65,7 +122,7 @@ class Account(object):
             raise Exception("Saw overdraft of {} for {} (bal={})"
                             .format(amount, coin, self.balance(coin)))
         self.balances[coin] = new
-        txn = (coin, amount, price, period)
+        txn = (coin, amount, float(price), period)
         self.txns.append(txn)
         self.last_txns[coin] = txn
 
@@ -82,65 +139,67 @@ class Account(object):
         """
         profits = []
         losses = []
-        open_txns = []  # buys to evaluate
+        for lot in self.closed_lots():
+            if lot.gain > 0:
+                profits.append((lot.coin, lot.gain))
+            else:
+                losses.append((lot.coin, lot.gain))
+        return profits, losses
+
+    def closed_lots(self):
+        """Match each sale against the oldest open buys of the same coin
+        (FIFO), returning one `Lot` per buy, or part of a buy, that was sold.
+        """
+        lots = []
+        open_buys = {}  # coin -> deque of [amount, price, period]
 
         for coin, amount, price, ts in self.txns:
             if coin == 'BTC':
                 continue  # TODO: do we care about BTC?
 
             if amount > 0:
-                open_txns.append((coin, amount, price))
-            else:
-                left_to_sell = amount
-                iters = 0
-
-                # search through the buys we've made to figure out if this sale
-                # was profitable or a loss
-                while open_txns:
-                    iters += 1
-                    if iters > 50:
-                        break
-                    buy = open_txns.pop(0)
-                    buy_coin, buy_amount, buy_price = buy
-                    if coin != buy_coin:
-                        open_txns.append(buy)
-                        continue
-
-                    # adjust the sale in this loop iteration to the smallest
-                    # of the buy or sell, for mismatched txn sizes
-                    remainder = buy_amount - abs(left_to_sell)
-                    selling_now = abs(left_to_sell)
-                    if math.isclose(remainder, 0):
-                        pass
-                    elif remainder > 0:
-                        # note: this path shouldn't happen in the bot b/c
-                        # it sells all of an altcoin at once
-                        open_txns.append((buy_coin, remainder, buy_price))
-                        buy_amount = abs(left_to_sell)
-                    elif remainder < 0:
-                        selling_now = buy_amount
-
-                    # calculate the percentage return
-                    initial = buy_amount * buy_price
-                    final = selling_now * price
-                    tx_return = ((final - initial) / initial) - 2 * BITTREX_FEE
-                    assert tx_return > -100, \
-                        f"{coin} return={tx_return}%, i={initial} f={final}"
-
-                    if tx_return > 0:
-                        profits.append((coin, tx_return))
-                    else:
-                        losses.append((coin, tx_return))
-
-                    left_to_sell += selling_now
-                    if math.isclose(left_to_sell, 0):
-                        break
-
-                # helpful for debugging:
-                # assert math.isclose(left_to_sell, 0), \
-                #    f"leftover {coin}: {left_to_sell}, txns: {open_txns}"
-
-        return profits, losses
+                open_buys.setdefault(coin, deque()).append([amount, price, ts])
+                continue
+
+            left_to_sell = amount
+            buys = open_buys.get(coin, ())
+            while buys:
+                buy = buys[0]
+                buy_amount, buy_price, opened = buy
+
+                # adjust the sale in this loop iteration to the smallest
+                # of the buy or sell, for mismatched txn sizes
+                remainder = buy_amount - abs(left_to_sell)
+                selling_now = abs(left_to_sell)
+                if math.isclose(remainder, 0):
+                    buys.popleft()
+                elif remainder > 0:
+                    # note: this path shouldn't happen in the bot b/c
+                    # it sells all of an altcoin at once
+                    buy[0] = remainder
+                    buy_amount = abs(left_to_sell)
+                elif remainder < 0:
+                    buys.popleft()
+                    selling_now = buy_amount
+
+                # calculate the percentage return
+                initial = buy_amount * buy_price
+                final = selling_now * price
+                tx_return = ((final - initial) / initial) - 2 * BITTREX_FEE
+                assert tx_return > -100, \
+                    f"{coin} return={tx_return}%, i={initial} f={final}"
+                lots.append(Lot(coin, selling_now, buy_price, price,
+                                opened, ts, tx_return))
+
+                left_to_sell += selling_now
+                if math.isclose(left_to_sell, 0):
+                    break
+
+            # helpful for debugging:
+            # assert math.isclose(left_to_sell, 0), \
+            #    f"leftover {coin}: {left_to_sell}, txns: {open_buys}"
+
+        return lots
 
     def save(self, *args):
         pass
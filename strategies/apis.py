@@ -1,4 +1,6 @@
+import asyncio
 import datetime
+from functools import lru_cache
 import logging
 import time
 import ccxt
@@ -6,6 +8,19 @@ import ccxt
 log = logging.getLogger('default')
 
 
+@lru_cache(maxsize=None)
+def async_ccxt():
+    """ccxt's asyncio exchanges, None on versions of ccxt without them.
+    Only looked for once, so the fallback is only logged once
+    """
+    try:
+        import ccxt.async_support as ccxt_async
+    except ImportError:
+        log.debug("No asyncio support in ccxt, fetching tickers one by one")
+        return None
+    return ccxt_async
+
+
 def lower_key(my_dict):
     return {k.lower(): v for k, v in my_dict.items()}
 
@@ -16,6 +31,9 @@ class CcxtExchange:
         json = self.fetch_json(symbol)
         if json is None:
             return None
+        return self.parse_ticker(coin, json)
+
+    def parse_ticker(self, coin, json):
         info = lower_key(json['info'])
         timestamp = datetime.datetime.utcfromtimestamp(json['timestamp'] / 1e3)
         values = {
@@ -40,6 +58,54 @@ class CcxtExchange:
                     return None
                 time.sleep(3)
 
+    def fetch_tickers(self, coins, client=None, concurrency=6, timeout=10,
+                      retries=3, backoff=3):
+        """Fetch tickers for all coins concurrently, at most `concurrency`
+        requests in flight at once. Coins that still fail after `retries`
+        attempts are left out of the results.
+        """
+        if client is None and async_ccxt() is None:
+            tickers = [self.fetch_ticker(coin) for coin in coins]
+            return [t for t in tickers if t is not None]
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.fetch_tickers_async(
+                coins, client, concurrency, timeout, retries, backoff))
+        finally:
+            loop.close()
+
+    async def fetch_tickers_async(self, coins, client=None, concurrency=6,
+                                  timeout=10, retries=3, backoff=3):
+        owned = client is None
+        if owned:
+            client = self.make_async_client()
+        limit = asyncio.Semaphore(concurrency)
+
+        async def fetch(coin):
+            async with limit:
+                return await self.fetch_ticker_async(client, coin, timeout,
+                                                     retries, backoff)
+        try:
+            tickers = await asyncio.gather(*[fetch(c) for c in coins])
+        finally:
+            if owned:
+                await client.close()
+        return [t for t in tickers if t is not None]
+
+    async def fetch_ticker_async(self, client, coin, timeout, retries, backoff):
+        symbol = self.make_symbol(coin)
+        for attempt in range(0, retries):
+            try:
+                json = await asyncio.wait_for(client.fetch_ticker(symbol),
+                                              timeout)
+                return self.parse_ticker(coin, lower_key(json))
+            except Exception as e:
+                if attempt >= retries - 1:
+                    log.error(f"Exception fetching {symbol} from {self.name}",
+                              exc_info=e.__traceback__)
+                    return None
+                await asyncio.sleep(backoff)
+
     def fetch_transactions(self, retries=3):
         for attempt in range(0, retries):
             try:
@@ -80,8 +146,11 @@ class Bittrex(CcxtExchange):
 
     def __init__(self, config):
         self.name = 'bittrex'
-        keys = config['exchanges'][self.name]
-        self.ccxt = ccxt.bittrex(keys)
+        self.keys = config['exchanges'][self.name]
+        self.ccxt = ccxt.bittrex(self.keys)
+
+    def make_async_client(self):
+        return async_ccxt().bittrex(self.keys)
 
     def make_symbol(self, coin):
         if coin.find('BTC') == -1:
@@ -1,6 +1,10 @@
+import cProfile
 from datetime import timedelta
+import json
+import os
 import random
-import statistics as s
+import shutil
+import tempfile
 from timeit import default_timer as timer
 import multiprocessing as mp
 from tqdm import tqdm
@@ -9,13 +13,21 @@ import logging
 from bot import Bot, account_value_btc
 from db import Ticker, create_db, new_session
 from account import Account
+from price_store import PriceStore
 from durable_account import close_alt_positions
+from instrument import install, instruments, profile_path, profiled
+from moving_avg import MovingAverage
+from stats import Summary
+from util import from_epoch, to_epoch
 
 SECS_DAY = 60 * 60 * 24
 
 log = logging.getLogger('backtest')
 log.setLevel(logging.INFO)
 
+# per-process session, set up once by `init_worker` in each pool worker
+worker = {}
+
 
 def fetch_data_timestamp(sess, oldest=True):
     sort = Ticker.timestamp
@@ -26,20 +38,26 @@ def fetch_data_timestamp(sess, oldest=True):
 
 class BacktestResult(object):
     def __init__(self, start, end, step, start_val, finish_val, fees, txns,
-                 gain_txns, loss_txns, out_of_btc, hit_coin_limit, high, low):
+                 gain_txns, loss_txns, out_of_btc, hit_coin_limit, high, low,
+                 lots=()):
         self.start = start
         self.end = end
         self.step = step
         self.start_val = start_val
         self.finish_val = finish_val
         self.fees = fees
-        self.txns = txns
+        self.num_txns = len(txns)
         self.gain_txns = [n for c, n in gain_txns]
         self.loss_txns = [n for c, n in loss_txns]
+        # (gain, hours held) for each closed lot
+        self.holds = [(lot.gain, (lot.closed - lot.opened).total_seconds() / 3600)
+                      for lot in lots]
         self.out_of_btc = out_of_btc
         self.hit_coin_limit = hit_coin_limit
         self.high = high
         self.low = low
+        # stage timings from the worker, when instrumented
+        self.timings = None
         self.percent_return = 100 * (finish_val - start_val) / start_val
         assert self.percent_return >= -100.0
 
@@ -49,7 +67,7 @@ class BacktestResult(object):
         log.debug("Balance after running backest {} BTC\n"
                   .format(self.finish_val))
         log.debug("Paid {} BTC in fees".format(round(self.fees, 8)))
-        log.debug("Transactions: {}".format(len(self.txns)))
+        log.debug("Transactions: {}".format(self.num_txns))
         log.debug("Missed buys: out of BTC: {}, hit coin limit: {}"
                   .format(self.out_of_btc, self.hit_coin_limit))
         if self.high is not None or self.low is not None:
@@ -57,15 +75,135 @@ class BacktestResult(object):
         log.debug("Return over period: {}%"
                   .format(round(self.percent_return, 2)))
 
+    def to_record(self, buy_and_hold=None):
+        """Summary of the trial as a plain dict, e.g. for writing as json"""
+        return {
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+            'start_val': self.start_val,
+            'finish_val': self.finish_val,
+            'percent_return': self.percent_return,
+            'buy_and_hold': (buy_and_hold.percent_return
+                             if buy_and_hold is not None else None),
+            'days': (self.end - self.start).total_seconds() / SECS_DAY,
+            'fees': self.fees,
+            'txns': self.num_txns,
+            'gains': self.gain_txns,
+            'losses': self.loss_txns,
+            'holds': self.holds,
+            'out_of_btc': self.out_of_btc,
+            'hit_coin_limit': self.hit_coin_limit,
+            'high': self.high,
+            'low': self.low,
+        }
+
+
+class TrialAggregates(object):
+    """Running totals across trials, so results can be folded in as they
+    arrive instead of being collected first. Trials are added as records
+    from `BacktestResult.to_record`, in trial order so that float sums come
+    out the same however the trials were run.
+    """
+
+    def __init__(self):
+        self.trials = 0
+        self.positive = 0
+        self.beat_buy_hold = 0
+        self.returns = Summary()
+        self.transactions = Summary()
+        self.length = Summary()
+        self.gains = Summary()
+        self.losses = Summary()
+        self.gain_hours = Summary()
+        self.loss_hours = Summary()
+
+    def add(self, record):
+        self.trials += 1
+        self.returns.add(record['percent_return'])
+        self.transactions.add(record['txns'])
+        self.length.add(record['days'])
+        self.gains.extend(record['gains'])
+        self.losses.extend(record['losses'])
+        for gain, hours in record['holds']:
+            (self.gain_hours if gain > 0 else self.loss_hours).add(hours)
+
+        if record['percent_return'] > 0:
+            self.positive += 1
+        if record['percent_return'] > record['buy_and_hold']:
+            self.beat_buy_hold += 1
+
+
+class Checkpoint(object):
+    """A backtest run on disk: a manifest of the run's settings and trial
+    intervals, plus a record for each trial as it finishes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def manifest(self):
+        try:
+            with open(self.file('manifest.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_manifest(self, manifest):
+        tmp = self.file('manifest.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, self.file('manifest.json'))
+
+    def finished(self):
+        """Records of the trials already run, by trial number"""
+        records = {}
+        try:
+            with open(self.file('trials.jsonl')) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return records
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # cut off mid-write, run it again
+            records[record['trial']] = record
+        if len(records) != len(lines) or not lines[-1].endswith("\n"):
+            # drop the partial line so new records don't get appended to it
+            tmp = self.file('trials.jsonl.tmp')
+            with open(tmp, 'w') as f:
+                for record in records.values():
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp, self.file('trials.jsonl'))
+        return records
+
+    def add(self, record):
+        with open(self.file('trials.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
 
 class Backtester(object):
-    def __init__(self, sess, db_loc, step=timedelta(minutes=10)):
+    def __init__(self, sess, db_loc, step=timedelta(minutes=10), archive=None,
+                 instrument=None):
+        self.sess = sess
         self.db_loc = db_loc
+        # `instrument` config, passed on to the pool workers
+        self.instrument = instrument or {}
         self.balances = {'BTC': 5}
         self.step = step
-        self.coins = Ticker.coins(sess)
-        self.start_data = fetch_data_timestamp(sess, oldest=True)
-        self.end_data = fetch_data_timestamp(sess, oldest=False)
+        # backtest against a binary archive rather than the history table
+        self.archive = PriceStore.open(archive) if archive else None
+        if self.archive is not None:
+            self.coins = self.archive.coins
+            self.start_data, self.end_data = self.archive.bounds()
+        else:
+            self.coins = Ticker.coins(sess)
+            self.start_data = fetch_data_timestamp(sess, oldest=True)
+            self.end_data = fetch_data_timestamp(sess, oldest=False)
 
         # quiet other logs down to avoid spam
         default = logging.getLogger('default')
@@ -73,88 +211,179 @@ class Backtester(object):
         txns = logging.getLogger('txns')
         txns.setLevel(logging.ERROR)
 
-    def run_backtest(self, num_trials, trial_days, threads=1):
+    def run_backtest(self, num_trials, trial_days, threads=1,
+                     results_file=None, seed=None, checkpoint=None):
         log.warn("Finding intervals between {} and {}"
                  .format(self.start_data, self.end_data))
 
-        intervals = [self.make_interval(timedelta(days=trial_days))
-                     for i in range(num_trials)]
-        func_args = [[i, self.coins, self.db_loc, self.step, self.balances]
-                     for i in intervals]
+        if seed is None:
+            seed = random.getrandbits(32)
+        manifest = self.make_manifest(num_trials, trial_days, seed)
+        done = {}
+        if checkpoint:
+            checkpoint = Checkpoint(checkpoint)
+            saved = checkpoint.manifest()
+            if saved is None:
+                checkpoint.save_manifest(manifest)
+            else:
+                settings = {k: v for k, v in manifest.items()
+                            if k != 'intervals'}
+                if any(saved.get(k) != v for k, v in settings.items()):
+                    raise ValueError("checkpoint at {} was made with "
+                                     "different settings"
+                                     .format(checkpoint.path))
+                # intervals come from the manifest, the data may have grown
+                manifest = saved
+                done = checkpoint.finished()
+                log.warn("Resuming from {}, {}/{} trials already run"
+                         .format(checkpoint.path, len(done), num_trials))
+
+        intervals = [(from_epoch(start), from_epoch(end))
+                     for start, end in manifest['intervals']]
+        todo = [i for i in range(len(intervals)) if i not in done]
+        func_args = [[intervals[i], self.coins, self.db_loc, self.step,
+                      self.balances] for i in todo]
 
         timing_start = timer()
-        with mp.Pool(threads) as p:
-            results = [r for r in
-                       tqdm(p.imap_unordered(evaluate_interval, func_args),
-                            total=len(func_args), ncols=80)]
+        results = TrialAggregates()
+        finished = self.map_trials(evaluate_interval, func_args, threads)
+        out = open(results_file, 'a') if results_file else None
+        try:
+            for i in range(len(intervals)):
+                record = done.get(i)
+                if record is None:
+                    strat, bah = next(finished)
+                    if strat.timings is not None:
+                        instruments.merge(strat.timings)
+                    record = dict(strat.to_record(bah), trial=i)
+                    if checkpoint:
+                        checkpoint.add(record)
+                    if out is not None:
+                        out.write(json.dumps(record) + "\n")
+                        out.flush()
+                results.add(record)
+        finally:
+            finished.close()
+            if out is not None:
+                out.close()
         timing_end = timer()
         elapsed_mins = (timing_end - timing_start) / 60.0
+        self.report(results, len(todo), elapsed_mins, trial_days)
+
+    def run_walk_forward(self, window_days, stride_days=None,
+                         results_file=None):
+        """Backtest windows that step through all of the data in order,
+        overlapping when the stride is shorter than the window. The windows
+        share one `MovingAverage`, with signals computed once for the whole
+        range, so each window only has to simulate its own ticks.
+        """
+        stride_days = stride_days or window_days
+        windows = self.make_windows(timedelta(days=window_days),
+                                    timedelta(days=stride_days))
+        log.warn("Walking forward between {} and {} in {} windows of {} days"
+                 .format(self.start_data, self.end_data, len(windows),
+                         window_days))
 
-        beat_buy_hold = 0
-        pos_return = 0
-        returns = []
-        length = []
-        transactions = []
-        gains = []
-        losses = []
-
-        for r in results:
-            strat, bah = r
-
-            returns.append(strat.percent_return)
-            transactions.append(len(strat.txns))
-            length.append((strat.end - strat.start).total_seconds() / SECS_DAY)
-            gains.extend(strat.gain_txns)
-            losses.extend(strat.loss_txns)
-
-            if strat.percent_return > 0:
-                pos_return += 1
-            if strat.percent_return > bah.percent_return:
-                beat_buy_hold += 1
+        timing_start = timer()
+        prices = self.archive
+        if prices is None:
+            prices = PriceStore.load(self.sess, self.coins)
+        prices.attach(self.sess)
+        results = TrialAggregates()
+        out = open(results_file, 'a') if results_file else None
+        try:
+            moving_avg = MovingAverage(self.sess)
+            for coin in self.coins:
+                moving_avg.fetch_data(coin, self.end_data, self.start_data)
+                moving_avg.precompute(coin, self.start_data, self.end_data,
+                                      self.step)
+            for i, window in enumerate(tqdm(windows, ncols=80)):
+                tup = [window, self.coins, self.db_loc, self.step,
+                       self.balances]
+                strat = run_strategy(*tup, moving_avg=moving_avg,
+                                     sess=self.sess)
+                bah = buy_and_hold(*tup, sess=self.sess)
+                record = dict(strat.to_record(bah), trial=i)
+                if out is not None:
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                results.add(record)
+        finally:
+            PriceStore.detach(self.sess)
+            if out is not None:
+                out.close()
+        timing_end = timer()
+        elapsed_mins = (timing_end - timing_start) / 60.0
+        self.report(results, len(windows), elapsed_mins, window_days)
 
+    def report(self, results, num_run, elapsed_mins, trial_days):
         log.warn("\n\nAggregate across-trials results:\n")
         log.warn("{} trials took {} mins to process"
-                 .format(num_trials, round(elapsed_mins, 1)))
+                 .format(num_run, round(elapsed_mins, 1)))
         log.warn("Average trial length: {} days (set to {})"
-                 .format(round(s.mean(length), 2), trial_days))
+                 .format(round(results.length.mean, 2), trial_days))
         log.warn("Positive return: {}/{}"
-                 .format(pos_return, num_trials))
+                 .format(results.positive, results.trials))
         log.warn("Outperformed buy-and-hold: {}/{}"
-                 .format(beat_buy_hold, num_trials))
-        self.descriptives("Returns", returns, suffix='%')
-        self.descriptives("Transactions", transactions)
-        self.estimate_kelly_bet_size(gains, losses)
+                 .format(results.beat_buy_hold, results.trials))
+        self.descriptives("Returns", results.returns, suffix='%')
+        self.descriptives("Transactions", results.transactions)
+        self.estimate_kelly_bet_size(results.gains, results.losses,
+                                     results.gain_hours, results.loss_hours)
+
+    def map_trials(self, func, func_args, threads):
+        """Run func over func_args in a pool of workers, yielding results in
+        the same order as func_args
+        """
+        if not func_args:
+            return
+        # load the price history once, workers memory-map the same files
+        dataset = tempfile.mkdtemp(prefix='coinbot-backtest-')
+        try:
+            prices = self.archive
+            if prices is None:
+                prices = PriceStore.load(self.sess, self.coins)
+            prices.save(dataset)
+            with mp.Pool(threads, initializer=init_worker,
+                         initargs=(self.db_loc, dataset,
+                                   self.instrument)) as p:
+                for r in tqdm(p.imap(func, func_args),
+                              total=len(func_args), ncols=80):
+                    yield r
+        finally:
+            shutil.rmtree(dataset)
 
     def descriptives(self, name, field, precision=2, suffix=''):
         log.warn("{} min: {}{s}, median: {}{s}, max: {}{s}, mean: {}{s}, stdev: {}{s}"
                  .format(name,
-                         round(min(field), precision),
-                         round(s.median(field), precision),
-                         round(max(field), precision),
-                         round(s.mean(field), precision),
-                         round(s.stdev(field), precision),
+                         round(field.min, precision),
+                         round(field.median, precision),
+                         round(field.max, precision),
+                         round(field.mean, precision),
+                         round(field.stdev, precision),
                          s=suffix))
 
-    def estimate_kelly_bet_size(self, gains, losses):
-        total_txns = len(gains) + len(losses)
-        p = len(gains) / total_txns
+    def estimate_kelly_bet_size(self, gains, losses, gain_hours=None,
+                                loss_hours=None):
+        total_txns = gains.count + losses.count
+        p = gains.count / total_txns
         q = 1 - p
-        a_cons = abs(min(losses))
-        b = s.median(gains)
+        a_cons = abs(losses.min)
+        b = gains.median
         log.warn("Kelly criteria estimates:\n")
-        log.warn(f"p = {len(gains)}/{total_txns} = {round(p, 3)}")
+        log.warn(f"p = {gains.count}/{total_txns} = {round(p, 3)}")
         log.warn(f"a_cons = max loss = {round(a_cons, 3)}")
         log.warn(f"b = median gain = {round(b, 3)}")
         f_star = p / a_cons - q / b
         log.warn(f"f*(conservative) = p/a - q/b = {round(f_star, 3)}\n")
 
-        a_median = abs(s.median(losses))
+        a_median = abs(losses.median)
         log.warn(f"a_median = median loss = {round(a_median, 3)}")
         f_star_median = p / a_median - q / b
         log.warn(f"f*(median) = p/a - q/b = {round(f_star_median, 3)}\n")
 
-        a_mean = abs(s.mean(losses))
-        b_mean = s.mean(gains)
+        a_mean = abs(losses.mean)
+        b_mean = gains.mean
         log.warn(f"a_mean = mean loss = {round(a_mean, 3)}")
         log.warn(f"b_mean = mean gain = {round(b_mean, 3)}")
         f_star_mean = p / a_mean - q / b_mean
@@ -167,12 +396,58 @@ class Backtester(object):
         k_p = p - q / r
         log.warn(f"  = {round(p, 3)} - {round(q,3)}/{round(r,3)} = {round(100 * k_p, 2)}%")
 
-    def make_interval(self, length):
+        if gain_hours and loss_hours:
+            log.warn("\nMedian holding period: gains {} hrs, losses {} hrs"
+                     .format(round(gain_hours.median, 1),
+                             round(loss_hours.median, 1)))
+
+    def make_interval(self, length, rand=random):
         data_range = self.end_data - self.start_data - (5 * self.step)
-        start = self.start_data + random.random() * data_range
+        start = self.start_data + rand.random() * data_range
         end = min(self.end_data, start + length)
         return (start, end)
 
+    def make_windows(self, length, stride):
+        """Intervals from the start of the data to the end, `stride` apart.
+        The stride is rounded down to whole steps, so that every window's
+        ticks line up with signals computed from the start of the data.
+        """
+        stride = (stride // self.step) * self.step
+        if stride <= timedelta(0):
+            raise ValueError("stride must be at least one step")
+        windows = []
+        start = self.start_data
+        while start < self.end_data - 5 * self.step:
+            end = min(self.end_data, start + length)
+            windows.append((start, end))
+            if end >= self.end_data:
+                break
+            start += stride
+        return windows
+
+    def make_manifest(self, num_trials, trial_days, seed):
+        """Settings and intervals for a run. Trial i's interval is drawn
+        with its own seed, so it doesn't depend on the trials before it
+        """
+        length = timedelta(days=trial_days)
+        intervals = []
+        for i in range(num_trials):
+            start, end = self.make_interval(length, trial_random(seed, i))
+            intervals.append([to_epoch(start), to_epoch(end)])
+        return {
+            'seed': seed,
+            'trials': num_trials,
+            'trial_days': trial_days,
+            'step': self.step.total_seconds(),
+            'balances': self.balances,
+            'coins': self.coins,
+            'intervals': intervals,
+        }
+
+
+def trial_random(seed, trial):
+    return random.Random("{}-{}".format(seed, trial))
+
 
 def log_value(account, period, sess):
     value = round(account_value_btc(sess, account, period), 3)
@@ -180,20 +455,44 @@ def log_value(account, period, sess):
     return value
 
 
-def evaluate_interval(tup):
-    strat = [None]
+def init_worker(db_loc, dataset, instrument=None):
+    engine = create_db(db_loc)
+    sess = new_session(engine)
+    PriceStore.open(dataset).attach(sess)
+    worker['sess'] = sess
+
+    instruments.reset()  # don't count the parent's numbers again after fork
+    if instrument and instrument.get('enabled'):
+        install(engine)
+        if instrument.get('profile'):
+            worker['profile'] = profile_path(instrument['profile'],
+                                             'backtest-worker')
+            worker['profiler'] = cProfile.Profile()
 
-    # uncomment to profile strategy execution:
-    # import cProfile
-    # cProfile.runctx('strat[0] = run_strategy(*tup)', globals(), locals(),
-    #                'backtest-%s.out' % mp.current_process().name)
 
-    strat[0] = run_strategy(*tup)
-    bah = buy_and_hold(*tup)
-    return (strat[0], bah)
+def trial_session(db_loc, coins, start, stop):
+    """The worker's shared session, or a new one with prices for just this
+    trial when running outside of a pool
+    """
+    sess = worker.get('sess')
+    if sess is None:
+        sess = new_session(create_db(db_loc))
+        PriceStore.load(sess, coins, start, stop).attach(sess)
+    return sess
+
+
+def evaluate_interval(tup):
+    with profiled(worker.get('profile'), worker.get('profiler')):
+        strat = run_strategy(*tup)
+        bah = buy_and_hold(*tup)
+    if instruments.enabled:
+        strat.timings = instruments.snapshot()
+        instruments.reset()
+    return (strat, bah)
 
 
-def run_strategy(interval, coins, db_loc, step, balances):
+def run_strategy(interval, coins, db_loc, step, balances, params=None,
+                 moving_avg=None, sess=None):
     start, stop = interval
     assert start < stop
 
@@ -201,14 +500,15 @@ def run_strategy(interval, coins, db_loc, step, balances):
     log.debug("Running backtest between {}->{} at {} intervals"
               .format(start, stop, step))
 
-    db = create_db(db_loc)
-    sess = new_session(db)
+    if sess is None:
+        sess = trial_session(db_loc, coins, start, stop)
 
     period = start
     account = Account(balances, period, coins=coins)
     start_value = account_value_btc(sess, account, start)
     # pass time bounds to bot object for data pre-fetching
-    bot = Bot(sess, account, beginning=start, now=stop)
+    bot = Bot(sess, account, beginning=start, now=stop, step=step,
+              params=params, moving_avg=moving_avg)
     low = high = start_value
 
     i = 0
@@ -227,28 +527,30 @@ def run_strategy(interval, coins, db_loc, step, balances):
     low = min(low, finish_value)
     high = max(high, finish_value)
 
-    gains, losses = account.evaluate_trades()
+    lots = account.closed_lots()
+    gains = [(lot.coin, lot.gain) for lot in lots if lot.gain > 0]
+    losses = [(lot.coin, lot.gain) for lot in lots if lot.gain <= 0]
     results = BacktestResult(
         start, stop, step,
         start_value, finish_value,
         account.fees, account.txns, gains, losses,
         bot.out_of_btc, bot.hit_coin_limit,
-        high, low
+        high, low, lots
     )
     results.print_results()
 
     return results
 
 
-def buy_and_hold(interval, coins, db_loc, step, balances):
+def buy_and_hold(interval, coins, db_loc, step, balances, sess=None):
     start, stop = interval
     account = Account(balances)
     # one share of each alt, one share of BTC
     btc_per_coin = account.balance('BTC') / (len(coins) + 1)
     with_fees = btc_per_coin - (btc_per_coin * 0.0025)
 
-    db = create_db(db_loc)
-    sess = new_session(db)
+    if sess is None:
+        sess = trial_session(db_loc, coins, start, stop)
 
     for coin in coins:
         price = Ticker.current_ask(sess, coin, now=start)
@@ -256,7 +558,7 @@ def buy_and_hold(interval, coins, db_loc, step, balances):
             continue
         to_buy = with_fees / price
         cost = account.trade(coin, to_buy, price, start)
-        account.update('BTC', cost, start)
+        account.update('BTC', cost, 1, start)
 
     start_value = account_value_btc(sess, account, now=start)
     finish_value = account_value_btc(sess, account, stop)
@@ -0,0 +1,204 @@
+"""Time the tick hot path against synthetic price history
+
+usage: python strategies/benchmark.py [--coins 20] [--days 10] [--store]
+           [--save baseline.json] [--baseline baseline.json]
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+from account import Account
+from backtest import run_strategy
+from bot import Bot, account_value_btc
+from db import Ticker, create_db, insert_tickers, new_session
+from moving_avg import MovingAverage
+from price_store import PriceStore
+import stop_loss
+
+START = datetime(2018, 1, 1)
+STEP = timedelta(minutes=10)
+# flag a benchmark when its median gets this much slower than the baseline
+TOLERANCE = 1.25
+
+
+def synthetic_ticks(coins, days, ticks_per_hour, seed=1):
+    """A random walk of prices for each coin, ticks a little off schedule
+    like the ones `update` records
+    """
+    rand = random.Random(seed)
+    spacing = timedelta(hours=1) / ticks_per_hour
+    end = START + timedelta(days=days)
+    for i in range(coins):
+        coin = 'C{:03}'.format(i)
+        price = rand.uniform(0.0001, 0.1)
+        t = START
+        while t < end:
+            price *= 1 + rand.gauss(0, 0.01)
+            yield {
+                'exchange': 'bittrex', 'coin': coin, 'timestamp': t,
+                'bid': price * 0.999, 'ask': price, 'last': price * 0.9995,
+                'volume': rand.random() * 100,
+            }
+            t += spacing + timedelta(seconds=rand.uniform(-20, 20))
+
+
+def make_db(path, coins, days, ticks_per_hour, seed=1):
+    db_loc = 'sqlite:///' + path
+    sess = new_session(create_db(db_loc))
+    if not Ticker.coins(sess):
+        ticks = synthetic_ticks(coins, days, ticks_per_hour, seed)
+        insert_tickers(sess, ticks)
+        sess.commit()
+    return db_loc, sess
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        'calls': len(ordered),
+        'p50': percentile(ordered, 0.5),
+        'p90': percentile(ordered, 0.9),
+        'p99': percentile(ordered, 0.99),
+        'max': ordered[-1],
+        'per_sec': len(ordered) / sum(ordered) if sum(ordered) else None,
+    }
+
+
+def time_calls(func, calls):
+    latencies = []
+    for args in calls:
+        start = timer()
+        func(*args)
+        latencies.append(timer() - start)
+    return summarize(latencies)
+
+
+def run_benchmarks(sess, db_loc, coins, periods):
+    """Latencies of each hot path function, over every coin and period"""
+    results = {}
+    holding = {coin: 1.0 for coin in coins}
+
+    moving_avg = MovingAverage(sess)
+    results['MovingAverage.calculate_strengths'] = time_calls(
+        moving_avg.calculate_strengths,
+        [(period, coin) for period in periods for coin in coins])
+
+    account = Account(dict(holding, BTC=5), period=START)
+    results['account_value_btc'] = time_calls(
+        account_value_btc, [(sess, account, period) for period in periods])
+
+    peaks = stop_loss.PeakTracker()
+    results['stop_loss.run_strategy'] = time_calls(
+        lambda period, coin: stop_loss.run_strategy(sess, period, coin,
+                                                    account, peaks=peaks),
+        [(period, coin) for period in periods for coin in coins])
+
+    # like a backtest, with history from the start of the data
+    account = Account({'BTC': 5}, period=START, coins=coins)
+    bot = Bot(sess, account, beginning=START, now=periods[-1], step=STEP)
+    results['Bot.tick'] = time_calls(bot.tick, [(p,) for p in periods])
+
+    # a whole trial over all of the data, per_sec is ticks per second
+    interval = (START, periods[-1])
+    start = timer()
+    run_strategy(interval, coins, db_loc, STEP, {'BTC': 5})
+    elapsed = timer() - start
+    ticks = (interval[1] - interval[0]) / STEP
+    results['run_strategy'] = dict(summarize([elapsed]),
+                                   per_sec=ticks / elapsed)
+    return results
+
+
+def print_results(results, baseline=None):
+    """Table of the results, returning the names of any that got slower
+    than `TOLERANCE` times their baseline median
+    """
+    slower = []
+    print("{:36} {:>7} {:>9} {:>9} {:>9} {:>10}".format(
+        'benchmark', 'calls', 'p50 ms', 'p90 ms', 'p99 ms', 'per sec'))
+    for name, r in results.items():
+        line = "{:36} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f}".format(
+            name, r['calls'], 1000 * r['p50'], 1000 * r['p90'],
+            1000 * r['p99'], r['per_sec'] or 0)
+        base = (baseline or {}).get(name)
+        if base:
+            ratio = r['p50'] / base['p50']
+            line += "  {:.2f}x baseline".format(ratio)
+            if ratio > TOLERANCE:
+                line += " SLOWER"
+                slower.append(name)
+        print(line)
+    return slower
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--coins', type=int, default=20)
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--ticks-per-hour', type=int, default=6)
+    parser.add_argument('--ticks', type=int, default=144,
+                        help="bot ticks to time, from the end of the data")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--store', action='store_true',
+                        help="read prices from a PriceStore, like backtests")
+    parser.add_argument('--db', help="sqlite file to keep the data in")
+    parser.add_argument('--save', help="write the results as a baseline")
+    parser.add_argument('--baseline', help="compare against a saved baseline")
+    args = parser.parse_args(argv)
+
+    # the strategies log every trade, keep them out of the timings
+    logging.getLogger('default').setLevel(logging.ERROR)
+    logging.getLogger('txns').setLevel(logging.ERROR)
+
+    settings = {k: getattr(args, k) for k in
+                ['coins', 'days', 'ticks_per_hour', 'ticks', 'seed', 'store']}
+    tmp = None
+    if args.db is None:
+        tmp = tempfile.mkdtemp(prefix='coinbot-benchmark-')
+        args.db = os.path.join(tmp, 'history.db')
+    try:
+        start = timer()
+        db_loc, sess = make_db(args.db, args.coins, args.days,
+                               args.ticks_per_hour, args.seed)
+        print("Synthetic data ready in {}s: {}".format(
+            round(timer() - start, 1), settings))
+        coins = Ticker.coins(sess)
+        if args.store:
+            PriceStore.load(sess, coins).attach(sess)
+
+        end = START + timedelta(days=args.days)
+        periods = [end - STEP * i for i in range(args.ticks, 0, -1)]
+        results = run_benchmarks(sess, db_loc, coins, periods)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved['settings'] != settings:
+            print("Baseline was run with different settings: {}"
+                  .format(saved['settings']))
+        baseline = saved['results']
+    slower = print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=2)
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,22 +1,25 @@
 import logging
 
 from moving_avg import MovingAverage
-from stop_loss import run_strategy as stop_loss_strat
-from db import Ticker
+from stop_loss import DROP_PERCENT, PeakTracker, run_strategy as stop_loss_strat
+from db import PriceSnapshot, Ticker
 from util import crypto_truncate
 
 log = logging.getLogger('default')
 txns = logging.getLogger('txns')
 
 
-def account_value_btc(sess, account, now):
+def account_value_btc(sess, account, now, prices=None):
     # TODO: remove this duplicate
     btc = account.balance('BTC')
     for coin in account.coins:
         if coin == 'BTC':
             continue  # BTC is priced in USD, everything else in BTC
         units = account.balance(coin)
-        unit_price = Ticker.current_ask(sess, coin, now)
+        if prices is not None:
+            unit_price = prices.ask(coin)
+        else:
+            unit_price = Ticker.current_ask(sess, coin, now)
         btc += units * unit_price
     return btc
 
@@ -25,12 +28,22 @@ class Bot(object):
     MAX_COIN_HOLDING = 0.15  # don't hold too much of a single coin
     BET_SIZE = 0.025
 
-    def __init__(self, sess, account, beginning=None, now=None, live=False):
+    def __init__(self, sess, account, beginning=None, now=None, live=False,
+                 step=None, params=None, moving_avg=None):
         self.sess = sess
         self.account = account
         self.beginning = beginning
-        self.moving_avg = MovingAverage(sess)
+        if moving_avg is None:
+            moving_avg = MovingAverage(sess)
+        self.moving_avg = moving_avg
+        self.drop_percent = DROP_PERCENT
+        self.configure(params or {})
         self.live = live
+        if live:
+            self.peaks = PeakTracker.from_db(sess, account.name,
+                                             account.exchange)
+        else:
+            self.peaks = PeakTracker()
         self.out_of_btc = 0
         self.hit_coin_limit = 0
 
@@ -38,7 +51,28 @@ class Bot(object):
             log.info("prefetching data from Bot: {} -> {}"
                      .format(beginning, now))
             for ticker in account.all_coins:
-                self.moving_avg.fetch_data(ticker, now, beginning)
+                if ticker not in self.moving_avg.prices:
+                    self.moving_avg.fetch_data(ticker, now, beginning)
+                if step is not None and ticker not in self.moving_avg.signals:
+                    self.moving_avg.precompute(ticker, beginning, now, step)
+
+    def configure(self, params):
+        """Override strategy settings, e.g. for a parameter sweep"""
+        for name, value in params.items():
+            if name == 'weak':
+                self.moving_avg.WEAK = value
+            elif name == 'strong':
+                self.moving_avg.STRONG = value
+            elif name == 'hours':
+                self.moving_avg.HOURS = list(value)
+            elif name == 'bet_size':
+                self.BET_SIZE = value
+            elif name == 'max_coin_holding':
+                self.MAX_COIN_HOLDING = value
+            elif name == 'drop_percent':
+                self.drop_percent = value
+            else:
+                raise ValueError("Unknown strategy parameter '{}'".format(name))
 
     def calculate_strengths(self, period, approx=False):
         return {
@@ -47,32 +81,38 @@ class Bot(object):
 
     def tick(self, period):
         action = False
+        prices = PriceSnapshot.at(self.sess, period)
         for coin in self.account.all_coins:
             if coin == 'BTC':
                 continue  # TODO
             try:
-                this_coin_action = self.tick_coin(period, coin)
+                this_coin_action = self.tick_coin(period, coin, prices)
                 action = action or this_coin_action
             except Exception as e:
                 log.error("Got error at {},{}: {}".format(coin, period, e))
                 raise e
+        self.peaks.save(self.sess)
         return action
 
-    def tick_coin(self, period, coin):
-        sold = self.check_sells(coin, period)
+    def tick_coin(self, period, coin, prices=None):
+        sold = self.check_sells(coin, period, prices)
         if sold:
             self.account.save(self.sess)
             return True
-        bought = self.check_buys(coin, period)
+        bought = self.check_buys(coin, period, prices)
         if bought:
             self.account.save(self.sess)
             return True
         return False
 
-    def check_sells(self, coin, period):
+    def check_sells(self, coin, period, prices=None):
         if self.account.balance(coin) <= 0:
+            self.peaks.close(coin)
             return False
-        action = stop_loss_strat(self.sess, period, coin, self.account)
+        action = stop_loss_strat(self.sess, period, coin, self.account,
+                                 peaks=self.peaks,
+                                 drop_percent=self.drop_percent,
+                                 prices=prices)
         if not action:
             return False
 
@@ -83,15 +123,17 @@ class Bot(object):
         if fraction == -1 and sell_worked:
             # hack: make sure to zero out balances after selling
             self.account.balances[coin] = 0
+            self.peaks.close(coin)
         return True
 
-    def check_buys(self, coin, period):
-        action = self.moving_avg.run_strategy(period, coin)
+    def check_buys(self, coin, period, prices=None):
+        action = self.moving_avg.run_strategy(period, coin, prices)
         if not action:
             return False
 
         fraction, price = action
-        acct_value = account_value_btc(self.sess, self.account, now=period)
+        acct_value = account_value_btc(self.sess, self.account, now=period,
+                                       prices=prices)
 
         coin_holding_btc = self.account.balance(coin) * price
         coin_holding_percent = round(coin_holding_btc / acct_value, 3)
@@ -127,6 +169,6 @@ def make_transaction(account, coin, units, price, period, live):
     cost = account.trade(coin, units, price, period)
     txns.warn("{}: {} {} of {} @ {} BTC ({})"
               .format(str(period), verb, units, coin, price, cost))
-    account.update('BTC', cost, period)
+    account.update('BTC', cost, 1, period)
     log.warn("  After {}: {}".format(verb, account))
     return True
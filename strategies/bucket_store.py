@@ -0,0 +1,205 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+from itertools import islice, takewhile
+import os
+import pickle
+
+from util import from_epoch, to_epoch
+
+# bump when the saved format changes, older files are ignored
+VERSION = 2
+
+
+class Buckets(object):
+    """A coin's asks in 15 minute buckets, as (sum, count, min, max, first,
+    last) aggregates in parallel typed arrays sorted by bucket time. Costs
+    the same per bucket however many ticks went into it.
+    """
+    FIELDS = ['epochs', 'sums', 'counts', 'mins', 'maxes', 'firsts', 'lasts']
+
+    def __init__(self):
+        self.epochs = array('q')  # microseconds since the unix epoch
+        self.sums = array('d')
+        self.counts = array('q')
+        self.mins = array('d')
+        self.maxes = array('d')
+        self.firsts = array('d')
+        self.lasts = array('d')
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __eq__(self, other):
+        return all(getattr(self, f) == getattr(other, f) for f in self.FIELDS)
+
+    def __repr__(self):
+        return "Buckets({} buckets, {} ticks)" \
+               .format(len(self), sum(self.counts))
+
+    def times(self):
+        return [from_epoch(e) for e in self.epochs]
+
+    def index(self, bucket):
+        return bisect_left(self.epochs, to_epoch(bucket))
+
+    def add(self, bucket, ask):
+        self.add_epoch(to_epoch(bucket), ask)
+
+    def add_epoch(self, epoch, ask):
+        """Add one tick, ticks have to be added oldest first"""
+        if self.epochs and self.epochs[-1] == epoch:
+            self.sums[-1] += ask
+            self.counts[-1] += 1
+            self.mins[-1] = min(self.mins[-1], ask)
+            self.maxes[-1] = max(self.maxes[-1], ask)
+            self.lasts[-1] = ask
+        else:
+            self.append_epoch(epoch, ask, 1, ask, ask, ask, ask)
+
+    def append(self, bucket, total, count, low, high, first, last):
+        """Add an already aggregated bucket, merging it into the newest one
+        if they are for the same time
+        """
+        self.append_epoch(to_epoch(bucket), total, count, low, high, first,
+                          last)
+
+    def append_epoch(self, epoch, total, count, low, high, first, last):
+        if self.epochs and epoch < self.epochs[-1]:
+            raise ValueError("bucket {} is older than the newest one"
+                             .format(from_epoch(epoch)))
+        if self.epochs and epoch == self.epochs[-1]:
+            self.sums[-1] += total
+            self.counts[-1] += count
+            self.mins[-1] = min(self.mins[-1], low)
+            self.maxes[-1] = max(self.maxes[-1], high)
+            self.lasts[-1] = last
+            return
+        self.epochs.append(epoch)
+        self.sums.append(total)
+        self.counts.append(count)
+        self.mins.append(low)
+        self.maxes.append(high)
+        self.firsts.append(first)
+        self.lasts.append(last)
+
+    def drop(self, n):
+        """Forget the oldest `n` buckets"""
+        for field in self.FIELDS:
+            del getattr(self, field)[:n]
+
+    def refill(self, i, asks):
+        """Replace bucket `i` with the aggregate of `asks`"""
+        self.sums[i] = sum(asks)
+        self.counts[i] = len(asks)
+        self.mins[i] = min(asks)
+        self.maxes[i] = max(asks)
+        self.firsts[i] = asks[0]
+        self.lasts[i] = asks[-1]
+
+    def rebuild(self, bucket, asks):
+        """Replace the aggregate for `bucket` with `asks`, oldest first,
+        adding the bucket in its place if there isn't one yet
+        """
+        epoch = to_epoch(bucket)
+        i = bisect_left(self.epochs, epoch)
+        if i == len(self) or self.epochs[i] != epoch:
+            for field in self.FIELDS:
+                getattr(self, field).insert(i, 0)
+            self.epochs[i] = epoch
+        self.refill(i, asks)
+
+
+class BucketStore(object):
+    """Bucketed asks for each coin, kept up to date incrementally. Remembers
+    how far each coin has been loaded (its watermark) and every tick in its
+    buckets, so that newer ticks can be added and ones that fall out of the
+    window removed one at a time.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.buckets = {}  # coin -> Buckets
+        self.ticks = {}  # coin -> deque of (timestamp, bucket, ask), oldest first
+        self.watermarks = {}
+
+    def reset(self, coin):
+        self.buckets[coin] = Buckets()
+        self.ticks[coin] = deque()
+        self.watermarks.pop(coin, None)
+
+    def add(self, coin, timestamp, bucket, ask):
+        """Add a tick. One older than the newest tick is put in its place
+        and its bucket rebuilt, which is slower.
+        """
+        ticks = self.ticks[coin]
+        if not ticks or ticks[-1][0] <= timestamp:
+            self.buckets[coin].add(bucket, ask)
+            ticks.append((timestamp, bucket, ask))
+            return
+        # late ticks are near the end, so look for the spot from there
+        i = len(ticks)
+        while i and ticks[i - 1][0] > timestamp:
+            i -= 1
+        ticks.insert(i, (timestamp, bucket, ask))
+        lo = i
+        while lo and ticks[lo - 1][1] == bucket:
+            lo -= 1
+        asks = [t[2] for t in takewhile(lambda t: t[1] == bucket,
+                                        islice(ticks, lo, None))]
+        self.buckets[coin].rebuild(bucket, asks)
+
+    def held(self, coin, since):
+        """How many ticks at each timestamp from `since` on are in the store"""
+        return Counter(t[0] for t in takewhile(lambda t: t[0] >= since,
+                                               reversed(self.ticks[coin])))
+
+    def evict(self, coin, now):
+        """Drop ticks at or before `now - window`, returning how many"""
+        cutoff = now - self.window
+        ticks = self.ticks[coin]
+        evicted = 0
+        while ticks and ticks[0][0] <= cutoff:
+            timestamp, bucket, ask = ticks.popleft()
+            evicted += 1
+        if evicted:
+            # older buckets are gone entirely, the last one may be partly
+            # left and is rebuilt from the ticks still in it
+            buckets = self.buckets[coin]
+            rest = [t[2] for t in takewhile(lambda t: t[1] == bucket, ticks)]
+            i = buckets.index(bucket)
+            buckets.drop(i if rest else i + 1)
+            if rest:
+                buckets.refill(0, rest)
+        return evicted
+
+    def save(self, path):
+        coins = {coin: {'watermark': self.watermarks[coin],
+                        'ticks': list(ticks)}
+                 for coin, ticks in self.ticks.items()
+                 if coin in self.watermarks}
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': VERSION, 'window': self.window,
+                         'coins': coins}, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path, window):
+        """The store saved at `path`, or an empty one if there isn't one
+        saved with the same version and window
+        """
+        store = BucketStore(window)
+        try:
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+        except FileNotFoundError:
+            return store
+        if saved.get('version') != VERSION or saved.get('window') != window:
+            return store
+        for coin, data in saved['coins'].items():
+            store.reset(coin)
+            for timestamp, bucket, ask in data['ticks']:
+                store.add(coin, timestamp, bucket, ask)
+            store.watermarks[coin] = data['watermark']
+        return store
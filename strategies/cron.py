@@ -2,26 +2,33 @@ import sys
 import datetime
 import logging
 import random
+import time
 import requests
 
 import config
 from bot import Bot
 from backtest import Backtester, fetch_data_timestamp
+from sweep import Sweeper
 from stop_loss import calc_change_percent, MIN_HOLD_TIME
 from apis import Bittrex
-from db import create_db, new_session, Ticker
+from db import (backfill_rollups, compact_history, create_db, explain,
+                incremental_vacuum, insert_tickers, new_session, rollups_cover,
+                Balance, Compaction, DayRollup, Peak, Ticker)
 from durable_account import DurableAccount
+from instrument import install, instruments, profile_path, profiled
+from moving_avg import MovingAverage
+from price_store import PriceStore
 from slack import setup_loggers
-from util import run
+from util import from_epoch, run, to_epoch
 
 log = logging.getLogger('cron')
 
 
-def account(sess, config, verbose=True) -> DurableAccount:
+def account(sess, config, verbose=True, ccxt=None) -> DurableAccount:
     name = config['account']
     log.debug("Fetching account '{}' @ bittrex".format(name))
-    account = DurableAccount.from_db(sess, name,
-                                     exchange='bittrex', ccxt=Bittrex(config))
+    account = DurableAccount.from_db(sess, name, exchange='bittrex',
+                                     ccxt=ccxt or Bittrex(config))
     if verbose:
         open_txns = account.remote_transactions()
         definitely_no_txns = open_txns is not None and len(open_txns) == 0
@@ -39,8 +46,8 @@ def account(sess, config, verbose=True) -> DurableAccount:
     return account
 
 
-def post_balance(sess, config):
-    acct = account(sess, config, verbose=False)
+def post_balance(sess, config, ccxt=None):
+    acct = account(sess, config, verbose=False, ccxt=ccxt)
     btc = round(acct.value_btc(sess), 8)
     url = config['spreadsheet']['url']
     secret = config['spreadsheet']['secret']
@@ -64,19 +71,18 @@ def print_coin(sess, account, value, coin):
     log.info(info)
 
 
-def update(sess, config):
+def update(sess, config, exchanges=None):
     """"Pull data from the exchanges and store it in our database"""
-    exchanges = {
-        'Bittrex': Bittrex(config),
-    }
+    if exchanges is None:
+        exchanges = {
+            'Bittrex': Bittrex(config),
+        }
+    ingest = config.get('ingest', {})
     start = datetime.datetime.utcnow()
     for name, exch in exchanges.items():
         print(name)
-        for coin in exch.COINS:
-            data = exch.fetch_ticker(coin)
-            if data is None:
-                continue
-            sess.add(Ticker(data))
+        rows = exch.fetch_tickers(exch.COINS, **ingest)
+        insert_tickers(sess, rows)
 
     sess.commit()
     elapsed = datetime.datetime.utcnow() - start
@@ -84,11 +90,30 @@ def update(sess, config):
         log.warn("Ran update in {}s".format(elapsed.seconds))
 
 
-def tick(sess, config):
+def refreshed(sess, config, coins, now, moving_avg=None):
+    """Moving average buckets brought up to `now`, starting from where the
+    daemon's last cycle or the `buckets` file left them. None to fetch them
+    from scratch, as there is nothing to start from.
+    """
+    path = config.get('buckets')
+    if moving_avg is None:
+        if path is None:
+            return None
+        moving_avg = MovingAverage(sess)
+        moving_avg.load_buckets(path)
+    for coin in coins:
+        moving_avg.refresh(coin, now)
+    if path is not None:
+        moving_avg.save_buckets(path)
+    return moving_avg
+
+
+def tick(sess, config, ccxt=None, moving_avg=None):
     """Run our strategies for the current time"""
     start = datetime.datetime.utcnow()
-    acct = account(sess, config, verbose=False)
-    bot = Bot(sess, acct, now=start, live=True)
+    acct = account(sess, config, verbose=False, ccxt=ccxt)
+    moving_avg = refreshed(sess, config, acct.all_coins, start, moving_avg)
+    bot = Bot(sess, acct, now=start, live=True, moving_avg=moving_avg)
     did_something = bot.tick(period=start)
     elapsed = datetime.datetime.utcnow() - start
     if elapsed.seconds > 30:
@@ -102,11 +127,12 @@ def tick(sess, config):
         log.info(f"Open transactions:\n {txns}")
 
 
-def strengths(sess, config):
+def strengths(sess, config, ccxt=None, moving_avg=None):
     """Print the current relative strengths of altcoins"""
-    acct = account(sess, config, verbose=False)
+    acct = account(sess, config, verbose=False, ccxt=ccxt)
     now = datetime.datetime.utcnow()
-    bot = Bot(sess, acct)
+    moving_avg = refreshed(sess, config, acct.all_coins, now, moving_avg)
+    bot = Bot(sess, acct, moving_avg=moving_avg)
     strengths = bot.calculate_strengths(now, approx=True)
 
     time_width = 6
@@ -159,8 +185,194 @@ def data(sess, config):
 def backtest(sess, config):
     data(sess, config)
     bt = config['backtesting']
-    tester = Backtester(sess, config['db'])
-    tester.run_backtest(bt['trials'], bt['trial_days'], bt['threads'])
+    archive = config['archive'] if bt.get('from_archive') else None
+    tester = Backtester(sess, config['db'], archive=archive,
+                        instrument=config.get('instrument'))
+    tester.run_backtest(bt['trials'], bt['trial_days'], bt['threads'],
+                        results_file=bt.get('results_file'),
+                        seed=config.get('seed'),
+                        checkpoint=bt.get('checkpoint'))
+
+
+def walk_forward(sess, config):
+    """Backtest consecutive windows across all of the price history"""
+    data(sess, config)
+    bt = config['backtesting']
+    wf = bt['walk_forward']
+    archive = config['archive'] if bt.get('from_archive') else None
+    tester = Backtester(sess, config['db'], archive=archive,
+                        instrument=config.get('instrument'))
+    tester.run_walk_forward(wf['window_days'], wf.get('stride_days'),
+                            results_file=bt.get('results_file'))
+
+
+def sweep(sess, config):
+    """Backtest every combination of the strategy parameters in the config"""
+    data(sess, config)
+    bt = config['backtesting']
+    sw = config['sweep']
+    archive = config['archive'] if bt.get('from_archive') else None
+    sweeper = Sweeper(sess, config['db'], archive=archive,
+                      instrument=config.get('instrument'))
+    sweeper.run_sweep(sw['params'], sw['trials'], sw['trial_days'],
+                      bt['threads'], cache=sw.get('cache'),
+                      search=sw.get('search', 'grid'),
+                      samples=sw.get('samples'), seed=config.get('seed'))
+
+
+def export(sess, config):
+    """Write the history table out to the binary archive"""
+    path = config['archive']
+    rows = PriceStore.export(sess, path, 'bittrex', Ticker.coins(sess))
+    log.info("Archived {} rows for {} coins to {}"
+             .format(sum(rows.values()), len(rows), path))
+
+
+def import_archive(sess, config):
+    """Load rows from the binary archive that aren't in our history yet"""
+    store = PriceStore.open(config['archive'])
+    imported = 0
+    for coin in store.coins:
+        rows = (row for batch in store.rows(coin) for row in batch)
+        imported += insert_tickers(sess, rows, dedupe=True)
+    sess.commit()
+    log.info("Imported {} rows from {}".format(imported, config['archive']))
+
+
+def rollups(sess, config):
+    """Rebuild the 15m/1h/1d rollups from the whole history table"""
+    sess.close()
+    written = backfill_rollups(sess.bind)
+    log.info("Rebuilt rollups: {}".format(
+        ", ".join("{} {}".format(n, table) for table, n in written.items())))
+
+
+def retention_cutoff(sess, now, raw_days):
+    """Start of the oldest day of raw ticks to keep: the last `raw_days`,
+    the longest moving average window, and back to when any open position
+    was opened or started tracking its peak, with a day to spare for "as
+    of" lookups. Strategies never read raw ticks from before it.
+    """
+    keep = [now - datetime.timedelta(days=raw_days),
+            now - datetime.timedelta(hours=max(MovingAverage.HOURS))]
+    keep += [b.opened for b in sess.query(Balance)
+             .filter(Balance.coin != 'BTC')
+             .filter(Balance.balance > 0) if b.opened is not None]
+    keep += [since for (since,) in sess.query(Peak.since)
+             .join(Balance, Balance.coin == Peak.coin)
+             .filter(Balance.name == Peak.name)
+             .filter(Balance.exchange == Peak.exchange)
+             .filter(Balance.balance > 0) if since is not None]
+    return DayRollup.bucket_of(min(keep) - datetime.timedelta(days=1))
+
+
+def compact(sess, config):
+    """Delete (or archive) raw ticks that are old enough to only be needed
+    as rollups, a batch at a time, then hand the space back with VACUUM
+    """
+    retention = config['retention']
+    through = retention_cutoff(sess, datetime.datetime.utcnow(),
+                               retention['raw_days'])
+    compacted = Compaction.through_time(sess)
+    if compacted is not None and through <= compacted:
+        log.info("History is already compacted through {}".format(compacted))
+        return
+    if not rollups_cover(sess, through):
+        log.warn("Rollups are missing ticks from before {}, rebuilding them"
+                 .format(through))
+        sess.close()
+        backfill_rollups(sess.bind)
+
+    archive = None
+    if retention.get('archive_db'):
+        archive = new_session(create_db(retention['archive_db']))
+    run = compact_history(sess, through,
+                          batch_size=retention.get('batch_size', 5000),
+                          archive=archive, pause=retention.get('pause', 0))
+    log.info("Compacted history through {}: deleted {} rows, archived {}"
+             .format(through, run.deleted, run.archived))
+    sess.close()
+    if retention.get('vacuum', True):
+        incremental_vacuum(sess.bind, retention.get('vacuum_pages'))
+
+
+def explain_queries(sess, config):
+    """Print the database's query plans for the Ticker helpers"""
+    coins = Ticker.coins(sess) or ['BTC']
+    now = datetime.datetime.utcnow()
+    for name, query in Ticker.helper_queries(sess, coins[0], now):
+        plan = explain(sess, query)
+        log.info("{}:\n```{}```".format(
+            name, "\n".join(" ".join(str(c) for c in row) for row in plan)))
+
+
+class Daemon(object):
+    """Runs actions on a schedule from one long-lived process, keeping the
+    database engine, exchange client and moving average buckets warm
+    between runs instead of starting cold each time
+    """
+
+    def __init__(self, sess, config, clock=datetime.datetime.utcnow):
+        self.sess = sess
+        self.config = config
+        self.clock = clock
+        # action -> minutes between runs, run in this order when due together
+        self.schedule = config['daemon']['schedule']
+        for action in self.schedule:
+            if action not in ACTIONS or action == 'daemon':
+                raise ValueError("can't schedule '{}'".format(action))
+        bittrex = Bittrex(config)
+        moving_avg = MovingAverage(sess)
+        if config.get('buckets'):
+            moving_avg.load_buckets(config['buckets'])
+        self.warm = {
+            'update': {'exchanges': {'Bittrex': bittrex}},
+            'tick': {'ccxt': bittrex, 'moving_avg': moving_avg},
+            'strengths': {'ccxt': bittrex, 'moving_avg': moving_avg},
+            'post_balance': {'ccxt': bittrex},
+        }
+        now = self.clock()
+        self.next_run = {a: next_time(now, m) for a, m in self.schedule.items()}
+
+    def run_forever(self):
+        while True:
+            self.run_pending(self.clock())
+            wait = min(self.next_run.values()) - self.clock()
+            time.sleep(max(0, wait.total_seconds()))
+
+    def run_pending(self, now):
+        due = [a for a in self.schedule if self.next_run[a] <= now]
+        for action in due:
+            print("--Running '{}'--".format(action))
+            try:
+                with instruments.stage("cron: {}".format(action)):
+                    ACTIONS[action](self.sess, self.config,
+                                    **self.warm.get(action, {}))
+            except Exception:
+                log.exception("Error running '{}'".format(action))
+                self.sess.rollback()
+            self.next_run[action] = next_time(self.clock(),
+                                              self.schedule[action])
+        if due:
+            self.sess.close()  # don't hold a transaction open while idle
+        if due and instruments.enabled:
+            log.warn("Timings for {}:\n```{}```"
+                     .format(" ".join(due), instruments.table()))
+            instruments.reset()
+        return due
+
+
+def next_time(now, minutes):
+    """The next multiple of `minutes` since the epoch after `now`, so that
+    e.g. every 10 minutes runs on the tens like cron would
+    """
+    period = minutes * 60 * 10 ** 6
+    return from_epoch((to_epoch(now) // period + 1) * period)
+
+
+def daemon(sess, config):
+    """Keep running, doing the actions in `daemon.schedule` as they're due"""
+    Daemon(sess, config).run_forever()
 
 
 def pull(sess, config):
@@ -172,13 +384,21 @@ def pull(sess, config):
 ACTIONS = {
     'account': account,
     'backtest': backtest,
+    'daemon': daemon,
     'data': data,
+    'explain': explain_queries,
+    'export': export,
+    'import': import_archive,
     'update': update,
+    'walkforward': walk_forward,
     'ipython': ipython,
     'tick': tick,
     'strengths': strengths,
     'pull': pull,
+    'sweep': sweep,
     'post_balance': post_balance,
+    'rollups': rollups,
+    'compact': compact,
 }
 
 
@@ -188,20 +408,36 @@ def main(parsed, actions):
 
     random.seed(parsed['seed'])
 
+    settings = parsed.get('instrument') or {}
+    profile = None
+    if settings.get('enabled'):
+        install(db)
+        profile = settings.get('profile')
+
     for action in actions:
         func = ACTIONS.get(action)
         if func is None:
             raise ValueError("valid actions are {}".format(list(ACTIONS.keys())))
         print("--Running '{}'--".format(action))
-        func(sess, parsed)
+        path = profile_path(profile, action) if profile else None
+        with instruments.stage("cron: {}".format(action)), profiled(path):
+            func(sess, parsed)
+
+    if instruments.enabled:
+        log.warn("Timings for {}:\n```{}```"
+                 .format(" ".join(actions), instruments.table()))
+        instruments.reset()
 
 
 if __name__ == "__main__":
     config_file = sys.argv[1]
     actions = sys.argv[2:]
+    parsed = config.read_config(config_file)
+    if '--instrument' in actions:
+        actions.remove('--instrument')
+        parsed.setdefault('instrument', {})['enabled'] = True
     if not actions:
         actions = ['update']
-    parsed = config.read_config(config_file)
     print("got config: {}".format(parsed))
 
     if 'backtest' not in actions:
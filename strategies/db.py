@@ -1,14 +1,30 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
+import time
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import OperationalError
 from sqlalchemy import Column, Integer, Float, String, DateTime, Index
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import func
+from sqlalchemy import bindparam, create_engine
+from sqlalchemy.orm import aliased, sessionmaker
+from sqlalchemy.sql import func, union_all
+
+from util import EPOCH, MICROSECOND
 
 
 Base = declarative_base()
 
+# session.info key for a preloaded `price_store.PriceStore`
+PRICE_STORE = 'price_store'
+
+
+# https://stackoverflow.com/questions/3463930/how-to-round-the-minute-of-a-datetime-object-python
+def roundTime(dt, dateDelta=timedelta(minutes=15)):
+    roundTo = dateDelta.total_seconds()
+    seconds = (dt - dt.min).seconds
+    # // is a floor division, not a comment on following line:
+    rounding = (seconds + roundTo / 2) // roundTo * roundTo
+    return dt + timedelta(0, rounding - seconds, -dt.microsecond)
+
 
 def construct(obj, initial_data, kwargs):
     for dictionary in initial_data:
@@ -40,24 +56,103 @@ class Ticker(Base):
 
     @staticmethod
     def peak(sess, coin, start_time=None, now=None):
+        store = sess.info.get(PRICE_STORE)
+        if store is not None and store.covers(coin, now, start_time):
+            return store.peak(coin, start_time, now)
+        res = Ticker.peak_query(sess, coin, start_time, now).first()
+        return res[0] if res else None
+
+    @staticmethod
+    def peak_query(sess, coin, start_time=None, now=None):
+        # an empty range has no tiles, the raw query gives its NULL peak
+        if start_time and now is not None and start_time < now:
+            return Ticker.rollup_peak_query(sess, coin, start_time, now)
         query = Ticker.at_time(
             sess.query(func.max(Ticker.last)).filter(Ticker.coin == coin),
             now
         )
         if start_time:
             query = query.filter(Ticker.timestamp > start_time)
-        res = query.first()
-        return res[0] if res else None
+        return query
+
+    @staticmethod
+    def rollup_peak_query(sess, coin, start_time, now):
+        """`peak_query` with the whole days and hours in the range read from
+        their rollups, and only the ragged ends from raw ticks
+        """
+        parts = []
+        # ticks in (start_time, now] as [lo, hi)
+        for rollup, lo, hi in tile(start_time + MICROSECOND, now + MICROSECOND,
+                                   [DayRollup, HourRollup]):
+            if rollup is None:
+                parts.append(sess.query(func.max(Ticker.last).label('peak'))
+                             .filter(Ticker.coin == coin)
+                             .filter(Ticker.timestamp >= lo)
+                             .filter(Ticker.timestamp < hi))
+            else:
+                parts.append(sess.query(func.max(rollup.high).label('peak'))
+                             .filter(rollup.coin == coin)
+                             .filter(rollup.bucket >= lo)
+                             .filter(rollup.bucket < hi))
+        peaks = union_all(*[p.statement for p in parts]).alias()
+        return sess.query(func.max(peaks.c.peak))
 
     @staticmethod
     def current_ask(sess, coin, now=None):
-        query = Ticker.at_time(
+        store = sess.info.get(PRICE_STORE)
+        if store is not None and store.covers(coin, now):
+            return store.current_ask(coin, now)
+        ask = Ticker.current_ask_query(sess, coin, now).first()
+        return ask[0] if ask else None
+
+    @staticmethod
+    def current_ask_query(sess, coin, now=None):
+        return Ticker.at_time(
             sess.query(Ticker.ask)
                 .filter(Ticker.coin == coin)
                 .order_by(Ticker.timestamp.desc()),
             now).limit(1)
-        ask = query.first()
-        return ask[0] if ask else None
+
+    @staticmethod
+    def latest(sess, now=None):
+        """The last tick at or before `now` for every registered coin, as
+        {coin: row with bid, ask & last}
+        """
+        return {row.coin: row for row in Ticker.latest_query(sess, now)}
+
+    @staticmethod
+    def latest_query(sess, now=None):
+        # one index lookup per coin in the registry, like `current_ask`
+        tick = aliased(Ticker)
+        newest = sess.query(tick.id).filter(tick.coin == Coin.coin)
+        if now is not None:
+            newest = newest.filter(tick.timestamp <= now)
+        newest = newest.order_by(tick.timestamp.desc()).limit(1) \
+            .correlate(Coin).as_scalar()
+        return sess.query(Ticker.coin, Ticker.bid, Ticker.ask, Ticker.last) \
+            .filter(Ticker.id.in_(sess.query(newest).select_from(Coin)))
+
+    @staticmethod
+    def history_query(sess, coin, start, end):
+        """Ticks for a coin strictly between start and end"""
+        return sess.query(Ticker) \
+            .filter(Ticker.coin == coin) \
+            .filter(Ticker.timestamp < end) \
+            .filter(Ticker.timestamp > start)
+
+    @staticmethod
+    def ticks_query(sess, coin, start, end, include_start=False):
+        """(timestamp, ask) for the ticks of a coin with an ask between start
+        and end, oldest first
+        """
+        after = Ticker.timestamp >= start if include_start \
+            else Ticker.timestamp > start
+        return sess.query(Ticker.timestamp, Ticker.ask) \
+            .filter(Ticker.coin == coin) \
+            .filter(Ticker.timestamp < end) \
+            .filter(after) \
+            .filter(Ticker.ask.isnot(None)) \
+            .order_by(Ticker.timestamp)
 
     @staticmethod
     def at_time(query, now=None):
@@ -67,10 +162,235 @@ class Ticker(Base):
 
     @staticmethod
     def coins(sess):
-        return [t[0] for t in sess.query(Ticker.coin).distinct().all()]
+        coins = [t[0] for t in Ticker.coins_query(sess).all()]
+        if not coins:
+            # history written some other way than `insert_tickers`
+            coins = [t[0] for t in sess.query(Ticker.coin).distinct()]
+        return coins
+
+    @staticmethod
+    def coins_query(sess):
+        return sess.query(Coin.coin).distinct().order_by(Coin.coin)
+
+    @staticmethod
+    def helper_queries(sess, coin, now):
+        """The queries behind each helper, for checking their query plans"""
+        day_ago = now - timedelta(days=1)
+        return [
+            ('current_ask', Ticker.current_ask_query(sess, coin, now)),
+            ('peak', Ticker.peak_query(sess, coin, day_ago, now)),
+            ('history', Ticker.history_query(sess, coin, day_ago, now)),
+            ('latest', Ticker.latest_query(sess, now)),
+            ('coins', Ticker.coins_query(sess)),
+        ]
+
+
+class PriceSnapshot(object):
+    """Asks for every coin at one moment, fetched with a single query so
+    that everything run during a tick can share them. Coins missing from
+    the registry fall back to `Ticker.current_ask`.
+    """
+
+    def __init__(self, sess, now, asks=None):
+        self.sess = sess
+        self.now = now
+        self.asks = asks if asks is not None else {}
+
+    def ask(self, coin):
+        if coin not in self.asks:
+            self.asks[coin] = Ticker.current_ask(self.sess, coin, self.now)
+        return self.asks[coin]
+
+    @staticmethod
+    def at(sess, now=None):
+        if sess.info.get(PRICE_STORE) is not None:
+            # the store answers without queries, look coins up as needed
+            return PriceSnapshot(sess, now)
+        latest = Ticker.latest(sess, now)
+        return PriceSnapshot(sess, now,
+                             {coin: row.ask for coin, row in latest.items()})
 
 
 ticker_timestamp_idx = Index('ticker_ts_idx', Ticker.timestamp)
+# covers the coin + time range lookups in current_ask & peak
+ticker_coin_timestamp_idx = Index('ticker_coin_ts_idx', Ticker.coin,
+                                  Ticker.timestamp, Ticker.ask, Ticker.last)
+
+
+class Coin(Base):
+    """Every coin in `history`, kept up to date by `insert_tickers` so that
+    listing them doesn't have to scan the whole table
+    """
+    __tablename__ = "coins"
+    __table_args__ = (
+        Index("uniq_coin", "exchange", "coin", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    exchange = Column(String(20))
+    coin = Column(String(10))
+    first_seen = Column(DateTime)
+
+    def __init__(self, *initial_data, **kwargs):
+        construct(self, initial_data, kwargs)
+
+    def __repr__(self):
+        return "Coin(exchange={}, coin={}, first_seen={})" \
+               .format(self.exchange, self.coin, self.first_seen)
+
+
+class RollupColumns(object):
+    """Ticks aggregated into buckets of `span`, kept up to date by
+    `insert_tickers` so that long ranges can be read a bucket at a time
+    instead of a tick at a time. Sum, count, min, max, first & last are of
+    the ask, OHLC is of the last trade price and volume is the latest of the
+    exchange's 24 hour volumes.
+    """
+    span = None
+
+    id = Column(Integer, primary_key=True)
+    exchange = Column(String(20))
+    coin = Column(String(10))
+    bucket = Column(DateTime)
+
+    count = Column(Integer)
+    sum = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+    first = Column(Float)
+    last = Column(Float)
+    # when the first & last ticks were seen, for folding in ticks later
+    first_at = Column(DateTime)
+    last_at = Column(DateTime)
+
+    open = Column(Float)
+    high = Column(Float)
+    low = Column(Float)
+    close = Column(Float)
+    volume = Column(Float)
+
+    def __init__(self, *initial_data, **kwargs):
+        construct(self, initial_data, kwargs)
+
+    def __repr__(self):
+        return "{}(coin={}, bucket={}, count={}, sum={})" \
+               .format(type(self).__name__, self.coin, self.bucket,
+                       self.count, self.sum)
+
+    @classmethod
+    def bucket_of(cls, dt):
+        """Start of the bucket a tick at `dt` goes in"""
+        return dt - (dt - EPOCH) % cls.span
+
+    @classmethod
+    def starts(cls, bucket):
+        """When the ticks in `bucket` start"""
+        return bucket
+
+    @classmethod
+    def first_bucket_from(cls, dt):
+        """The first bucket with no ticks from before `dt`"""
+        bucket = cls.bucket_of(dt)
+        if cls.starts(bucket) < dt:
+            bucket += cls.span
+        return bucket
+
+    @classmethod
+    def range_query(cls, sess, coin, first, last):
+        """Ask aggregates for the buckets from first through last, oldest
+        first
+        """
+        return sess.query(cls.bucket, cls.sum, cls.count, cls.min, cls.max,
+                          cls.first, cls.last) \
+            .filter(cls.coin == coin) \
+            .filter(cls.bucket >= first) \
+            .filter(cls.bucket <= last) \
+            .filter(cls.count > 0) \
+            .order_by(cls.bucket, cls.first_at)
+
+
+class Rollup(RollupColumns, Base):
+    """15 minute buckets, the same ones as `roundTime`, used for moving
+    averages
+    """
+    __tablename__ = "rollups_15m"
+    __table_args__ = (
+        Index("uniq_rollup_15m", "coin", "bucket", "exchange", unique=True),
+    )
+    span = timedelta(minutes=15)
+
+    @classmethod
+    def bucket_of(cls, dt):
+        # centered on the bucket time rather than starting at it
+        return roundTime(dt)
+
+    @classmethod
+    def starts(cls, bucket):
+        return bucket - cls.span / 2
+
+
+class HourRollup(RollupColumns, Base):
+    __tablename__ = "rollups_1h"
+    __table_args__ = (
+        Index("uniq_rollup_1h", "coin", "bucket", "exchange", unique=True),
+    )
+    span = timedelta(hours=1)
+
+
+class DayRollup(RollupColumns, Base):
+    __tablename__ = "rollups_1d"
+    __table_args__ = (
+        Index("uniq_rollup_1d", "coin", "bucket", "exchange", unique=True),
+    )
+    span = timedelta(days=1)
+
+
+ROLLUPS = [Rollup, HourRollup, DayRollup]
+
+
+class Compaction(Base):
+    """A run of `compact_history`. Raw ticks before the latest `through`
+    have been deleted, so rollups for them are final: they're no longer
+    added to or rebuilt.
+    """
+    __tablename__ = "compactions"
+
+    id = Column(Integer, primary_key=True)
+    through = Column(DateTime)
+    ran = Column(DateTime)
+    deleted = Column(Integer)
+    archived = Column(Integer)
+
+    def __init__(self, *initial_data, **kwargs):
+        construct(self, initial_data, kwargs)
+
+    def __repr__(self):
+        return "Compaction(through={}, ran={}, deleted={})" \
+               .format(self.through, self.ran, self.deleted)
+
+    @staticmethod
+    def through_time(sess):
+        """How far history has been compacted, None if it hasn't been"""
+        return sess.query(func.max(Compaction.through)).scalar()
+
+
+def tile(start, end, rollups):
+    """Split the ticks in [start, end) into whole buckets of the first of
+    `rollups` that fit, then of the next ones, then raw ticks for what's
+    left at the ends. Returns [(rollup class or None for raw, lo, hi)].
+    """
+    if start >= end:
+        return []
+    if not rollups:
+        return [(None, start, end)]
+    rollup, finer = rollups[0], rollups[1:]
+    lo = rollup.bucket_of(start)
+    if lo < start:
+        lo += rollup.span
+    hi = rollup.bucket_of(end)
+    if lo >= hi:
+        return tile(start, end, finer)
+    return tile(start, lo, finer) + [(rollup, lo, hi)] + tile(hi, end, finer)
 
 
 class Balance(Base):
@@ -115,16 +435,431 @@ class Balance(Base):
             sess.delete(existing)
 
 
+class Peak(Base):
+    """Highest price of an open position since its stop-loss lockup ended,
+    as of `through`
+    """
+    __tablename__ = "peaks"
+    __table_args__ = (
+        Index("uniq_peaks", "name", "coin", "exchange", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(12))
+
+    exchange = Column(String(20))
+    coin = Column(String(10))
+
+    since = Column(DateTime)
+    through = Column(DateTime)
+    peak = Column(Float)
+
+    def __init__(self, *initial_data, **kwargs):
+        construct(self, initial_data, kwargs)
+
+    def __repr__(self):
+        return "Peak(name={}, coin={}, since={}, through={}, peak={})" \
+               .format(self.name, self.coin, self.since, self.through,
+                       self.peak)
+
+
+def stream(sess, query, batch_size=10000):
+    """Rows of a column query as plain tuples, fetched `batch_size` at a
+    time through a server-side cursor where the database has them, so that
+    memory doesn't grow with the size of the result
+    """
+    statement = query.statement.execution_options(stream_results=True)
+    result = sess.execute(statement)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)
+    finally:
+        result.close()
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def new_ticks(sess, batch):
+    """Drop ticks whose (exchange, coin, timestamp) is already stored or
+    repeated earlier in the batch
+    """
+    by_coin = {}
+    for tick in batch:
+        by_coin.setdefault((tick['exchange'], tick['coin']), []).append(tick)
+
+    fresh = []
+    for (exchange, coin), ticks in by_coin.items():
+        times = [t['timestamp'] for t in ticks]
+        seen = set(t[0] for t in sess.query(Ticker.timestamp)
+                   .filter(Ticker.exchange == exchange)
+                   .filter(Ticker.coin == coin)
+                   .filter(Ticker.timestamp >= min(times))
+                   .filter(Ticker.timestamp <= max(times)))
+        for tick in ticks:
+            if tick['timestamp'] not in seen:
+                seen.add(tick['timestamp'])
+                fresh.append(tick)
+    return fresh
+
+
+def register_coins(sess, first_seen):
+    """Add {(exchange, coin): timestamp} to the registry where missing"""
+    known = set(tuple(c) for c in sess.query(Coin.exchange, Coin.coin))
+    new = [{'exchange': exchange, 'coin': coin, 'first_seen': timestamp}
+           for (exchange, coin), timestamp in first_seen.items()
+           if (exchange, coin) not in known]
+    if new:
+        sess.execute(Coin.__table__.insert(), new)
+    return len(new)
+
+
+ROLLUP_FIELDS = ['count', 'sum', 'min', 'max', 'first', 'last', 'first_at',
+                 'last_at', 'open', 'high', 'low', 'close', 'volume']
+
+
+def new_rollup(exchange, coin, bucket):
+    """An empty rollup dict for `fold_tick`, with every column present so a
+    batch of them can be inserted together
+    """
+    rollup = dict.fromkeys(ROLLUP_FIELDS)
+    rollup.update(exchange=exchange, coin=coin, bucket=bucket, count=0)
+    return rollup
+
+
+def fold_tick(rollup, tick):
+    """Add a tick dict to a rollup dict. A tick without an ask only counts
+    towards the high and low, the ask columns and the first & last ticks
+    are for ticks with an ask
+    """
+    timestamp, ask, last = tick['timestamp'], tick['ask'], tick['last']
+    if last is not None:
+        rollup['high'] = last if rollup['high'] is None else max(rollup['high'], last)
+        rollup['low'] = last if rollup['low'] is None else min(rollup['low'], last)
+    if ask is None:
+        return
+    if not rollup['count']:
+        rollup.update(count=1, sum=0.0 + ask, min=ask, max=ask, first=ask,
+                      last=ask, first_at=timestamp, last_at=timestamp,
+                      open=last, close=last, volume=tick['volume'])
+        return
+    rollup['count'] += 1
+    rollup['sum'] += ask
+    rollup['min'] = min(rollup['min'], ask)
+    rollup['max'] = max(rollup['max'], ask)
+    if timestamp < rollup['first_at']:
+        rollup['first_at'] = timestamp
+        rollup['first'], rollup['open'] = ask, last
+    if timestamp >= rollup['last_at']:
+        rollup['last_at'] = timestamp
+        rollup['last'], rollup['close'] = ask, last
+        rollup['volume'] = tick['volume']
+
+
+def update_rollups(sess, ticks, rollups=ROLLUPS):
+    """Fold a batch of tick dicts into their rollups, oldest tick first"""
+    ticks = sorted(ticks, key=lambda t: t['timestamp'])
+    coins = set(t['coin'] for t in ticks)
+    for rollup in rollups:
+        keys = set((t['exchange'], t['coin'], rollup.bucket_of(t['timestamp']))
+                   for t in ticks)
+        buckets = [k[2] for k in keys]
+        existing = {}
+        # plain columns, ORM objects already in the session would be stale
+        # after the UPDATEs below
+        rows = sess.query(rollup.id, rollup.exchange, rollup.coin,
+                          rollup.bucket,
+                          *[getattr(rollup, f) for f in ROLLUP_FIELDS]) \
+            .filter(rollup.coin.in_(coins)) \
+            .filter(rollup.bucket >= min(buckets)) \
+            .filter(rollup.bucket <= max(buckets))
+        for row in rows:
+            key = (row.exchange, row.coin, row.bucket)
+            if key in keys:
+                existing[key] = dict({f: getattr(row, f)
+                                      for f in ROLLUP_FIELDS},
+                                     rollup_id=row.id)
+
+        new = {}
+        for tick in ticks:
+            key = (tick['exchange'], tick['coin'],
+                   rollup.bucket_of(tick['timestamp']))
+            folded = existing.get(key)
+            if folded is None:
+                folded = new.get(key)
+            if folded is None:
+                folded = new[key] = new_rollup(*key)
+            fold_tick(folded, tick)
+
+        table = rollup.__table__
+        if new:
+            sess.execute(table.insert(), list(new.values()))
+        if existing:
+            # the SET clause comes from the other keys
+            sess.execute(
+                table.update().where(table.c.id == bindparam('rollup_id')),
+                list(existing.values()))
+
+
+def insert_tickers(sess, ticks, batch_size=10000, dedupe=False):
+    """Insert an iterable of tick dicts into `history` with one executemany
+    per batch, all inside the session's transaction (the caller commits).
+    Returns how many rows were written.
+    """
+    compacted = Compaction.through_time(sess)
+    inserted = 0
+    for batch in batches(ticks, batch_size):
+        if dedupe:
+            batch = new_ticks(sess, batch)
+        if batch:
+            sess.execute(Ticker.__table__.insert(), batch)
+            inserted += len(batch)
+            first_seen = {}
+            for tick in batch:
+                key = (tick['exchange'], tick['coin'])
+                first_seen[key] = min(first_seen.get(key, tick['timestamp']),
+                                      tick['timestamp'])
+            register_coins(sess, first_seen)
+            if compacted is not None:
+                # already counted in the final rollups
+                batch = [t for t in batch if t['timestamp'] >= compacted]
+            if batch:
+                update_rollups(sess, batch)
+    return inserted
+
+
+class Migration(Base):
+    __tablename__ = "migrations"
+
+    name = Column(String(50), primary_key=True)
+    applied = Column(DateTime)
+
+
+def create_index(index):
+    def create(engine):
+        try:
+            index.create(bind=engine)
+        except OperationalError:
+            pass  # already there, e.g. made by create_all on a new db
+    return create
+
+
+def backfill_coins(engine):
+    sess = new_session(engine)
+    rows = sess.query(Ticker.exchange, Ticker.coin, func.min(Ticker.timestamp)) \
+        .group_by(Ticker.exchange, Ticker.coin)
+    register_coins(sess, {(e, c): first for e, c, first in rows})
+    sess.commit()
+    sess.close()
+
+
+def backfill_rollups(engine, batch_size=10000, rollups=ROLLUPS):
+    """Rebuild the rollups from `history` in one pass over the ticks,
+    returning how many of each were written. Only rebuilds the ones after
+    history was compacted.
+    """
+    sess = new_session(engine)
+    compacted = Compaction.through_time(sess)
+    first = {}
+    for rollup in rollups:
+        query = sess.query(rollup)
+        if compacted is not None:
+            first[rollup] = rollup.first_bucket_from(compacted)
+            query = query.filter(rollup.bucket >= first[rollup])
+        query.delete(synchronize_session=False)
+    ticks = sess.query(Ticker.exchange, Ticker.coin, Ticker.timestamp,
+                       Ticker.ask, Ticker.last, Ticker.volume)
+    if compacted is not None:
+        ticks = ticks.filter(Ticker.timestamp >= compacted)
+    ticks = ticks \
+        .order_by(Ticker.exchange, Ticker.coin, Ticker.timestamp, Ticker.id) \
+        .yield_per(batch_size)
+    current = {rollup: None for rollup in rollups}
+    done = {rollup: [] for rollup in rollups}
+    written = {rollup.__tablename__: 0 for rollup in rollups}
+
+    def flush(rollup, size=1):
+        if len(done[rollup]) >= size:
+            sess.execute(rollup.__table__.insert(), done[rollup])
+            written[rollup.__tablename__] += len(done[rollup])
+            done[rollup] = []
+
+    for row in ticks:
+        tick = row._asdict()
+        for rollup in rollups:
+            bucket = rollup.bucket_of(row.timestamp)
+            if compacted is not None and bucket < first[rollup]:
+                continue  # shares a final bucket with compacted ticks
+            folded = current[rollup]
+            if folded is None or (folded['exchange'], folded['coin'],
+                                  folded['bucket']) != \
+                    (row.exchange, row.coin, bucket):
+                if folded is not None:
+                    done[rollup].append(folded)
+                    flush(rollup, batch_size)
+                folded = current[rollup] = new_rollup(
+                    row.exchange, row.coin, bucket)
+            fold_tick(folded, tick)
+    for rollup in rollups:
+        if current[rollup] is not None:
+            done[rollup].append(current[rollup])
+        flush(rollup)
+    sess.commit()
+    sess.close()
+    return written
+
+
+def rollups_cover(sess, before, rollups=(HourRollup, DayRollup)):
+    """Whether the rollups have counted every tick with an ask before
+    `before`, which should be the start of a day
+    """
+    compacted = Compaction.through_time(sess)
+    raw = sess.query(Ticker.exchange, Ticker.coin, func.count(Ticker.ask)) \
+        .filter(Ticker.timestamp < before)
+    if compacted is not None:
+        raw = raw.filter(Ticker.timestamp >= compacted)
+    raw = dict(((e, c), n) for e, c, n in
+               raw.group_by(Ticker.exchange, Ticker.coin))
+    for rollup in rollups:
+        query = sess.query(rollup.exchange, rollup.coin, func.sum(rollup.count)) \
+            .filter(rollup.bucket < before)
+        if compacted is not None:
+            # raw ticks before this are gone
+            query = query.filter(rollup.bucket >= compacted)
+        counted = dict(((e, c), n) for e, c, n in
+                       query.group_by(rollup.exchange, rollup.coin))
+        if counted != raw:
+            return False
+    return True
+
+
+def compact_history(sess, through, batch_size=5000, archive=None, pause=0):
+    """Delete `history` rows from before `through`, oldest first, in batches
+    of `batch_size`. Each batch is committed on its own, sleeping `pause`
+    seconds after it, so other writers aren't held up for long. With an
+    `archive` session the rows are copied into its database first.
+    The rollups should already cover them, see `rollups_cover`.
+    """
+    run = Compaction(through=through, ran=datetime.utcnow(), deleted=0,
+                     archived=0)
+    sess.add(run)
+    sess.commit()
+
+    columns = [c for c in Ticker.__table__.columns if c.name != 'id']
+    while True:
+        oldest = sess.query(Ticker.id) \
+            .filter(Ticker.timestamp < through) \
+            .order_by(Ticker.timestamp, Ticker.id) \
+            .limit(batch_size)
+        if archive is not None:
+            rows = sess.query(*columns).filter(Ticker.id.in_(oldest))
+            run.archived += insert_tickers(
+                archive, (row._asdict() for row in rows), dedupe=True)
+            archive.commit()
+        deleted = sess.query(Ticker) \
+            .filter(Ticker.id.in_(oldest)) \
+            .delete(synchronize_session=False)
+        run.deleted += deleted
+        sess.commit()
+        if deleted < batch_size:
+            return run
+        if pause:
+            time.sleep(pause)
+
+
+def incremental_vacuum(engine, pages=None):
+    """Hand free pages back to the filesystem, up to `pages` of them. SQLite
+    only: the first run switches the database to incremental auto_vacuum,
+    which takes one full VACUUM. Returns whether anything was done.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+    vacuum = "PRAGMA incremental_vacuum" if not pages else \
+        "PRAGMA incremental_vacuum({})".format(int(pages))
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            cursor.executescript("PRAGMA auto_vacuum = INCREMENTAL; VACUUM;")
+        # execute would stop after the first page, executescript runs it all
+        cursor.executescript(vacuum + ";")
+    finally:
+        conn.close()
+    return True
+
+
+def add_columns(table, names):
+    def add(engine):
+        for column in [table.c[name] for name in names]:
+            try:
+                engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name,
+                    column.type.compile(engine.dialect)))
+            except OperationalError:
+                pass  # already there, e.g. made by create_all on a new db
+    return add
+
+
+# Schema changes to existing databases that create_all won't make, applied
+# once each and in order. Only ever append to this list.
+MIGRATIONS = [
+    ('ticker_ts_idx', create_index(ticker_timestamp_idx)),
+    ('ticker_coin_ts_idx', create_index(ticker_coin_timestamp_idx)),
+    ('coins_registry', backfill_coins),
+    ('rollups_15m', partial(backfill_rollups, rollups=[Rollup])),
+    ('rollups_ohlcv', add_columns(Rollup.__table__, [
+        'open', 'high', 'low', 'close', 'volume'])),
+    ('rollups_1h_1d', backfill_rollups),
+]
+
+
+def migrate(engine):
+    sess = new_session(engine)
+    applied = set(m[0] for m in sess.query(Migration.name))
+    for name, step in MIGRATIONS:
+        if name in applied:
+            continue
+        step(engine)
+        sess.add(Migration(name=name, applied=datetime.utcnow()))
+        sess.commit()
+    sess.close()
+
+
+def explain(sess, query):
+    """The database's plan for running a query, as a list of rows"""
+    dialect = sess.bind.dialect
+    prefix = "EXPLAIN QUERY PLAN " if dialect.name == 'sqlite' else "EXPLAIN "
+    compiled = query.statement.compile(dialect=dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = [params[k] for k in compiled.positiontup]
+    cursor = sess.connection().connection.cursor()
+    try:
+        cursor.execute(prefix + str(compiled), params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
 # TODO: create a transactions table
 
 def create_db(db_string):
     engine = create_engine(db_string)
     Base.metadata.create_all(engine)
     Base.metadata.bind = engine
-    try:
-        ticker_timestamp_idx.create(bind=engine)
-    except OperationalError:
-        pass
+    migrate(engine)
     return engine
 
 
@@ -1,17 +1,18 @@
 import datetime
 import logging
 from account import Account
-from db import Balance, Ticker
+from db import Balance, PriceSnapshot, Ticker
 
 log = logging.getLogger('default')
 BTC_DIFF_THRESH = 0.001  # one thousandth, about $10
 
 
 def close_alt_positions(sess, account, period):
+    prices = PriceSnapshot.at(sess, period)
     for coin in account.coins:
         if coin == 'BTC':
             continue
-        price = Ticker.current_ask(sess, coin, period)
+        price = prices.ask(coin)
         assert price is not None, f"no price for {coin} at {period}"
         proceeds = account.trade(coin, -account.balance(coin), price, period)
         assert proceeds >= 0, f"got {proceeds} when selling {coin}"
@@ -49,11 +50,12 @@ class DurableAccount(Account):
     def value_btc(self, sess, now=None):
         btc = self.balance('BTC')
         self.values_in_btc['BTC'] = btc
+        prices = PriceSnapshot.at(sess, now)
         for coin in self.coins:
             if coin == 'BTC':
                 continue  # BTC is priced in USD, everything else in BTC
             units = self.balance(coin)
-            unit_price = Ticker.current_ask(sess, coin, now)
+            unit_price = prices.ask(coin)
             if not unit_price:
                 continue
             value = units * unit_price
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+import random
+
+from .db import create_db, insert_tickers, new_session
+
+START = datetime(2018, 1, 1)
+
+
+def tick(coin, t, price):
+    """A tick dict as `insert_tickers` takes them"""
+    return {'exchange': 'bittrex', 'coin': coin, 'timestamp': t,
+            'bid': price, 'ask': price, 'last': price, 'volume': 1.0}
+
+
+def random_ticks(rand, coin, days):
+    """A random walk of ticks from START, a few minutes apart"""
+    t, price = START, 1.0
+    while t < START + timedelta(days=days):
+        price *= 1 + rand.gauss(0, 0.02)
+        yield tick(coin, t, price)
+        t += timedelta(minutes=rand.randint(1, 40))
+
+
+def make_db(path, coins, days, ticks_per_hour, seed=1):
+    """A database file of evenly spaced random walks for `coins` coins, for
+    tests that hand a db_loc to the backtester
+    """
+    db_loc = 'sqlite:///' + path
+    sess = new_session(create_db(db_loc))
+    rand = random.Random(seed)
+    spacing = timedelta(hours=1) / ticks_per_hour
+    for i in range(coins):
+        t, price = START, rand.uniform(0.0001, 0.1)
+        ticks = []
+        while t < START + timedelta(days=days):
+            price *= 1 + rand.gauss(0, 0.01)
+            ticks.append(tick('C{:03}'.format(i), t, price))
+            t += spacing
+        insert_tickers(sess, ticks)
+    sess.commit()
+    return db_loc, sess
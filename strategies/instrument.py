@@ -0,0 +1,159 @@
+import cProfile
+from contextlib import contextmanager
+from functools import wraps
+import importlib
+import os
+from timeit import default_timer as timer
+
+from sqlalchemy import event
+
+# (module, class, method, stage) timed by `install`
+HOT_PATHS = [
+    ('db', 'Ticker', 'peak', 'db'),
+    ('db', 'Ticker', 'current_ask', 'db'),
+    ('db', 'Ticker', 'coins', 'db'),
+    ('moving_avg', 'MovingAverage', 'fetch_data', 'db'),
+    ('moving_avg', 'MovingAverage', 'precompute', 'strategy'),
+    ('moving_avg', 'MovingAverage', 'calculate_strengths', 'strategy'),
+    ('bot', 'Bot', 'tick', 'strategy'),
+    ('bot', 'Bot', 'check_sells', 'strategy'),
+    ('bot', 'Bot', 'check_buys', 'strategy'),
+    ('stop_loss', 'PeakTracker', 'peak', 'strategy'),
+    ('stop_loss', 'PeakTracker', 'save', 'db'),
+    ('durable_account', 'DurableAccount', 'save', 'db'),
+    ('durable_account', 'DurableAccount', 'place_order', 'exchange'),
+    ('apis', 'CcxtExchange', 'fetch_tickers', 'exchange'),
+    ('apis', 'CcxtExchange', 'fetch_json', 'exchange'),
+    ('apis', 'CcxtExchange', 'fetch_transactions', 'exchange'),
+    ('apis', 'CcxtExchange', 'balance', 'exchange'),
+    ('slacker_log_handler', 'SlackerLogHandler', 'emit', 'slack'),
+]
+
+
+class Instruments(object):
+    """Calls, time and database queries for each stage of the bot. Stages
+    nest, a query counts towards every stage it ran inside of.
+    Does nothing until `enabled` is set.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}  # name -> [calls, seconds, queries]
+        self.active = []
+        self.queries = 0
+
+    def reset(self):
+        self.stages = {}
+        self.queries = 0
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        stats = self.stages.setdefault(name, [0, 0.0, 0])
+        self.active.append(stats)
+        start = timer()
+        try:
+            yield
+        finally:
+            stats[0] += 1
+            # only count the outermost call when a stage recurses
+            if not any(s is stats for s in self.active[:-1]):
+                stats[1] += timer() - start
+            self.active.pop()
+
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            wrapper.instrumented = True
+            return wrapper
+        return decorator
+
+    def wrap(self, owner, attr, name):
+        """Replace a method (or staticmethod) of `owner` with a timed one"""
+        func = owner.__dict__[attr]
+        static = isinstance(func, staticmethod)
+        if static:
+            func = func.__func__
+        if getattr(func, 'instrumented', False):
+            return
+        wrapped = self.timed(name)(func)
+        setattr(owner, attr, staticmethod(wrapped) if static else wrapped)
+
+    def count_query(self, *args):
+        if not self.enabled:
+            return
+        self.queries += 1
+        for stats in {id(s): s for s in self.active}.values():
+            stats[2] += 1
+
+    def watch(self, engine):
+        """Count the queries run through `engine`"""
+        if not event.contains(engine, 'before_cursor_execute',
+                              self.count_query):
+            event.listen(engine, 'before_cursor_execute', self.count_query)
+
+    def snapshot(self):
+        return {'queries': self.queries,
+                'stages': {k: list(v) for k, v in self.stages.items()}}
+
+    def merge(self, snapshot):
+        """Add in the numbers from another process' `snapshot`"""
+        self.queries += snapshot['queries']
+        for name, (calls, seconds, queries) in snapshot['stages'].items():
+            stats = self.stages.setdefault(name, [0, 0.0, 0])
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] += queries
+
+    def table(self):
+        lines = ["{:44} {:>8} {:>9} {:>9} {:>8} {:>8}".format(
+            'stage', 'calls', 'total s', 'mean ms', 'queries', 'per call')]
+        for name, (calls, seconds, queries) in sorted(
+                self.stages.items(), key=lambda s: s[1][1], reverse=True):
+            lines.append("{:44} {:>8} {:>9.2f} {:>9.3f} {:>8} {:>8.1f}".format(
+                name, calls, seconds, 1000 * seconds / calls, queries,
+                queries / calls))
+        lines.append("{} queries in total".format(self.queries))
+        return "\n".join(lines)
+
+
+instruments = Instruments()
+
+
+def install(engine=None):
+    """Time the `HOT_PATHS` and count queries through `engine`"""
+    for module, cls, attr, category in HOT_PATHS:
+        owner = getattr(importlib.import_module(module), cls)
+        instruments.wrap(owner, attr, "{}: {}.{}".format(category, cls, attr))
+    if engine is not None:
+        instruments.watch(engine)
+    instruments.enabled = True
+
+
+def profile_path(directory, name):
+    """One stats file per process, as workers can't share one"""
+    return os.path.join(directory, "{}-{}.prof".format(name, os.getpid()))
+
+
+@contextmanager
+def profiled(path, profiler=None):
+    """Run the block under cProfile, writing pstats to `path`. Pass the
+    same `profiler` each time to accumulate over several blocks.
+    """
+    if path is None:
+        yield
+        return
+    profiler = profiler or cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -1,7 +1,14 @@
 import logging
 from datetime import timedelta
 
-from db import Ticker
+import numpy as np
+
+from bucket_store import Buckets, BucketStore
+from db import PRICE_STORE, Rollup, Ticker, roundTime, stream
+from rolling import RollingAverages
+from signals import Signal
+from stop_loss import LATE_TICKS
+from util import from_epoch, to_epoch
 
 log = logging.getLogger('default')
 
@@ -13,23 +20,61 @@ def all_above(list, threshold):
     return True
 
 
-# https://stackoverflow.com/questions/3463930/how-to-round-the-minute-of-a-datetime-object-python
-def roundTime(dt, dateDelta=timedelta(minutes=15)):
-    roundTo = dateDelta.total_seconds()
-    seconds = (dt - dt.min).seconds
-    # // is a floor division, not a comment on following line:
-    rounding = (seconds + roundTo / 2) // roundTo * roundTo
-    return dt + timedelta(0, rounding - seconds, -dt.microsecond)
-
-
-def bucket_15m(tickers):
-    bucketed = {}
-    for t in tickers:
-        bucket = roundTime(t.timestamp)
-        contents = bucketed.get(bucket, [])
-        contents.append(t.ask)
-        bucketed[bucket] = contents
-    return bucketed
+BUCKET_US = 15 * 60 * 10 ** 6
+# ticks bucketed at a time from arrays
+CHUNK = 10000
+
+
+def bucket_15m(ticks, buckets=None):
+    """Add (timestamp, ask) ticks, oldest first, to `buckets`. Takes any
+    iterable, so ticks can be streamed through without holding them all
+    """
+    buckets = buckets if buckets is not None else Buckets()
+    for timestamp, ask in ticks:
+        buckets.add(roundTime(timestamp), ask)
+    return buckets
+
+
+def bucket_epochs(timestamps):
+    """`roundTime` for an array of epoch microseconds"""
+    seconds = timestamps // 10 ** 6
+    of_day = seconds % (24 * 60 * 60)
+    return (seconds - of_day + (of_day + 450) // 900 * 900) * 10 ** 6
+
+
+def bucket_15m_arrays(timestamps, asks):
+    # missing asks are NaN here, leave them out like `ticks_query` does
+    has_ask = ~np.isnan(asks)
+    if not has_ask.all():
+        timestamps, asks = timestamps[has_ask], asks[has_ask]
+    buckets = Buckets()
+    for i in range(0, len(timestamps), CHUNK):
+        epochs = bucket_epochs(timestamps[i:i + CHUNK]).tolist()
+        for bucket, ask in zip(epochs, asks[i:i + CHUNK].tolist()):
+            buckets.add_epoch(bucket, ask)
+    return buckets
+
+
+def fetch_buckets(sess, coin, start, end):
+    """Buckets of the ticks strictly between start and end. The ones that
+    lie entirely inside come from the 15 minute rollups, only the partial
+    buckets at either end are made from raw ticks.
+    """
+    half = BUCKET_US // 2
+    first = ((to_epoch(start) + half) // BUCKET_US + 1) * BUCKET_US
+    last = (to_epoch(end) - half) // BUCKET_US * BUCKET_US
+    if first > last:
+        return bucket_15m(stream(sess, Ticker.ticks_query(sess, coin, start,
+                                                          end)))
+
+    buckets = bucket_15m(stream(sess, Ticker.ticks_query(
+        sess, coin, start, from_epoch(first - half))))
+    for row in stream(sess, Rollup.range_query(sess, coin, from_epoch(first),
+                                               from_epoch(last))):
+        buckets.append(*row)
+    return bucket_15m(stream(sess, Ticker.ticks_query(
+        sess, coin, from_epoch(last + half), end, include_start=True)),
+        buckets)
 
 
 class MovingAverage(object):
@@ -40,8 +85,19 @@ class MovingAverage(object):
     def __init__(self, sess):
         self.sess = sess
         self.prices = {}
+        self.averages = {}
+        self.signals = {}
+        self.buckets = None  # `BucketStore` for `refresh`
+
+    def calculate_strengths(self, now, ticker, allow_missing=False,
+                            prices=None):
+        signal = self.signals.get(ticker)
+        i = signal.index(now) if signal is not None else None
+        if i is not None and not allow_missing:
+            if not signal.valid[i]:
+                return None
+            return float(signal.prices[i]), signal.strengths[i].tolist()
 
-    def calculate_strengths(self, now, ticker, allow_missing=False):
         if self.prices.get(ticker) is None:
             self.fetch_data(ticker, now)
 
@@ -50,27 +106,37 @@ class MovingAverage(object):
             return None
         log.debug("Averages by hour: {}".format(hour_avgs))
 
-        current_price = Ticker.current_ask(self.sess, ticker, now)
+        if prices is not None:
+            current_price = prices.ask(ticker)
+        else:
+            current_price = Ticker.current_ask(self.sess, ticker, now)
 
-        if current_price is None or hour_avgs.get(1) is None:
+        if current_price is None or hour_avgs.get(self.HOURS[0]) is None:
             log.debug("No price for {} @ {}".format(ticker, now))
             return None
 
         return current_price, [hour_avgs[hour] / current_price
                                for hour in self.HOURS[1:]]
 
-    def run_strategy(self, now, ticker):
+    def run_strategy(self, now, ticker, prices=None):
         log.debug("Running moving averages strategy for '{}' at '{}'"
                   .format(ticker, now))
-        percent_strength = self.calculate_strengths(now, ticker)
+        percent_strength = self.calculate_strengths(now, ticker,
+                                                    prices=prices)
         if percent_strength is None:
             return None
         current_price, percent_strength = percent_strength
 
-        # past 24 hours
-        weak_buy = all_above(percent_strength[:3], self.WEAK)
-        # past 7 days
-        strong_buy = weak_buy and all_above(percent_strength, self.STRONG)
+        signal = self.signals.get(ticker)
+        i = signal.index(now) if signal is not None else None
+        if i is not None:
+            weak_buy = signal.weak[i]
+            strong_buy = signal.strong[i]
+        else:
+            # past 24 hours
+            weak_buy = all_above(percent_strength[:3], self.WEAK)
+            # past 7 days
+            strong_buy = weak_buy and all_above(percent_strength, self.STRONG)
 
         buy_str = "buy of '{}' ask {} @ {}".format(ticker, current_price, now)
         if strong_buy:
@@ -88,33 +154,12 @@ class MovingAverage(object):
         return None
 
     def avg_by_hour(self, now, ticker, allow_missing=False):
-        # datetime cutoffs for each hour bucket e.g. 24hrs ago
-        deltas = {h: now - timedelta(hours=h) for h in self.HOURS}
-        # the most data we need to make a decision for this 'now'
-        time_cutoff = now - timedelta(hours=max(self.HOURS))
-        prices = self.prices.get(ticker, {})
-
-        min_timestamp = now
-        strengths_by_hours = {}
-
-        for b, bucket_prices in prices.items():
-            if b > now or b < time_cutoff:
-                continue
-            min_timestamp = min(min_timestamp, b)
-            for k, hour in deltas.items():
-                if b < hour:
-                    continue
-                current = strengths_by_hours.get(k, [])
-                added = current + bucket_prices
-                strengths_by_hours[k] = added
-
-        # don't make a decision if we are missing more than 24hr of data
-        needed_timestamp = time_cutoff + timedelta(hours=24)
-        if min_timestamp > needed_timestamp and not allow_missing:
-            return None
-
-        return {k: sum(p) / len(p)
-                for k, p in strengths_by_hours.items()}
+        averages = self.averages.get(ticker)
+        if averages is None:
+            averages = RollingAverages(self.prices.get(ticker, Buckets()),
+                                       self.HOURS)
+            self.averages[ticker] = averages
+        return averages.averages(now, allow_missing)
 
     def fetch_data(self, ticker, now, beginning=None):
         if beginning is not None:
@@ -122,10 +167,80 @@ class MovingAverage(object):
         else:
             time_cutoff = now - timedelta(hours=max(self.HOURS))
 
-        alt_raw = self.sess.query(Ticker) \
-            .filter(Ticker.coin == ticker) \
-            .filter(Ticker.timestamp < now) \
-            .filter(Ticker.timestamp > time_cutoff) \
-            .all()
-
-        self.prices[ticker] = bucket_15m(alt_raw)
+        store = self.sess.info.get(PRICE_STORE)
+        if store is not None and store.covers(ticker, now, time_cutoff):
+            prices = store.prices[ticker]
+            lo = np.searchsorted(prices.timestamps, to_epoch(time_cutoff),
+                                 side='right')
+            hi = np.searchsorted(prices.timestamps, to_epoch(now), side='left')
+            self.prices[ticker] = bucket_15m_arrays(prices.timestamps[lo:hi],
+                                                    prices.ask[lo:hi])
+            self.averages.pop(ticker, None)
+            self.signals.pop(ticker, None)
+            return
+
+        self.prices[ticker] = fetch_buckets(self.sess, ticker, time_cutoff,
+                                            now)
+        self.averages.pop(ticker, None)
+        self.signals.pop(ticker, None)
+
+    def refresh(self, ticker, now):
+        """Bring a coin's buckets up to `now`, the same as
+        `fetch_data(ticker, now)` would, but only loading the ticks since the
+        last refresh and dropping the ones that are now too old
+        """
+        window = timedelta(hours=max(self.HOURS))
+        if self.buckets is None or self.buckets.window != window:
+            self.buckets = BucketStore(window)
+        store = self.buckets
+
+        watermark = store.watermarks.get(ticker)
+        held = {}
+        if watermark is None or now < watermark:
+            store.reset(ticker)
+            query = Ticker.ticks_query(self.sess, ticker, now - window, now)
+        else:
+            # go back far enough for ticks that were stored late, skipping
+            # the ones already in the store
+            start = watermark - LATE_TICKS
+            held = store.held(ticker, start)
+            query = Ticker.ticks_query(self.sess, ticker, start, now,
+                                       include_start=True)
+        for timestamp, ask in stream(self.sess, query):
+            if held.get(timestamp):
+                held[timestamp] -= 1
+                continue
+            store.add(ticker, timestamp, roundTime(timestamp), ask)
+        store.evict(ticker, now)
+        store.watermarks[ticker] = now
+
+        self.prices[ticker] = store.buckets[ticker]
+        self.averages.pop(ticker, None)
+        self.signals.pop(ticker, None)
+
+    def load_buckets(self, path):
+        """Pick up the buckets `save_buckets` left, e.g. by an earlier run"""
+        window = timedelta(hours=max(self.HOURS))
+        self.buckets = BucketStore.load(path, window)
+
+    def save_buckets(self, path):
+        if self.buckets is not None:
+            self.buckets.save(path)
+
+    def precompute(self, ticker, start, stop, step):
+        """Evaluate the strategy for every step between start and stop up
+        front, so `run_strategy` only has to look the answer up. Needs raw
+        prices for the whole interval from a `PriceStore` on the session.
+        """
+        store = self.sess.info.get(PRICE_STORE)
+        if store is None or not store.covers(ticker, stop, start):
+            return None
+        if self.prices.get(ticker) is None:
+            self.fetch_data(ticker, stop, start)
+
+        coin = store.prices[ticker]
+        signal = Signal.compute(self.prices[ticker], coin.timestamps, coin.ask,
+                                start, stop, step,
+                                self.HOURS, self.WEAK, self.STRONG)
+        self.signals[ticker] = signal
+        return signal
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from db import Ticker, PRICE_STORE, stream
+from util import from_epoch, to_epoch
+
+log = logging.getLogger('default')
+
+COLUMNS = ['bid', 'ask', 'last', 'volume']
+MANIFEST = 'manifest.json'
+
+
+def range_max_table(values):
+    """Sparse table for O(1) max queries over any index range.
+    Row k holds the max of each run of 2**k values, NaNs are ignored and
+    the tail of each row is padded with -inf.
+    """
+    level = np.where(np.isnan(values), -np.inf, values)
+    levels = max(1, len(level).bit_length())
+    table = np.full((levels, len(level)), -np.inf)
+    table[0] = level
+    width = 1
+    for k in range(1, levels):
+        level = np.maximum(level[:-width], level[width:])
+        table[k, :len(level)] = level
+        width *= 2
+    return table
+
+
+def range_max(table, lo, hi):
+    """Max over the inclusive index range [lo, hi]"""
+    k = int(hi - lo + 1).bit_length() - 1
+    found = max(table[k][lo], table[k][hi - (1 << k) + 1])
+    return None if found == -np.inf else float(found)
+
+
+class CoinPrices(object):
+    def __init__(self, timestamps, bid, ask, last, volume, peaks=None):
+        self.timestamps = timestamps
+        self.bid = bid
+        self.ask = ask
+        self.last = last
+        self.volume = volume
+        self.peaks = range_max_table(last) if peaks is None else peaks
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def index_at(self, now):
+        """Index of the latest row at or before 'now', -1 when there isn't one"""
+        if now is None:
+            return len(self.timestamps) - 1
+        return int(np.searchsorted(self.timestamps, to_epoch(now),
+                                   side='right')) - 1
+
+    def current_ask(self, now=None):
+        i = self.index_at(now)
+        if i < 0 or np.isnan(self.ask[i]):
+            return None
+        return float(self.ask[i])
+
+    def peak(self, start_time=None, now=None):
+        lo = 0
+        if start_time:
+            lo = self.index_at(start_time) + 1
+        hi = self.index_at(now)
+        if hi < lo:
+            return None
+        return range_max(self.peaks, lo, hi)
+
+    def columns(self, peaks=True):
+        columns = {c: getattr(self, c) for c in COLUMNS}
+        columns['timestamp'] = self.timestamps
+        if peaks:
+            columns['peaks'] = self.peaks
+        return columns
+
+    def save(self, path, peaks=True):
+        os.makedirs(path, exist_ok=True)
+        for name, values in self.columns(peaks).items():
+            np.save(os.path.join(path, name + '.npy'), values)
+
+    @staticmethod
+    def open(path):
+        def column(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        # the peak table is derived, archives can leave it out
+        has_peaks = os.path.exists(os.path.join(path, 'peaks.npy'))
+        return CoinPrices(column('timestamp'),
+                          *[column(c) for c in COLUMNS],
+                          peaks=column('peaks') if has_peaks else None)
+
+
+class PriceStore(object):
+    """Per-coin price history held in NumPy arrays, so backtests can answer
+    the `Ticker` helper queries without going back to the database.
+
+    Holds every row between `start` and `end` plus the last row before
+    `start`, so "as of" lookups anywhere inside the range are exact.
+
+    On disk a store is a directory with a manifest and one subdirectory per
+    coin holding an int64 epoch-microsecond `timestamp.npy` and a float64
+    .npy file for each price column.
+    """
+
+    def __init__(self, prices, start=None, end=None, exchange=None):
+        self.prices = prices
+        self.start = start
+        self.end = end
+        self.exchange = exchange
+
+    @property
+    def coins(self):
+        return list(self.prices.keys())
+
+    def bounds(self):
+        """Timestamps of the oldest and newest rows in the store"""
+        timestamps = [p.timestamps for p in self.prices.values() if len(p)]
+        if not timestamps:
+            return None, None
+        return (from_epoch(min(t[0] for t in timestamps)),
+                from_epoch(max(t[-1] for t in timestamps)))
+
+    def covers(self, coin, now, start_time=None):
+        if coin not in self.prices:
+            return False
+        if now is None:
+            if self.end is not None:
+                return False
+        elif self.end is not None and now > self.end:
+            return False
+        if self.start is None:
+            return True
+        earliest = now if start_time is None else start_time
+        return earliest is not None and earliest >= self.start
+
+    def current_ask(self, coin, now=None):
+        return self.prices[coin].current_ask(now)
+
+    def peak(self, coin, start_time=None, now=None):
+        return self.prices[coin].peak(start_time, now)
+
+    def save(self, path, peaks=True):
+        """Write the store out as one .npy file per column, per coin"""
+        for coin, prices in self.prices.items():
+            prices.save(os.path.join(path, coin), peaks)
+        self.save_manifest(path, {c: len(p) for c, p in self.prices.items()})
+
+    def save_manifest(self, path, rows):
+        manifest = {
+            'start': None if self.start is None else to_epoch(self.start),
+            'end': None if self.end is None else to_epoch(self.end),
+            'exchange': self.exchange,
+            'coins': rows,
+        }
+        with open(os.path.join(path, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+    @staticmethod
+    def open(path):
+        """Memory-map a store written by `save`. Nothing is read until it's
+        used, and processes opening the same files share the page cache.
+        """
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        prices = {coin: CoinPrices.open(os.path.join(path, coin))
+                  for coin in manifest['coins']}
+        start, end = [from_epoch(manifest[k]) if manifest[k] is not None else None
+                      for k in ('start', 'end')]
+        return PriceStore(prices, start, end, manifest.get('exchange'))
+
+    def attach(self, sess):
+        """Route the `Ticker` helpers for this session through the store"""
+        sess.info[PRICE_STORE] = self
+        return self
+
+    @staticmethod
+    def detach(sess):
+        sess.info.pop(PRICE_STORE, None)
+
+    @staticmethod
+    def export(sess, path, exchange, coins):
+        """Archive the full history of each coin, one coin at a time"""
+        store = PriceStore({}, exchange=exchange)
+        rows = {}
+        for coin in coins:
+            prices = PriceStore.load(sess, [coin], exchange=exchange) \
+                .prices[coin]
+            prices.save(os.path.join(path, coin), peaks=False)
+            rows[coin] = len(prices)
+            log.debug("Archived {} rows of {}".format(len(prices), coin))
+        store.save_manifest(path, rows)
+        return rows
+
+    @staticmethod
+    def load(sess, coins, start=None, end=None, exchange=None,
+             batch_size=10000):
+        """Rows are streamed from the database and packed into arrays
+        `batch_size` at a time, so they're never all held as Python objects
+        """
+        log.debug("Loading prices for {} coins: {} -> {}"
+                  .format(len(coins), start, end))
+        columns = [getattr(Ticker, c) for c in COLUMNS]
+        query = sess.query(Ticker.coin, Ticker.timestamp, *columns) \
+            .filter(Ticker.coin.in_(coins))
+        if exchange is not None:
+            query = query.filter(Ticker.exchange == exchange)
+        if start is not None:
+            query = query.filter(Ticker.timestamp >= start)
+        if end is not None:
+            query = query.filter(Ticker.timestamp <= end)
+        query = query.order_by(Ticker.coin, Ticker.timestamp, Ticker.id)
+
+        rows = {coin: [] for coin in coins}
+        chunks = {coin: [] for coin in coins}
+        if start is not None:
+            for coin in coins:
+                before = sess.query(Ticker.coin, Ticker.timestamp, *columns) \
+                    .filter(Ticker.coin == coin) \
+                    .filter(Ticker.timestamp < start)
+                if exchange is not None:
+                    before = before.filter(Ticker.exchange == exchange)
+                before = before.order_by(Ticker.timestamp.desc()).first()
+                if before is not None:
+                    rows[coin].append(before)
+        for row in stream(sess, query, batch_size):
+            pending = rows[row[0]]
+            pending.append(row)
+            if len(pending) >= batch_size:
+                chunks[row[0]].append(to_arrays(pending))
+                pending.clear()
+        for coin, pending in rows.items():
+            chunks[coin].append(to_arrays(pending))
+
+        return PriceStore({coin: from_chunks(c) for coin, c in chunks.items()},
+                          start, end, exchange)
+
+    def rows(self, coin, since=None, batch_size=10000):
+        """Yield batches of `history` rows for a coin, newer than `since`"""
+        prices = self.prices[coin]
+        lo = 0
+        if since is not None:
+            lo = int(np.searchsorted(prices.timestamps, to_epoch(since),
+                                     side='right'))
+        for i in range(lo, len(prices), batch_size):
+            columns = {c: getattr(prices, c)[i:i + batch_size].tolist()
+                       for c in COLUMNS}
+            timestamps = prices.timestamps[i:i + batch_size].tolist()
+            yield [dict({c: nan_to_none(columns[c][j]) for c in COLUMNS},
+                        exchange=self.exchange, coin=coin,
+                        timestamp=from_epoch(ts))
+                   for j, ts in enumerate(timestamps)]
+
+
+def nan_to_none(value):
+    return None if value != value else value
+
+
+def to_arrays(rows):
+    """(epoch timestamps, values by column) for (coin, timestamp, ...) rows"""
+    timestamps = np.array([to_epoch(r[1]) for r in rows], dtype=np.int64)
+    values = np.array([r[2:] for r in rows], dtype=np.float64) \
+        .reshape(len(rows), len(COLUMNS))
+    return timestamps, values
+
+
+def from_chunks(chunks):
+    """CoinPrices from a list of `to_arrays` results, in order"""
+    timestamps = np.concatenate([c[0] for c in chunks])
+    return CoinPrices(timestamps, *[np.concatenate([c[1][:, i] for c in chunks])
+                                    for i in range(len(COLUMNS))])
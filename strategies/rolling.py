@@ -0,0 +1,92 @@
+from datetime import timedelta
+
+
+def scan_averages(buckets, now, hours, allow_missing=False):
+    """Average bucketed price for each window of `hours` ending at `now`,
+    found by scanning every bucket. Reference for `RollingAverages`.
+    """
+    # datetime cutoffs for each hour bucket e.g. 24hrs ago
+    deltas = {h: now - timedelta(hours=h) for h in hours}
+    # the most data we need to make a decision for this 'now'
+    time_cutoff = now - timedelta(hours=max(hours))
+
+    min_timestamp = now
+    sums = {}
+    counts = {}
+
+    for b, total, count in zip(buckets.times(), buckets.sums, buckets.counts):
+        if b > now or b < time_cutoff:
+            continue
+        min_timestamp = min(min_timestamp, b)
+        for k, hour in deltas.items():
+            if b < hour:
+                continue
+            sums[k] = sums.get(k, 0) + total
+            counts[k] = counts.get(k, 0) + count
+
+    # don't make a decision if we are missing more than 24hr of data
+    needed_timestamp = time_cutoff + timedelta(hours=24)
+    if min_timestamp > needed_timestamp and not allow_missing:
+        return None
+
+    return {k: sums[k] / counts[k] for k in sums}
+
+
+class RollingAverages(object):
+    """Running sum & count of bucketed prices for each window of `hours`.
+    Moving `now` forward only adds buckets that have come into range and drops
+    the ones that fell out, so each call costs O(len(hours)) amortized.
+    Going back in time starts over from the first bucket.
+    """
+
+    def __init__(self, buckets, hours):
+        self.hours = list(hours)
+        self.longest = max(self.hours)
+        self.times = buckets.times()
+        self.sums = list(buckets.sums)
+        self.counts = list(buckets.counts)
+        self.reset()
+
+    def reset(self):
+        self.now = None
+        self.right = 0  # buckets before this index are <= now
+        self.left = {h: 0 for h in self.hours}
+        self.sum = {h: 0.0 for h in self.hours}
+        self.count = {h: 0 for h in self.hours}
+
+    def advance(self, now):
+        if self.now is not None and now < self.now:
+            self.reset()
+        self.now = now
+
+        while self.right < len(self.times) and self.times[self.right] <= now:
+            for h in self.hours:
+                self.sum[h] += self.sums[self.right]
+                self.count[h] += self.counts[self.right]
+            self.right += 1
+
+        for h in self.hours:
+            cutoff = now - timedelta(hours=h)
+            i = self.left[h]
+            while i < self.right and self.times[i] < cutoff:
+                self.sum[h] -= self.sums[i]
+                self.count[h] -= self.counts[i]
+                i += 1
+            self.left[h] = i
+            if self.count[h] == 0:
+                self.sum[h] = 0.0  # don't carry rounding error forward
+
+    def averages(self, now, allow_missing=False):
+        self.advance(now)
+
+        min_timestamp = now
+        if self.count[self.longest] > 0:
+            min_timestamp = min(now, self.times[self.left[self.longest]])
+
+        # don't make a decision if we are missing more than 24hr of data
+        needed_timestamp = now - timedelta(hours=self.longest - 24)
+        if min_timestamp > needed_timestamp and not allow_missing:
+            return None
+
+        return {h: self.sum[h] / self.count[h]
+                for h in self.hours if self.count[h] > 0}
@@ -0,0 +1,98 @@
+from datetime import timedelta
+
+import numpy as np
+
+MICROS_HOUR = 60 * 60 * 10 ** 6
+
+
+def epochs(datetimes):
+    """Microseconds since the unix epoch, as an int64 array"""
+    return np.array(list(datetimes), dtype='datetime64[us]').astype(np.int64)
+
+
+def prices_at(timestamps, prices, periods):
+    """Latest price at or before each period, NaN where there isn't one"""
+    idx = np.searchsorted(timestamps, periods, side='right') - 1
+    found = prices[np.maximum(idx, 0)] if len(prices) else np.nan
+    return np.where(idx >= 0, found, np.nan)
+
+
+class Signal(object):
+    """Moving average strengths and buy flags for every step of a trial.
+    Row i describes `start + i * step`, rows that `MovingAverage` would
+    skip (missing prices or history) are marked invalid.
+    """
+
+    def __init__(self, start, step, prices, strengths, valid, weak, strong):
+        self.start = start
+        self.step = step
+        self.prices = prices
+        self.strengths = strengths
+        self.valid = valid
+        self.weak = weak
+        self.strong = strong
+
+    def __len__(self):
+        return len(self.prices)
+
+    def index(self, period):
+        if period < self.start:
+            return None
+        steps, remainder = divmod(period - self.start, self.step)
+        if remainder or steps >= len(self):
+            return None
+        return steps
+
+    @staticmethod
+    def compute(buckets, timestamps, asks, start, stop, step, hours,
+                weak, strong):
+        """Evaluate the strategy at every step between start and stop.
+
+        buckets: `bucket_store.Buckets` of asks, from `moving_avg.bucket_15m`
+        timestamps, asks: raw ticks for the coin, sorted by epoch micros
+        """
+        steps = int((stop - start) / step) + 1
+        step_us = step // timedelta(microseconds=1)
+        periods = epochs([start])[0] + step_us * np.arange(steps, dtype=np.int64)
+
+        bucket_times = np.array(buckets.epochs, dtype=np.int64)
+        sums = np.concatenate([[0.0], np.cumsum(buckets.sums)])
+        counts = np.concatenate(
+            [[0], np.cumsum(buckets.counts)]).astype(np.int64)
+
+        right = np.searchsorted(bucket_times, periods, side='right')
+        averages = np.empty((steps, len(hours)))
+        for i, h in enumerate(hours):
+            left = np.searchsorted(bucket_times, periods - h * MICROS_HOUR,
+                                   side='left')
+            count = counts[right] - counts[left]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                averages[:, i] = (sums[right] - sums[left]) / count
+            averages[count == 0, i] = np.nan
+
+        # don't make a decision if we are missing more than 24hr of data
+        longest = max(hours)
+        left = np.searchsorted(bucket_times, periods - longest * MICROS_HOUR,
+                               side='left')
+        oldest = np.where(left < right,
+                          bucket_times[np.minimum(left, len(buckets) - 1)]
+                          if len(buckets) else 0,
+                          periods)
+        enough_history = oldest <= periods - (longest - 24) * MICROS_HOUR
+
+        prices = prices_at(timestamps, asks, periods)
+        valid = enough_history & ~np.isnan(prices) & ~np.isnan(averages[:, 0])
+        with np.errstate(invalid='ignore'):
+            strengths = averages[:, 1:] / prices[:, None]
+        return Signal(start, step, prices, strengths, valid, None, None) \
+            .with_thresholds(weak, strong)
+
+    def with_thresholds(self, weak, strong):
+        """The same strengths with buy flags for different thresholds"""
+        with np.errstate(invalid='ignore'):
+            # past 24 hours
+            weak_buy = self.valid & np.all(self.strengths[:, :3] > weak, axis=1)
+            # past 7 days
+            strong_buy = weak_buy & np.all(self.strengths > strong, axis=1)
+        return Signal(self.start, self.step, self.prices, self.strengths,
+                      self.valid, weak_buy, strong_buy)
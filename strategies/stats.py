@@ -0,0 +1,90 @@
+import math
+import statistics
+
+
+class QuantileSketch(object):
+    """Approximate quantiles in bounded memory. Values are kept exactly until
+    `size` of them arrive, then sorted and halved by keeping every other one
+    at twice the weight, one level up (a Munro-Paterson style compactor).
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.levels = [[]]  # values in level k each stand for 2**k values
+        self.compactions = 0
+
+    def add(self, value):
+        self.levels[0].append(value)
+        k = 0
+        while len(self.levels[k]) >= self.size:
+            if k + 1 == len(self.levels):
+                self.levels.append([])
+            # alternate which half survives so the error doesn't drift one way
+            self.levels[k + 1].extend(
+                sorted(self.levels[k])[self.compactions % 2::2])
+            self.levels[k] = []
+            self.compactions += 1
+            k += 1
+
+    def quantile(self, q):
+        if len(self.levels) == 1:
+            values = sorted(self.levels[0])
+            if not values:
+                raise statistics.StatisticsError("no values")
+            if q == 0.5:
+                return statistics.median(values)
+            return values[min(len(values) - 1, int(q * len(values)))]
+
+        weighted = sorted((v, 1 << k) for k, level in enumerate(self.levels)
+                          for v in level)
+        rank = q * sum(w for v, w in weighted)
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen > rank:
+                return value
+        return weighted[-1][0]
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+class Summary(object):
+    """Count, mean, stdev, min, max and median of a stream of values,
+    without keeping them all around
+    """
+
+    def __init__(self, sketch_size=1000):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(sketch_size)
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sketch.add(value)
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+
+    @property
+    def stdev(self):
+        """Sample standard deviation, like `statistics.stdev`"""
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    @property
+    def median(self):
+        return self.sketch.median()
+
+    def __len__(self):
+        return self.count
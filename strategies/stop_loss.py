@@ -1,16 +1,74 @@
 import logging
+from collections import namedtuple
 from datetime import timedelta
 
-from db import Ticker
+from db import Peak, Ticker
 
 log = logging.getLogger('default')
 
 DROP_PERCENT = 4
 MIN_HOLD_TIME = timedelta(hours=24)
+# ticks can be stored a little after their timestamp, so re-check this far
+# back when extending a peak. Re-reading ticks doesn't change a max.
+LATE_TICKS = timedelta(hours=1)
 
+PeakState = namedtuple('PeakState', ['since', 'through', 'peak'])
 
-def run_strategy(sess, now, ticker, account, debug=False):
+
+class PeakTracker(object):
+    """High-water mark of each open position since its lockup ended. Each
+    update only looks at ticks since the previous one, instead of taking
+    the max over the whole time the position has been open.
+    Persisted as `Peak` rows when created with an account name & exchange.
+    """
+
+    def __init__(self, peaks=None, name=None, exchange=None):
+        self.peaks = peaks if peaks is not None else {}
+        self.name = name
+        self.exchange = exchange
+
+    def peak(self, sess, coin, since, now):
+        state = self.peaks.get(coin)
+        if state is None or state.since != since or now < state.through:
+            peak = Ticker.peak(sess, coin, start_time=since, now=now)
+        else:
+            start = max(since, state.through - LATE_TICKS)
+            newer = Ticker.peak(sess, coin, start_time=start, now=now)
+            peak = max([p for p in (state.peak, newer) if p is not None],
+                       default=None)
+        self.peaks[coin] = PeakState(since, now, peak)
+        return peak
+
+    def close(self, coin):
+        self.peaks.pop(coin, None)
+
+    def save(self, sess):
+        if self.name is None:
+            return
+        attrs = {'name': self.name, 'exchange': self.exchange}
+        for row in sess.query(Peak).filter_by(**attrs):
+            if row.coin not in self.peaks:
+                sess.delete(row)
+        for coin, state in self.peaks.items():
+            row = sess.query(Peak).filter_by(coin=coin, **attrs).one_or_none()
+            if row is None:
+                row = Peak(coin=coin, **attrs)
+            row.since, row.through, row.peak = state
+            sess.add(row)
+        sess.commit()
+
+    @staticmethod
+    def from_db(sess, name, exchange):
+        rows = sess.query(Peak).filter_by(name=name, exchange=exchange)
+        peaks = {r.coin: PeakState(r.since, r.through, r.peak) for r in rows}
+        return PeakTracker(peaks, name, exchange)
+
+
+def run_strategy(sess, now, ticker, account, debug=False, peaks=None,
+                 drop_percent=DROP_PERCENT, prices=None):
     if account.balance(ticker) <= 0.00_000_001:
+        if peaks is not None:
+            peaks.close(ticker)
         return None
     open_time = account.opened(ticker)
     first_sell = open_time + MIN_HOLD_TIME
@@ -18,19 +76,26 @@ def run_strategy(sess, now, ticker, account, debug=False):
         log.debug("Min holding time hasn't passed yet for {}".format(ticker))
         return None
 
-    change, current = calc_change_percent(sess, ticker, first_sell, now)
-    if change < -DROP_PERCENT:
+    change, current = calc_change_percent(sess, ticker, first_sell, now,
+                                          peaks=peaks, prices=prices)
+    if change < -drop_percent:
         log.info("Sell of '{}' ask {} @ {} (down {}%)"
                  .format(ticker, current, now, change))
         return -1, current
 
 
-def calc_change_percent(sess, ticker, start_time, now, peak=True):
-    if peak:
+def calc_change_percent(sess, ticker, start_time, now, peak=True, peaks=None,
+                        prices=None):
+    if peak and peaks is not None:
+        start = peaks.peak(sess, ticker, start_time, now)
+    elif peak:
         start = Ticker.peak(sess, ticker, start_time=start_time, now=now)
     else:
         start = Ticker.current_ask(sess, ticker, start_time)
-    current = Ticker.current_ask(sess, ticker, now)
+    if prices is not None:
+        current = prices.ask(ticker)
+    else:
+        current = Ticker.current_ask(sess, ticker, now)
     if current is None or start is None:
         log.debug(f"Could not get current/start for {ticker} at s={start_time} n={now}: c={current}, p={start}")
         return 0, current
@@ -0,0 +1,186 @@
+from datetime import timedelta
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import statistics as s
+
+from backtest import (Backtester, buy_and_hold, run_strategy, trial_random,
+                      trial_session)
+from moving_avg import MovingAverage
+
+log = logging.getLogger('backtest')
+
+# bump to invalidate cached results after changing strategy code
+CACHE_VERSION = 1
+
+
+def combinations(space, search='grid', samples=None, rand=random):
+    """Parameter sets to try: every combination of the values in `space`,
+    or `samples` distinct ones chosen at random from them
+    """
+    names = sorted(space.keys())
+    grid = [dict(zip(names, values))
+            for values in itertools.product(*[space[n] for n in names])]
+    if search == 'grid' or samples is None or samples >= len(grid):
+        return grid
+    if search != 'random':
+        raise ValueError("search must be 'grid' or 'random'")
+    return rand.sample(grid, samples)
+
+
+def cache_key(params, interval, step, balances):
+    start, end = interval
+    key = json.dumps({
+        'version': CACHE_VERSION,
+        'params': params,
+        'interval': [start.isoformat(), end.isoformat()],
+        'step': step.total_seconds(),
+        'balances': balances,
+    }, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """One JSON file per (parameters, interval) result"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.file(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, result):
+        tmp = self.file(key) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp, self.file(key))
+
+
+def shared_signals(sess, coins, interval, step, hours_options):
+    """Price buckets and strength matrices for every HOURS setting in the
+    sweep, computed once per interval and shared by all parameter sets
+    """
+    start, stop = interval
+    base = MovingAverage(sess)
+    for coin in coins:
+        base.fetch_data(coin, stop, start)
+    signals = {}
+    for hours in hours_options:
+        moving_avg = MovingAverage(sess)
+        moving_avg.HOURS = list(hours)
+        moving_avg.prices = base.prices
+        for coin in coins:
+            moving_avg.precompute(coin, start, stop, step)
+        signals[tuple(hours)] = moving_avg.signals
+    return base.prices, signals
+
+
+def evaluate_combinations(tup):
+    interval, combos, coins, db_loc, step, balances = tup
+    start, stop = interval
+    sess = trial_session(db_loc, coins, start, stop)
+
+    hours_options = set(tuple(p.get('hours', MovingAverage.HOURS))
+                        for p in combos)
+    prices, signals = shared_signals(sess, coins, interval, step,
+                                     hours_options)
+    bah = buy_and_hold(interval, coins, db_loc, step, balances)
+
+    results = []
+    for params in combos:
+        moving_avg = MovingAverage(sess)
+        moving_avg.prices = prices
+        hours = tuple(params.get('hours', MovingAverage.HOURS))
+        weak = params.get('weak', MovingAverage.WEAK)
+        strong = params.get('strong', MovingAverage.STRONG)
+        moving_avg.signals = {c: signal.with_thresholds(weak, strong)
+                              for c, signal in signals[hours].items()}
+        strat = run_strategy(interval, coins, db_loc, step, balances,
+                             params=params, moving_avg=moving_avg)
+        results.append((params, {
+            'return': strat.percent_return,
+            'buy_and_hold': bah.percent_return,
+            'txns': strat.num_txns,
+            'gains': strat.gain_txns,
+            'losses': strat.loss_txns,
+        }))
+    return interval, results
+
+
+class Sweeper(Backtester):
+    """Backtest every parameter set over the same random intervals"""
+
+    def run_sweep(self, space, trials, trial_days, threads=1, cache=None,
+                  search='grid', samples=None, seed=None):
+        if seed is None:
+            seed = random.getrandbits(32)
+        combos = combinations(space, search, samples, random.Random(seed))
+        intervals = self.make_intervals(trials, trial_days, seed)
+        log.warn("Sweeping {} parameter sets over {} intervals"
+                 .format(len(combos), len(intervals)))
+
+        cache = ResultCache(cache) if cache else None
+        results = {i: {} for i in range(len(combos))}
+        func_args = []
+        for interval in intervals:
+            todo = []
+            for i, params in enumerate(combos):
+                key = cache_key(params, interval, self.step, self.balances)
+                cached = cache.get(key) if cache else None
+                if cached is None:
+                    todo.append(params)
+                else:
+                    results[i][interval] = cached
+            if todo:
+                func_args.append([interval, todo, self.coins, self.db_loc,
+                                  self.step, self.balances])
+        log.warn("{} results cached, running {}".format(
+            len(combos) * len(intervals) - sum(len(a[1]) for a in func_args),
+            sum(len(a[1]) for a in func_args)))
+
+        index = {json.dumps(p, sort_keys=True): i for i, p in enumerate(combos)}
+        for interval, finished in self.map_trials(evaluate_combinations,
+                                                  func_args, threads):
+            for params, result in finished:
+                results[index[json.dumps(params, sort_keys=True)]][interval] = result
+                if cache:
+                    cache.put(cache_key(params, interval, self.step,
+                                        self.balances), result)
+
+        self.report_sweep(combos, results)
+
+    def make_intervals(self, trials, trial_days, seed):
+        """Each interval is drawn with its own seed, so the same ones come
+        up (and hit the cache) whatever parameter sets are being tried
+        """
+        length = timedelta(days=trial_days)
+        return [self.make_interval(length, trial_random(seed, i))
+                for i in range(trials)]
+
+    def report_sweep(self, combos, results):
+        rows = []
+        for i, params in enumerate(combos):
+            trials = list(results[i].values())
+            returns = [t['return'] for t in trials]
+            rows.append((s.mean(returns), s.median(returns),
+                         sum(1 for r in returns if r > 0),
+                         sum(1 for t in trials if t['return'] > t['buy_and_hold']),
+                         len(trials), params))
+
+        log.warn("\n\nSweep results, best mean return first:\n")
+        for mean, median, positive, beat, n, params in \
+                sorted(rows, key=lambda r: r[0], reverse=True):
+            log.warn("mean: {}%, median: {}%, positive: {}/{}, beat b&h: {}/{} {}"
+                     .format(round(mean, 2), round(median, 2), positive, n,
+                             beat, n, params))
@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
+import pickle
 import unittest
-from .account import Account
+from .account import Account, TxnLog
 
 
 class TestAccount(unittest.TestCase):
@@ -89,3 +90,65 @@ class TestAccount(unittest.TestCase):
         account.update('ETH', 0, 0.5)
         self.assertEqual(account.balance('ETH'), 0)
         self.assertEqual(account.balance('FOO'), 0)
+
+    def test_many_open_coins(self):
+        # sales are matched even with lots of other coins' buys still open
+        account = Account()
+        for i in range(100):
+            account.update('C{}'.format(i), 1, 1.0)
+        account.update('C99', -1, 2.0)
+        account.update('C0', -1, 0.5)
+        profits, losses = account.evaluate_trades()
+        self.assertEqual(profits, [('C99', 0.995)])
+        self.assertEqual(losses, [('C0', -0.505)])
+
+    def test_partial_sells_fifo(self):
+        account = Account()
+        account.update('DCR', 10, 0.1)
+        account.update('DCR', 10, 0.2)
+        account.update('DCR', -5, 0.4)
+        account.update('DCR', -10, 0.4)
+        profits, losses = account.evaluate_trades()
+        self.assertFalse(losses)
+        self.assertEqual([round(p, 3) for c, p in profits],
+                         [2.995, 2.995, 0.995])
+
+    def test_closed_lots(self):
+        opened = datetime(2018, 1, 1)
+        closed = opened + timedelta(hours=30)
+        account = Account()
+        account.update('DCR', 4, 0.1, opened)
+        account.update('ETH', 1, 0.1, opened)
+        account.update('DCR', -4, 0.2, closed)
+        lots = account.closed_lots()
+        self.assertEqual(len(lots), 1)
+        lot = lots[0]
+        self.assertEqual((lot.coin, lot.amount, lot.buy_price, lot.sell_price),
+                         ('DCR', 4, 0.1, 0.2))
+        self.assertEqual(lot.closed - lot.opened, timedelta(hours=30))
+        self.assertAlmostEqual(lot.gain, 0.995)
+
+
+class TestTxnLog(unittest.TestCase):
+    def test_tuples(self):
+        now = datetime(2018, 1, 2, 3, 4, 5, 6789)
+        txns = [('DCR', 5.0, 0.1, now),
+                ('BTC', -0.5, 1.0, now),
+                ('DCR', -5.0, 0.2, now + timedelta(hours=1))]
+        log = TxnLog(txns)
+        self.assertEqual(len(log), 3)
+        self.assertEqual(list(log), txns)
+        self.assertEqual(log[-1], txns[-1])
+        self.assertEqual(log[1:], txns[1:])
+        self.assertEqual(log, txns)
+        self.assertEqual(log.coin_names, ['DCR', 'BTC'])
+        self.assertFalse(TxnLog())
+
+    def test_pickle(self):
+        now = datetime(2018, 1, 1)
+        txns = [('DCR', i / 7, 1 / (i + 3), now + timedelta(seconds=i / 3))
+                for i in range(1000)]
+        log = TxnLog(txns)
+        unpickled = pickle.loads(pickle.dumps(log))
+        self.assertEqual(unpickled, txns)
+        self.assertLess(len(pickle.dumps(log)), len(pickle.dumps(txns)))
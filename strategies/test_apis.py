@@ -0,0 +1,105 @@
+import asyncio
+from datetime import datetime
+import unittest
+from unittest import mock
+
+from . import apis
+from .apis import CcxtExchange
+
+TICKER = {
+    'timestamp': 1514764800000,
+    'bid': 0.99, 'ask': 1.01, 'last': 1.0,
+    'info': {'Volume': 12.5},
+}
+
+
+class FakeExchange(CcxtExchange):
+    def __init__(self):
+        self.name = 'fake'
+
+    def make_symbol(self, coin):
+        return coin + '/BTC'
+
+
+class FakeClient(object):
+    """Stands in for an async ccxt exchange. `failures` is how many times
+    each symbol errors before it works, symbols in `hangs` never return
+    """
+
+    def __init__(self, failures={}, hangs=[], delay=0.01):
+        self.failures = dict(failures)
+        self.hangs = hangs
+        self.delay = delay
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def fetch_ticker(self, symbol):
+        self.calls.append(symbol)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if symbol in self.hangs:
+                await asyncio.sleep(60)
+            await asyncio.sleep(self.delay)
+            if self.failures.get(symbol, 0) > 0:
+                self.failures[symbol] -= 1
+                raise Exception("exchange is down")
+            return dict(TICKER)
+        finally:
+            self.in_flight -= 1
+
+
+class TestFetchTickers(unittest.TestCase):
+    def fetch(self, coins, client, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return FakeExchange().fetch_tickers(coins, client=client, **kwargs)
+
+    def test_fetch_all(self):
+        client = FakeClient()
+        rows = self.fetch(['DCR', 'ETH'], client)
+        self.assertEqual([r['coin'] for r in rows], ['DCR', 'ETH'])
+        self.assertEqual(rows[0], {
+            'exchange': 'fake', 'coin': 'DCR',
+            'timestamp': datetime(2018, 1, 1),
+            'bid': 0.99, 'ask': 1.01, 'last': 1.0, 'volume': 12.5,
+        })
+
+    def test_concurrency_limit(self):
+        coins = ['C{}'.format(i) for i in range(10)]
+        client = FakeClient()
+        rows = self.fetch(coins, client, concurrency=3)
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(client.max_in_flight, 3)
+
+    def test_retries(self):
+        client = FakeClient(failures={'DCR/BTC': 2, 'ETH/BTC': 5})
+        rows = self.fetch(['DCR', 'ETH', 'LTC'], client, retries=3)
+        self.assertEqual([r['coin'] for r in rows], ['DCR', 'LTC'])
+        self.assertEqual(client.calls.count('DCR/BTC'), 3)
+        self.assertEqual(client.calls.count('ETH/BTC'), 3)
+
+    def test_timeout(self):
+        client = FakeClient(hangs=['ETH/BTC'])
+        rows = self.fetch(['DCR', 'ETH'], client, timeout=0.05, retries=2)
+        self.assertEqual([r['coin'] for r in rows], ['DCR'])
+        self.assertEqual(client.calls.count('ETH/BTC'), 2)
+
+    def test_without_async_ccxt(self):
+        exchange = FakeExchange()
+        exchange.ccxt = mock.Mock()
+        exchange.ccxt.fetch_ticker.side_effect = lambda symbol: dict(TICKER)
+        with mock.patch.object(apis, 'async_ccxt', return_value=None):
+            rows = exchange.fetch_tickers(['DCR', 'ETH'])
+        self.assertEqual([r['coin'] for r in rows], ['DCR', 'ETH'])
+        self.assertEqual(rows, self.fetch(['DCR', 'ETH'], FakeClient()))
+
+    def test_fallback_logged_once(self):
+        apis.async_ccxt.cache_clear()
+        self.addCleanup(apis.async_ccxt.cache_clear)
+        # a None entry makes the import fail, like ccxt before async_support
+        with mock.patch.dict('sys.modules', {'ccxt.async_support': None}), \
+                self.assertLogs('default', 'DEBUG') as logs:
+            self.assertIsNone(apis.async_ccxt())
+            self.assertIsNone(apis.async_ccxt())
+        self.assertEqual([r.levelname for r in logs.records], ['DEBUG'])
@@ -0,0 +1,192 @@
+from datetime import timedelta
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from . import backtest
+from .backtest import Backtester, Checkpoint, buy_and_hold, run_strategy
+from .fixtures import make_db
+from .util import from_epoch
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.checkpoint = Checkpoint(os.path.join(self.dir, 'run'))
+
+    def test_manifest(self):
+        self.assertIsNone(self.checkpoint.manifest())
+        self.checkpoint.save_manifest({'seed': 1, 'intervals': [[0, 1]]})
+        self.assertEqual(Checkpoint(self.checkpoint.path).manifest(),
+                         {'seed': 1, 'intervals': [[0, 1]]})
+
+    def test_truncated_line(self):
+        self.assertEqual(self.checkpoint.finished(), {})
+        for i in range(3):
+            self.checkpoint.add({'trial': i, 'percent_return': i})
+        path = self.checkpoint.file('trials.jsonl')
+        with open(path) as f:
+            text = f.read()
+        with open(path, 'w') as f:
+            f.write(text[:-10])  # killed part way through the last write
+
+        self.assertEqual(sorted(self.checkpoint.finished()), [0, 1])
+        self.checkpoint.add({'trial': 2, 'percent_return': 2})
+        self.assertEqual(self.checkpoint.finished()[2],
+                         {'trial': 2, 'percent_return': 2})
+
+
+class TestRunBacktest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.db_loc, cls.sess = make_db(os.path.join(cls.dir, 'history.db'),
+                                       coins=4, days=8, ticks_per_hour=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sess.close()
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        self.tester = Backtester(self.sess, self.db_loc)
+        self.checkpoint = os.path.join(self.dir, 'checkpoint')
+        self.results = os.path.join(self.dir, 'results.jsonl')
+        for path in [self.checkpoint, self.results]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def easy_signals(self):
+        # easy to trigger, so that a few days of a random walk make trades.
+        # backtest and bot import moving_avg as a top level module, so
+        # patch their MovingAverage rather than .moving_avg's
+        return mock.patch.multiple(backtest.MovingAverage, HOURS=[1, 6, 12, 24],
+                                   WEAK=1.01, STRONG=1.02)
+
+    def run_backtest(self, trials=3, trial_days=3, seed=7, **kwargs):
+        with mock.patch.object(Backtester, 'report'), self.easy_signals():
+            self.tester.run_backtest(trials, trial_days, seed=seed,
+                                     results_file=self.results, **kwargs)
+        return self.records()
+
+    def records(self):
+        with open(self.results) as f:
+            return [json.loads(line) for line in f]
+
+    def test_make_manifest(self):
+        manifest = self.tester.make_manifest(5, 2, seed=7)
+        self.assertEqual(manifest, self.tester.make_manifest(5, 2, seed=7))
+        self.assertNotEqual(manifest['intervals'],
+                            self.tester.make_manifest(5, 2, seed=8)['intervals'])
+        # trial i's interval doesn't depend on how many trials there are
+        self.assertEqual(self.tester.make_manifest(3, 2, seed=7)['intervals'],
+                         manifest['intervals'][:3])
+        for start, end in manifest['intervals']:
+            self.assertGreaterEqual(from_epoch(start), self.tester.start_data)
+            self.assertLessEqual(from_epoch(end), self.tester.end_data)
+            self.assertLessEqual(end - start,
+                                 timedelta(days=2) // timedelta(microseconds=1))
+
+    def test_make_windows(self):
+        step = self.tester.step
+        windows = self.tester.make_windows(timedelta(days=2),
+                                           timedelta(hours=25, minutes=7))
+        self.assertEqual(windows[0][0], self.tester.start_data)
+        self.assertEqual(windows[-1][1], self.tester.end_data)
+        for (start, end), (after, _) in zip(windows, windows[1:]):
+            # rounded down to whole steps, overlapping with no gaps
+            self.assertEqual(after - start, timedelta(hours=25))
+            self.assertEqual((after - self.tester.start_data) % step,
+                             timedelta(0))
+            self.assertEqual(end - start, timedelta(days=2))
+            self.assertLess(after, end)
+
+        back_to_back = self.tester.make_windows(timedelta(days=1),
+                                                timedelta(days=1))
+        self.assertEqual([w[1] for w in back_to_back[:-1]],
+                         [w[0] for w in back_to_back[1:]])
+        self.assertEqual(back_to_back[-1][1], self.tester.end_data)
+        with self.assertRaises(ValueError):
+            self.tester.make_windows(timedelta(days=1), step / 2)
+
+    def walk_forward(self, window_days, stride_days):
+        if os.path.exists(self.results):
+            os.remove(self.results)
+        with mock.patch.object(Backtester, 'report') as report, \
+                self.easy_signals():
+            self.tester.run_walk_forward(window_days, stride_days,
+                                         results_file=self.results)
+        return report, self.records()
+
+    def test_walk_forward(self):
+        report, records = self.walk_forward(3, 2)
+        windows = self.tester.make_windows(timedelta(days=3),
+                                           timedelta(days=2))
+        # about 8 days of data, the last window cut short at the end
+        self.assertEqual(len(windows), 4)
+        self.assertEqual(windows[-1][1], self.tester.end_data)
+        self.assertEqual([(r['trial'], r['start'], r['end'])
+                          for r in records],
+                         [(i, start.isoformat(), end.isoformat())
+                          for i, (start, end) in enumerate(windows)])
+        self.assertEqual([round(r['days'], 2) for r in records[:-1]],
+                         [3.0] * 3)
+        self.assertTrue(all(r['txns'] > 0 for r in records))
+        results, num_run = report.call_args[0][:2]
+        self.assertEqual((results.trials, num_run), (4, 4))
+
+        # the first window has no history before it either way, so it's
+        # the same as a backtest of just that window
+        tup = [windows[0], self.tester.coins, self.db_loc, self.tester.step,
+               self.tester.balances]
+        with self.easy_signals():
+            strat = run_strategy(*tup)
+        expected = dict(strat.to_record(buy_and_hold(*tup)), trial=0)
+        self.assertEqual(json.loads(json.dumps(expected)), records[0])
+
+        # and a window reports the same whatever windows are around it
+        _, wider = self.walk_forward(3, 4)
+        self.assertEqual([r['start'] for r in wider],
+                         [records[0]['start'], records[2]['start']])
+        self.assertEqual([dict(r, trial=None) for r in wider],
+                         [dict(r, trial=None) for r in records[::2]])
+
+    def test_deterministic(self):
+        first = self.run_backtest()
+        os.remove(self.results)
+        self.assertEqual(self.run_backtest(), first)
+        self.assertEqual([r['trial'] for r in first], [0, 1, 2])
+        self.assertTrue(all(r['txns'] > 0 for r in first))
+
+    def test_resume(self):
+        expected = self.run_backtest()
+        os.remove(self.results)
+
+        self.run_backtest(checkpoint=self.checkpoint)
+        path = os.path.join(self.checkpoint, 'trials.jsonl')
+        with open(path) as f:
+            lines = f.readlines()
+        with open(path, 'w') as f:
+            f.writelines(lines[:1])
+            f.write(lines[1][:20])
+        os.remove(self.results)
+
+        # only the unfinished trials are run again
+        self.assertEqual(self.run_backtest(checkpoint=self.checkpoint),
+                         expected[1:])
+        self.assertEqual(sorted(Checkpoint(self.checkpoint).finished().values(),
+                                key=lambda r: r['trial']), expected)
+
+    def test_settings_mismatch(self):
+        self.run_backtest(trials=1, checkpoint=self.checkpoint)
+        with self.assertRaises(ValueError):
+            self.run_backtest(trials=1, trial_days=2,
+                              checkpoint=self.checkpoint)
+        with self.assertRaises(ValueError):
+            self.run_backtest(trials=1, seed=8, checkpoint=self.checkpoint)
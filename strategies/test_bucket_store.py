@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+from .bucket_store import Buckets, BucketStore
+
+START = datetime(2018, 1, 1)
+WINDOW = timedelta(hours=1)
+BUCKET = timedelta(minutes=15)
+
+
+class TestBuckets(unittest.TestCase):
+    def test_add(self):
+        buckets = Buckets()
+        for bucket, ask in [(0, 2.0), (0, 1.0), (0, 3.0), (1, 5.0)]:
+            buckets.add(START + bucket * BUCKET, ask)
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(buckets.times(), [START, START + BUCKET])
+        self.assertEqual(list(buckets.sums), [6.0, 5.0])
+        self.assertEqual(list(buckets.counts), [3, 1])
+        self.assertEqual(list(buckets.mins), [1.0, 5.0])
+        self.assertEqual(list(buckets.maxes), [3.0, 5.0])
+        self.assertEqual(list(buckets.firsts), [2.0, 5.0])
+        self.assertEqual(list(buckets.lasts), [3.0, 5.0])
+
+    def test_append_matches_add(self):
+        added = Buckets()
+        for ask in [2.0, 1.0, 3.0]:
+            added.add(START, ask)
+        appended = Buckets()
+        appended.append(START, 3.0, 2, 1.0, 2.0, 2.0, 1.0)
+        appended.append(START, 3.0, 1, 3.0, 3.0, 3.0, 3.0)
+        self.assertEqual(appended, added)
+        with self.assertRaises(ValueError):
+            appended.append(START - BUCKET, 1.0, 1, 1.0, 1.0, 1.0, 1.0)
+
+    def test_drop_refill(self):
+        buckets = Buckets()
+        for bucket, ask in [(0, 1.0), (1, 2.0), (1, 4.0), (2, 8.0)]:
+            buckets.add(START + bucket * BUCKET, ask)
+        self.assertEqual(buckets.index(START + BUCKET), 1)
+        buckets.drop(1)
+        buckets.refill(0, [4.0])
+        expected = Buckets()
+        expected.add(START + BUCKET, 4.0)
+        expected.add(START + 2 * BUCKET, 8.0)
+        self.assertEqual(buckets, expected)
+
+
+class TestBucketStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'buckets.pickle')
+
+        self.store = BucketStore(WINDOW)
+        self.store.reset('ETH')
+        for minutes, ask in [(0, 1.0), (5, 2.0), (10, 3.0), (20, 4.0)]:
+            t = START + timedelta(minutes=minutes)
+            bucket = START + timedelta(minutes=minutes // 10 * 10)
+            self.store.add('ETH', t, bucket, ask)
+        self.store.watermarks['ETH'] = START + timedelta(minutes=20)
+
+    def expected(self, ticks):
+        buckets = Buckets()
+        for minutes, ask in ticks:
+            buckets.add(START + timedelta(minutes=minutes), ask)
+        return buckets
+
+    def test_evict(self):
+        now = START + WINDOW + timedelta(minutes=5)
+        self.assertEqual(self.store.evict('ETH', now), 2)
+        self.assertEqual(self.store.buckets['ETH'],
+                         self.expected([(10, 3.0), (20, 4.0)]))
+        self.assertEqual(self.store.evict('ETH', now), 0)
+
+    def test_evict_part_of_bucket(self):
+        now = START + WINDOW + timedelta(minutes=1)
+        self.assertEqual(self.store.evict('ETH', now), 1)
+        self.assertEqual(self.store.buckets['ETH'],
+                         self.expected([(0, 2.0), (10, 3.0), (20, 4.0)]))
+
+    def test_late_ticks(self):
+        # into a bucket that has ticks, and into a new one between two
+        self.store.add('ETH', START + timedelta(minutes=3), START, 5.0)
+        self.store.add('ETH', START + timedelta(minutes=15),
+                       START + timedelta(minutes=10), 6.0)
+        self.assertEqual(self.store.buckets['ETH'], self.expected(
+            [(0, 1.0), (0, 5.0), (0, 2.0), (10, 3.0), (10, 6.0), (20, 4.0)]))
+        self.store.add('ETH', START + timedelta(minutes=1),
+                       START - timedelta(minutes=10), 0.5)
+        self.assertEqual(self.store.buckets['ETH'].times()[0],
+                         START - timedelta(minutes=10))
+        self.assertEqual(self.store.held('ETH', START + timedelta(minutes=5)),
+                         {START + timedelta(minutes=m): 1 for m in [5, 10, 15, 20]})
+
+    def test_save_load(self):
+        self.store.save(self.path)
+        loaded = BucketStore.load(self.path, WINDOW)
+        self.assertEqual(loaded.buckets, self.store.buckets)
+        self.assertEqual(loaded.ticks, self.store.ticks)
+        self.assertEqual(loaded.watermarks, self.store.watermarks)
+
+    def test_load_missing(self):
+        loaded = BucketStore.load(self.path, WINDOW)
+        self.assertEqual(loaded.buckets, {})
+        self.assertEqual(loaded.window, WINDOW)
+
+    def test_load_other_window(self):
+        self.store.save(self.path)
+        loaded = BucketStore.load(self.path, 2 * WINDOW)
+        self.assertEqual(loaded.buckets, {})
+        self.assertEqual(loaded.window, 2 * WINDOW)
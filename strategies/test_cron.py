@@ -0,0 +1,199 @@
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from . import cron
+from .cron import Daemon, compact, next_time, retention_cutoff
+from .db import (Balance, Compaction, DayRollup, Peak, Ticker, create_db,
+                 insert_tickers, new_session)
+
+START = datetime(2018, 1, 1)
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestNextTime(unittest.TestCase):
+    def test_aligned(self):
+        self.assertEqual(next_time(datetime(2018, 1, 1, 3, 4, 5), 10),
+                         datetime(2018, 1, 1, 3, 10))
+        self.assertEqual(next_time(datetime(2018, 1, 1, 3, 10), 10),
+                         datetime(2018, 1, 1, 3, 20))
+        self.assertEqual(next_time(datetime(2018, 1, 1, 3, 4), 60),
+                         datetime(2018, 1, 1, 4))
+        self.assertEqual(next_time(datetime(2018, 1, 1, 3, 4), 1440),
+                         datetime(2018, 1, 2))
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+        self.ran = []
+        actions = {name: self.action(name) for name in ['a', 'b', 'c']}
+        actions['broken'] = self.broken
+        for patcher in [mock.patch.dict(cron.ACTIONS, actions),
+                        mock.patch.object(cron, 'Bittrex')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.clock = Clock(START + timedelta(minutes=3))
+
+    def action(self, name):
+        def run(sess, config):
+            self.ran.append((name, self.clock()))
+        return run
+
+    def broken(self, sess, config):
+        insert_tickers(sess, [{'exchange': 'bittrex', 'coin': 'DCR',
+                               'timestamp': self.clock(), 'bid': 1.0,
+                               'ask': 1.0, 'last': 1.0, 'volume': 1.0}])
+        raise Exception("exchange is down")
+
+    def daemon(self, schedule):
+        config = {'exchanges': {'bittrex': {}},
+                  'daemon': {'schedule': schedule}}
+        return Daemon(self.sess, config, clock=self.clock)
+
+    def test_schedule(self):
+        daemon = self.daemon({'a': 10, 'b': 60})
+        self.assertEqual(daemon.next_run, {'a': START + timedelta(minutes=10),
+                                           'b': START + timedelta(hours=1)})
+        self.assertEqual(daemon.run_pending(self.clock()), [])
+
+        self.clock.now = START + timedelta(minutes=10, seconds=1)
+        self.assertEqual(daemon.run_pending(self.clock()), ['a'])
+        self.assertEqual(daemon.next_run['a'], START + timedelta(minutes=20))
+
+        # late, so both are due: they run in schedule order, once each
+        self.clock.now = START + timedelta(hours=1, minutes=25)
+        self.assertEqual(daemon.run_pending(self.clock()), ['a', 'b'])
+        self.assertEqual([name for name, _ in self.ran], ['a', 'a', 'b'])
+        self.assertEqual(daemon.next_run,
+                         {'a': START + timedelta(hours=1, minutes=30),
+                          'b': START + timedelta(hours=2)})
+
+    def test_order(self):
+        daemon = self.daemon({'c': 5, 'a': 5, 'b': 5})
+        self.clock.now = START + timedelta(minutes=5)
+        self.assertEqual(daemon.run_pending(self.clock()), ['c', 'a', 'b'])
+        self.assertEqual([name for name, _ in self.ran], ['c', 'a', 'b'])
+
+    def test_error(self):
+        daemon = self.daemon({'broken': 5, 'a': 5})
+        self.clock.now = START + timedelta(minutes=5)
+        with self.assertLogs('cron', 'ERROR'):
+            self.assertEqual(daemon.run_pending(self.clock()),
+                             ['broken', 'a'])
+        # the failed action's writes are rolled back, the rest still run
+        self.assertEqual(self.sess.query(Ticker).count(), 0)
+        self.assertEqual(self.ran, [('a', self.clock())])
+        self.assertEqual(daemon.next_run['broken'],
+                         START + timedelta(minutes=10))
+
+    def test_unknown_action(self):
+        for action in ['nope', 'daemon']:
+            with self.assertRaises(ValueError):
+                self.daemon({'a': 10, action: 10})
+
+
+class TestRetentionCutoff(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+        self.now = datetime(2018, 3, 1, 15, 30)
+
+    def position(self, coin, balance, opened, since=None):
+        attrs = {'name': 'test', 'exchange': 'bittrex', 'coin': coin}
+        self.sess.add(Balance(balance=balance, opened=opened, **attrs))
+        if since is not None:
+            self.sess.add(Peak(since=since, through=self.now, peak=1.0,
+                               **attrs))
+        self.sess.commit()
+
+    def test_window(self):
+        # the longest moving average window is 5 days
+        self.assertEqual(retention_cutoff(self.sess, self.now, 2),
+                         datetime(2018, 2, 23))
+        self.assertEqual(retention_cutoff(self.sess, self.now, 30),
+                         datetime(2018, 1, 29))
+
+    def test_open_positions(self):
+        self.position('BTC', 1.0, datetime(2017, 1, 1))
+        self.position('ETH', 0.0, datetime(2017, 6, 1))
+        self.assertEqual(retention_cutoff(self.sess, self.now, 2),
+                         datetime(2018, 2, 23))
+        self.position('DCR', 2.0, datetime(2018, 2, 10, 12),
+                      since=datetime(2018, 2, 11, 12))
+        self.assertEqual(retention_cutoff(self.sess, self.now, 2),
+                         datetime(2018, 2, 9))
+
+    def test_closed_position_peaks(self):
+        # left behind by a sold position, or from another account's
+        self.position('ETH', 0.0, None, since=datetime(2017, 6, 1))
+        self.sess.add(Peak(name='other', exchange='bittrex', coin='DCR',
+                           since=datetime(2017, 7, 1)))
+        self.position('DCR', 2.0, datetime(2018, 2, 20),
+                      since=datetime(2018, 2, 19))
+        self.assertEqual(retention_cutoff(self.sess, self.now, 2),
+                         datetime(2018, 2, 18))
+
+
+class TestCompact(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.sess = new_session(create_db(
+            'sqlite:///' + os.path.join(self.dir, 'history.db')))
+        self.addCleanup(self.sess.close)
+        # compact goes back from the real time
+        self.now = datetime.utcnow()
+        start = self.now - timedelta(days=30)
+        insert_tickers(self.sess, [
+            {'exchange': 'bittrex', 'coin': coin, 'bid': 1.0,
+             'ask': 1.0 + h % 7, 'last': 1.0 + h % 7, 'volume': 1.0,
+             'timestamp': start + timedelta(hours=h)}
+            for coin in ['DCR', 'ETH'] for h in range(0, 30 * 24, 2)])
+        attrs = {'name': 'test', 'exchange': 'bittrex'}
+        self.since = self.now - timedelta(days=20)
+        self.sess.add_all([
+            Balance(coin='DCR', balance=2.0, opened=self.since, **attrs),
+            Peak(coin='DCR', since=self.since, through=self.now, peak=1.0,
+                 **attrs),
+            # a sold position's peak doesn't hold anything back
+            Balance(coin='ETH', balance=0.0, opened=None, **attrs),
+            Peak(coin='ETH', since=start, through=self.now, peak=1.0,
+                 **attrs)])
+        self.sess.commit()
+        self.config = {'retention': {
+            'raw_days': 2, 'batch_size': 50,
+            'archive_db': 'sqlite:///' + os.path.join(self.dir, 'archive.db')}}
+
+    def test_compact(self):
+        through = DayRollup.bucket_of(self.since - timedelta(days=1))
+        kept = self.sess.query(Ticker) \
+            .filter(Ticker.timestamp >= through).count()
+        total = self.sess.query(Ticker).count()
+        peak = Ticker.peak(self.sess, 'DCR', self.since, self.now)
+        self.assertLess(kept, total)
+
+        compact(self.sess, self.config)
+        self.assertEqual(Compaction.through_time(self.sess), through)
+        self.assertEqual(self.sess.query(Ticker).count(), kept)
+        self.assertEqual(self.sess.query(Ticker)
+                         .filter(Ticker.timestamp < through).count(), 0)
+        # the open position's peak is still read from raw ticks
+        self.assertEqual(Ticker.peak(self.sess, 'DCR', self.since, self.now),
+                         peak)
+        archive = new_session(create_db(self.config['retention']['archive_db']))
+        self.addCleanup(archive.close)
+        self.assertEqual(archive.query(Ticker).count(), total - kept)
+
+        # already done, so running again changes nothing
+        compact(self.sess, self.config)
+        self.assertEqual(self.sess.query(Ticker).count(), kept)
@@ -0,0 +1,349 @@
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy.sql import func
+
+from .db import (MIGRATIONS, ROLLUPS, Coin, Compaction, DayRollup,
+                 HourRollup, Migration, PriceSnapshot, Rollup, Ticker,
+                 backfill_coins, backfill_rollups, compact_history, create_db, explain,
+                 incremental_vacuum, insert_tickers, migrate, new_session,
+                 rollups_cover, stream, tile)
+
+START = datetime(2018, 1, 1)
+
+
+def tick(coin, minutes, ask=1.0, exchange='bittrex'):
+    return {'exchange': exchange, 'coin': coin,
+            'timestamp': START + timedelta(minutes=minutes),
+            'bid': ask, 'ask': ask, 'last': ask, 'volume': 1.0}
+
+
+class TestInsertTickers(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+
+    def count(self):
+        return self.sess.query(Ticker).count()
+
+    def test_batches(self):
+        ticks = (tick(c, m) for c in ['DCR', 'ETH'] for m in range(0, 250, 10))
+        self.assertEqual(insert_tickers(self.sess, ticks, batch_size=7), 50)
+        self.sess.commit()
+        self.assertEqual(self.count(), 50)
+        self.assertEqual(Ticker.current_ask(self.sess, 'ETH'), 1.0)
+
+    def test_dedupe(self):
+        insert_tickers(self.sess, [tick('DCR', 0), tick('DCR', 10)])
+        ticks = [tick('DCR', 10), tick('DCR', 20), tick('DCR', 20),
+                 tick('ETH', 10), tick('DCR', 10, exchange='other')]
+        self.assertEqual(insert_tickers(self.sess, ticks, batch_size=2,
+                                        dedupe=True), 3)
+        self.assertEqual(self.count(), 5)
+        # without dedupe, everything is written
+        self.assertEqual(insert_tickers(self.sess, ticks), 5)
+        self.assertEqual(self.count(), 10)
+
+    def test_rollback(self):
+        insert_tickers(self.sess, [tick('DCR', 0)])
+        self.sess.rollback()
+        self.assertEqual(self.count(), 0)
+
+
+class TestStream(unittest.TestCase):
+    def test_stream(self):
+        sess = new_session(create_db('sqlite://'))
+        insert_tickers(sess, [tick('DCR', m, ask=m) for m in range(25)])
+        query = Ticker.ticks_query(sess, 'DCR', START, START + timedelta(hours=1))
+        rows = list(stream(sess, query, batch_size=7))
+        self.assertEqual(rows, [tuple(r) for r in query.all()])
+        self.assertEqual(len(rows), 24)
+        self.assertIs(type(rows[0]), tuple)
+
+
+class TestPriceSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+        ticks = [tick('DCR', m, ask=m) for m in range(0, 60, 10)]
+        ticks += [tick('ETH', m, ask=m) for m in range(0, 300, 50)]
+        ticks.append(tick('LTC', 0, ask=7))
+        insert_tickers(self.sess, ticks)
+
+    def test_matches_current_ask(self):
+        for minutes in [-5, 0, 25, 50, 55, 120, 290]:
+            now = START + timedelta(minutes=minutes)
+            snapshot = PriceSnapshot.at(self.sess, now)
+            for coin in ['DCR', 'ETH', 'LTC', 'XRP']:
+                self.assertEqual(snapshot.ask(coin),
+                                 Ticker.current_ask(self.sess, coin, now),
+                                 (coin, minutes))
+
+    def test_one_query(self):
+        now = START + timedelta(minutes=45)
+        snapshot = PriceSnapshot.at(self.sess, now)
+        self.assertEqual(snapshot.asks, {'DCR': 40, 'ETH': 0, 'LTC': 7})
+
+    def test_latest(self):
+        latest = Ticker.latest(self.sess, START + timedelta(minutes=100))
+        self.assertEqual({c: r.ask for c, r in latest.items()},
+                         {'DCR': 50, 'ETH': 100, 'LTC': 7})
+        self.assertEqual(Ticker.latest(self.sess, START - timedelta(1)), {})
+
+
+class TestCoinRegistry(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_db('sqlite://')
+        self.sess = new_session(self.engine)
+
+    def registry(self):
+        return sorted((c.exchange, c.coin, c.first_seen)
+                      for c in self.sess.query(Coin))
+
+    def test_insert_registers(self):
+        insert_tickers(self.sess, [tick('DCR', 10), tick('DCR', 0),
+                                   tick('ETH', 5, exchange='other')])
+        insert_tickers(self.sess, [tick('DCR', 20), tick('LTC', 30)])
+        self.assertEqual(self.registry(), [
+            ('bittrex', 'DCR', START),
+            ('bittrex', 'LTC', START + timedelta(minutes=30)),
+            ('other', 'ETH', START + timedelta(minutes=5)),
+        ])
+        self.assertEqual(Ticker.coins(self.sess), ['DCR', 'ETH', 'LTC'])
+
+    def test_backfill(self):
+        # e.g. history written before the registry existed
+        self.sess.execute(Ticker.__table__.insert(),
+                          [tick('ETH', 5), tick('DCR', 10), tick('DCR', 0)])
+        self.sess.commit()
+        self.assertEqual(Ticker.coins(self.sess), ['DCR', 'ETH'])
+        backfill_coins(self.engine)
+        self.assertEqual(self.registry(), [('bittrex', 'DCR', START),
+                                           ('bittrex', 'ETH', START + timedelta(minutes=5))])
+
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_db('sqlite://')
+        self.sess = new_session(self.engine)
+
+    def rollups(self):
+        return [(r.coin, r.bucket, r.count, r.sum, r.min, r.max, r.first,
+                 r.last) for r in self.sess.query(Rollup)
+                .order_by(Rollup.coin, Rollup.bucket)]
+
+    def test_insert(self):
+        ticks = [tick('DCR', m, ask=m) for m in range(0, 60, 5)]
+        insert_tickers(self.sess, ticks[6:], batch_size=4)
+        # older ticks arriving later, and a bucket being added to
+        insert_tickers(self.sess, ticks[:6] + [tick('ETH', 0, ask=2)])
+        insert_tickers(self.sess, [tick('DCR', 21, ask=100)])
+
+        minutes = timedelta(minutes=1)
+        self.assertEqual(self.rollups(), [
+            ('DCR', START, 2, 5.0, 0.0, 5.0, 0.0, 5.0),
+            ('DCR', START + 15 * minutes, 4, 145.0, 10.0, 100.0, 10.0, 100.0),
+            ('DCR', START + 30 * minutes, 3, 90.0, 25.0, 35.0, 25.0, 35.0),
+            ('DCR', START + 45 * minutes, 3, 135.0, 40.0, 50.0, 40.0, 50.0),
+            ('DCR', START + 60 * minutes, 1, 55.0, 55.0, 55.0, 55.0, 55.0),
+            ('ETH', START, 1, 2.0, 2.0, 2.0, 2.0, 2.0),
+        ])
+        rows = Rollup.range_query(self.sess, 'DCR', START + 15 * minutes,
+                                  START + 45 * minutes).all()
+        self.assertEqual([r.bucket for r in rows],
+                         [START + m * minutes for m in [15, 30, 45]])
+
+        # rebuilding them from history gives the same
+        expected = self.rollups()
+        self.sess.commit()
+        backfill_rollups(self.engine, batch_size=2)
+        self.assertEqual(self.rollups(), expected)
+
+    def test_batches_in_one_session(self):
+        # rollup rows already loaded in the session mustn't be read stale
+        loaded = []
+        for m, ask in enumerate([1.0, 2.0, 1.0, 4.0]):
+            insert_tickers(self.sess, [tick('DCR', m, ask=ask)])
+            loaded += self.sess.query(Rollup).all() \
+                + self.sess.query(HourRollup).all()
+        for rollup in [Rollup, HourRollup]:
+            row = self.sess.query(rollup.count, rollup.sum, rollup.max,
+                                  rollup.last).one()
+            self.assertEqual(tuple(row), (4, 8.0, 4.0, 4.0))
+
+    def test_migration(self):
+        insert_tickers(self.sess, [tick('DCR', m) for m in range(0, 120, 7)])
+        for rollup in ROLLUPS:
+            self.sess.query(rollup).delete()
+        self.sess.commit()
+        # the first rollups migration only builds the 15 minute ones
+        dict(MIGRATIONS)['rollups_15m'](self.engine)
+        self.assertEqual(self.sess.query(Rollup).count(), 9)
+        self.assertEqual(self.sess.query(HourRollup).count(), 0)
+        dict(MIGRATIONS)['rollups_1h_1d'](self.engine)
+        self.assertEqual(self.sess.query(HourRollup).count(), 2)
+        self.assertEqual(self.sess.query(DayRollup).count(), 1)
+
+    def test_ohlcv(self):
+        ticks = [dict(tick('DCR', m, ask=m), last=2 * m, volume=m)
+                 for m in [70, 0, 59, 130, 61]]
+        insert_tickers(self.sess, ticks)
+        rows = [(r.bucket, r.count, r.open, r.high, r.low, r.close, r.volume)
+                for r in self.sess.query(HourRollup).order_by(HourRollup.bucket)]
+        hour = timedelta(hours=1)
+        self.assertEqual(rows, [
+            (START, 2, 0.0, 118.0, 0.0, 118.0, 59.0),
+            (START + hour, 2, 122.0, 140.0, 122.0, 140.0, 70.0),
+            (START + 2 * hour, 1, 260.0, 260.0, 260.0, 260.0, 130.0),
+        ])
+        day = self.sess.query(DayRollup).one()
+        self.assertEqual((day.bucket, day.count, day.open, day.high, day.close),
+                         (START, 5, 0.0, 260.0, 260.0))
+
+    def test_missing_ask(self):
+        ticks = [dict(tick('DCR', m, ask=ask), last=last)
+                 for m, ask, last in [(0, None, 9.0), (5, 2.0, 2.0),
+                                      (10, 4.0, 4.0), (50, None, 1.0),
+                                      (70, None, 6.0)]]
+        insert_tickers(self.sess, ticks)
+        rows = [(r.bucket, r.count, r.sum, r.min, r.max, r.first, r.last,
+                 r.open, r.high, r.low, r.close)
+                for r in self.sess.query(HourRollup).order_by(HourRollup.bucket)]
+        hour = timedelta(hours=1)
+        self.assertEqual(rows, [
+            (START, 2, 6.0, 2.0, 4.0, 2.0, 4.0, 2.0, 9.0, 1.0, 4.0),
+            # only a last price, so nothing for the asks
+            (START + hour, 0, None, None, None, None, None, None, 6.0, 6.0,
+             None),
+        ])
+        rows = Rollup.range_query(self.sess, 'DCR', START, START + 2 * hour)
+        self.assertEqual([r.bucket for r in rows],
+                         [START, START + timedelta(minutes=15)])
+        self.assertEqual(Ticker.peak(self.sess, 'DCR', START - hour,
+                                     START + 3 * hour), 9.0)
+        self.assertTrue(rollups_cover(self.sess, START + timedelta(days=1)))
+
+        expected = self.rollups()
+        self.sess.commit()
+        backfill_rollups(self.engine)
+        self.assertEqual(self.rollups(), expected)
+
+    def test_tile(self):
+        hour = timedelta(hours=1)
+        start = START + timedelta(minutes=10)
+        end = START + timedelta(days=2, hours=3, minutes=5)
+        self.assertEqual(tile(start, end, [DayRollup, HourRollup]), [
+            (None, start, START + hour),
+            (HourRollup, START + hour, START + timedelta(days=1)),
+            (DayRollup, START + timedelta(days=1), START + timedelta(days=2)),
+            (HourRollup, START + timedelta(days=2), START + timedelta(days=2, hours=3)),
+            (None, START + timedelta(days=2, hours=3), end),
+        ])
+        self.assertEqual(tile(start, start + hour, [DayRollup, HourRollup]),
+                         [(None, start, start + hour)])
+
+    def test_peak(self):
+        rnd = random.Random(1)
+        minutes = sorted(rnd.sample(range(5 * 24 * 60), 2000))
+        insert_tickers(self.sess, [tick('DCR', m, ask=rnd.random())
+                                   for m in minutes])
+        for _ in range(100):
+            start = START + timedelta(minutes=rnd.randint(-60, 5 * 24 * 60))
+            now = start + timedelta(minutes=rnd.randint(0, 4 * 24 * 60))
+            raw = self.sess.query(func.max(Ticker.last)) \
+                .filter(Ticker.coin == 'DCR') \
+                .filter(Ticker.timestamp > start) \
+                .filter(Ticker.timestamp <= now).scalar()
+            self.assertEqual(Ticker.peak(self.sess, 'DCR', start, now), raw)
+
+        # empty ranges
+        now = START + timedelta(days=2)
+        self.assertIsNone(Ticker.peak(self.sess, 'DCR', now, now))
+        self.assertIsNone(Ticker.peak(self.sess, 'DCR', now,
+                                      now - timedelta(hours=1)))
+
+
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.engine = create_db('sqlite:///' + os.path.join(self.dir, 'db'))
+        self.sess = new_session(self.engine)
+        self.addCleanup(self.sess.close)
+        rnd = random.Random(2)
+        insert_tickers(self.sess, [tick(c, m, ask=rnd.random())
+                                   for c in ['DCR', 'ETH']
+                                   for m in range(0, 3 * 24 * 60, 10)])
+        self.sess.commit()
+        self.through = START + timedelta(days=1)
+
+    def rollups(self):
+        return [tuple(getattr(r, f) for f in ['coin', 'bucket', 'count', 'sum',
+                                              'high', 'close'])
+                for rollup in [Rollup, HourRollup, DayRollup]
+                for r in self.sess.query(rollup)
+                .order_by(rollup.coin, rollup.bucket)]
+
+    def peaks(self):
+        return [Ticker.peak(self.sess, 'DCR', self.through + timedelta(hours=h),
+                            START + timedelta(days=3)) for h in [0, 5, 30]]
+
+    def test_compact(self):
+        rollups, peaks = self.rollups(), self.peaks()
+        archive = new_session(create_db('sqlite://'))
+        self.assertTrue(rollups_cover(self.sess, self.through))
+
+        run = compact_history(self.sess, self.through, batch_size=50,
+                              archive=archive)
+        self.assertEqual((run.deleted, run.archived), (2 * 144, 2 * 144))
+        self.assertEqual(archive.query(Ticker).count(), 2 * 144)
+        self.assertEqual(self.sess.query(Ticker).count(), 2 * 2 * 144)
+        self.assertEqual(self.sess.query(Ticker)
+                         .filter(Ticker.timestamp < self.through).count(), 0)
+        self.assertEqual(Compaction.through_time(self.sess), self.through)
+        self.assertEqual(self.rollups(), rollups)
+        self.assertEqual(self.peaks(), peaks)
+        self.assertTrue(rollups_cover(self.sess, self.through + timedelta(days=1)))
+
+    def test_rollups_are_final(self):
+        rollups = self.rollups()
+        compact_history(self.sess, self.through)
+        # rebuilding only touches rollups after the compacted ticks
+        backfill_rollups(self.engine)
+        self.assertEqual(self.rollups(), rollups)
+        # and old ticks coming back aren't counted twice
+        insert_tickers(self.sess, [tick('DCR', 5)])
+        self.assertEqual(self.rollups(), rollups)
+
+    def test_vacuum(self):
+        compact_history(self.sess, self.through)
+        self.sess.close()
+        self.assertTrue(incremental_vacuum(self.engine))
+        self.assertEqual(self.engine.execute("PRAGMA auto_vacuum").scalar(), 2)
+        self.assertEqual(
+            self.engine.execute("PRAGMA freelist_count").scalar(), 0)
+        self.assertTrue(incremental_vacuum(self.engine, pages=10))
+
+
+class TestSchema(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_db('sqlite://')
+        self.sess = new_session(self.engine)
+
+    def test_migrations(self):
+        applied = [m.name for m in self.sess.query(Migration)]
+        self.assertEqual(sorted(applied), sorted(n for n, _ in MIGRATIONS))
+        migrate(self.engine)
+        self.assertEqual(self.sess.query(Migration).count(), len(MIGRATIONS))
+
+    def test_query_plans(self):
+        # the hot lookups should only touch the covering index
+        queries = dict(Ticker.helper_queries(self.sess, 'DCR', START))
+        for name in ['current_ask', 'peak', 'latest']:
+            plan = " ".join(str(c) for row in explain(self.sess, queries[name])
+                            for c in row)
+            self.assertIn("COVERING INDEX ticker_coin_ts_idx", plan, name)
+        plan = str(explain(self.sess, queries['history']))
+        self.assertIn("ticker_coin_ts_idx", plan)
@@ -0,0 +1,66 @@
+import unittest
+
+from sqlalchemy import create_engine
+
+from .instrument import Instruments
+
+
+class Thing(object):
+    @staticmethod
+    def double(x):
+        return 2 * x
+
+    def countdown(self, n):
+        return n if n == 0 else self.countdown(n - 1)
+
+
+class TestInstruments(unittest.TestCase):
+    def setUp(self):
+        self.instruments = Instruments()
+        self.instruments.enabled = True
+        self.engine = create_engine('sqlite://')
+        self.instruments.watch(self.engine)
+
+    def query(self):
+        self.engine.execute('select 1').fetchall()
+
+    def test_disabled(self):
+        self.instruments.enabled = False
+        with self.instruments.stage('a'):
+            self.query()
+        self.assertEqual(self.instruments.snapshot(),
+                         {'queries': 0, 'stages': {}})
+
+    def test_nested_queries(self):
+        with self.instruments.stage('outer'):
+            self.query()
+            with self.instruments.stage('inner'):
+                self.query()
+                self.query()
+        stages = self.instruments.stages
+        self.assertEqual(self.instruments.queries, 3)
+        self.assertEqual((stages['outer'][0], stages['outer'][2]), (1, 3))
+        self.assertEqual((stages['inner'][0], stages['inner'][2]), (1, 2))
+        self.assertGreaterEqual(stages['outer'][1], stages['inner'][1])
+
+    def test_wrap(self):
+        self.addCleanup(setattr, Thing, 'double', Thing.__dict__['double'])
+        self.addCleanup(setattr, Thing, 'countdown', Thing.countdown)
+        self.instruments.wrap(Thing, 'double', 'double')
+        self.instruments.wrap(Thing, 'double', 'double')  # only wraps once
+        self.instruments.wrap(Thing, 'countdown', 'countdown')
+
+        self.assertEqual(Thing.double(2), 4)
+        self.assertEqual(Thing().countdown(3), 0)
+        self.assertEqual(self.instruments.stages['double'][0], 1)
+        self.assertEqual(self.instruments.stages['countdown'][0], 4)
+
+    def test_merge(self):
+        with self.instruments.stage('a'):
+            self.query()
+        other = Instruments()
+        other.merge(self.instruments.snapshot())
+        other.merge(self.instruments.snapshot())
+        self.assertEqual(other.queries, 2)
+        self.assertEqual(other.stages['a'][0], 2)
+        self.assertIn('2 queries in total', other.table())
@@ -0,0 +1,51 @@
+from datetime import timedelta
+import random
+import unittest
+
+from .db import create_db, insert_tickers, new_session
+from .fixtures import START, tick
+from .moving_avg import MovingAverage
+
+
+class TestRefresh(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+        self.rand = random.Random(1)
+        self.insert(START, START + timedelta(days=2))
+
+    def insert(self, start, end):
+        t = start
+        ticks = []
+        while t < end:
+            ticks.append(tick('DCR', t, self.rand.uniform(1, 2)))
+            t += timedelta(minutes=self.rand.randint(1, 20))
+        insert_tickers(self.sess, ticks)
+
+    def assertMatchesFetch(self, refreshed, now):
+        fetched = MovingAverage(self.sess)
+        fetched.fetch_data('DCR', now)
+        self.assertEqual(refreshed.prices['DCR'], fetched.prices['DCR'])
+
+    def test_refresh(self):
+        moving_avg = MovingAverage(self.sess)
+        now = START + timedelta(days=1)
+        for minutes in [0, 7, 15, 60, 61, 300]:
+            moving_avg.refresh('DCR', now + timedelta(minutes=minutes))
+            self.assertMatchesFetch(moving_avg, now + timedelta(minutes=minutes))
+
+    def test_late_ticks(self):
+        moving_avg = MovingAverage(self.sess)
+        now = START + timedelta(days=2, hours=1)
+        self.insert(START + timedelta(days=2), now)
+        moving_avg.refresh('DCR', now)
+        # stored after the refresh, but stamped before it
+        insert_tickers(self.sess, [
+            tick('DCR', now - timedelta(minutes=40), 5.0),
+            tick('DCR', now - timedelta(seconds=1), 0.5)])
+        self.insert(now, now + timedelta(minutes=30))
+        now += timedelta(minutes=30)
+        moving_avg.refresh('DCR', now)
+        self.assertMatchesFetch(moving_avg, now)
+        # nothing is counted twice by the next one
+        moving_avg.refresh('DCR', now + timedelta(minutes=5))
+        self.assertMatchesFetch(moving_avg, now + timedelta(minutes=5))
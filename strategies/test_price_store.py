@@ -0,0 +1,148 @@
+from datetime import timedelta
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from .cron import import_archive
+from .db import Ticker, create_db, insert_tickers, new_session
+from .fixtures import START, random_ticks
+from .price_store import PriceStore, range_max, range_max_table
+from .util import to_epoch
+
+COINS = ['DCR', 'ETH']
+
+
+class TestRangeMax(unittest.TestCase):
+    def test_range_max(self):
+        rand = random.Random(1)
+        values = np.array([rand.random() for _ in range(37)])
+        values[[3, 4, 20]] = np.nan
+        table = range_max_table(values)
+        for lo in range(len(values)):
+            for hi in range(lo, len(values)):
+                expected = np.nanmax(values[lo:hi + 1]) \
+                    if not np.isnan(values[lo:hi + 1]).all() else None
+                self.assertEqual(range_max(table, lo, hi), expected)
+
+
+class TestPriceStore(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+        rand = random.Random(1)
+        for coin in COINS:
+            insert_tickers(self.sess, random_ticks(rand, coin, 4))
+        self.sess.commit()
+        self.start = START + timedelta(days=1, minutes=7)
+        self.end = START + timedelta(days=3)
+        self.store = PriceStore.load(self.sess, COINS, self.start, self.end,
+                                     exchange='bittrex')
+
+    def times(self, count=60, seed=2):
+        rand = random.Random(seed)
+        span = (self.end - self.start).total_seconds()
+        times = [self.start, self.end] + \
+            [self.start + timedelta(seconds=rand.uniform(0, span))
+             for _ in range(count)]
+        # exactly on a tick as well as between them
+        times += [t for (t,) in self.sess.query(Ticker.timestamp)
+                  .filter(Ticker.timestamp.between(self.start, self.end))
+                  .limit(count)]
+        return times
+
+    def test_current_ask(self):
+        for coin in COINS:
+            for now in self.times():
+                self.assertEqual(self.store.current_ask(coin, now),
+                                 Ticker.current_ask(self.sess, coin, now))
+
+    def test_peak(self):
+        times = sorted(self.times(count=20))
+        for coin in COINS:
+            for i, start_time in enumerate(times):
+                for now in times[i:]:
+                    self.assertEqual(
+                        self.store.peak(coin, start_time, now),
+                        Ticker.peak(self.sess, coin, start_time, now))
+
+    def test_row_before_start(self):
+        for coin in COINS:
+            before = self.sess.query(Ticker.timestamp, Ticker.ask) \
+                .filter(Ticker.coin == coin) \
+                .filter(Ticker.timestamp < self.start) \
+                .order_by(Ticker.timestamp.desc()).first()
+            prices = self.store.prices[coin]
+            self.assertEqual(prices.timestamps[0], to_epoch(before[0]))
+            self.assertEqual(self.store.current_ask(coin, self.start),
+                             before[1])
+
+    def test_covers(self):
+        store, start, end = self.store, self.start, self.end
+        self.assertTrue(store.covers('DCR', start))
+        self.assertTrue(store.covers('DCR', end))
+        self.assertTrue(store.covers('DCR', end, start_time=start))
+        self.assertFalse(store.covers('DCR', end + timedelta(seconds=1)))
+        early = start - timedelta(microseconds=1)
+        self.assertFalse(store.covers('DCR', end, start_time=early))
+        self.assertFalse(store.covers('DCR', early))
+        self.assertFalse(store.covers('DCR', None))
+        self.assertFalse(store.covers('BTC', end))
+
+    def test_fallback(self):
+        self.store.attach(self.sess)
+        self.addCleanup(PriceStore.detach, self.sess)
+        later = self.end + timedelta(hours=12)
+        for coin in COINS:
+            # newer than anything in the store, so only SQL has the answer
+            self.assertNotEqual(Ticker.current_ask(self.sess, coin, later),
+                                self.store.current_ask(coin, later))
+            self.assertEqual(Ticker.current_ask(self.sess, coin, later),
+                             Ticker.current_ask_query(self.sess, coin, later)
+                             .first()[0])
+            self.assertEqual(Ticker.peak(self.sess, coin, self.start, later),
+                             Ticker.peak_query(self.sess, coin, self.start,
+                                               later).first()[0])
+            self.assertEqual(Ticker.current_ask(self.sess, coin),
+                             Ticker.current_ask_query(self.sess, coin)
+                             .first()[0])
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'archive')
+
+    def history(self, sess):
+        return sess.query(Ticker.exchange, Ticker.coin, Ticker.timestamp,
+                          Ticker.bid, Ticker.ask, Ticker.last, Ticker.volume) \
+            .order_by(Ticker.coin, Ticker.timestamp).all()
+
+    def test_round_trip(self):
+        sess = new_session(create_db('sqlite://'))
+        rand = random.Random(1)
+        ticks = [t for coin in COINS for t in random_ticks(rand, coin, 1)]
+        ticks[3]['volume'] = None
+        insert_tickers(sess, ticks)
+        sess.commit()
+        rows = PriceStore.export(sess, self.path, 'bittrex', COINS)
+        self.assertEqual(sum(rows.values()), len(ticks))
+
+        store = PriceStore.open(self.path)
+        self.assertEqual(sorted(store.coins), COINS)
+        self.assertIsInstance(store.prices['DCR'].ask, np.memmap)
+        archived = [r for coin in COINS
+                    for batch in store.rows(coin, batch_size=7) for r in batch]
+        self.assertEqual(archived, ticks)
+
+        # only the rows the other database is missing get imported
+        other = new_session(create_db('sqlite://'))
+        insert_tickers(other, ticks[::2])
+        import_archive(other, {'archive': self.path})
+        self.assertEqual(self.history(other), self.history(sess))
+
+        import_archive(other, {'archive': self.path})
+        self.assertEqual(other.query(Ticker).count(), len(ticks))
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+import random
+import unittest
+
+from .bucket_store import Buckets
+from .rolling import RollingAverages, scan_averages
+
+HOURS = [1, 6, 12, 24, 48, 72, 120]
+START = datetime(2018, 1, 1)
+
+
+def to_buckets(asks):
+    """Buckets from {bucket: [ask, ...]}"""
+    buckets = Buckets()
+    for bucket in sorted(asks):
+        for ask in asks[bucket]:
+            buckets.add(bucket, ask)
+    return buckets
+
+
+def make_buckets(rnd, days=10, gap=None):
+    buckets = Buckets()
+    price = 0.01
+    for i in range(days * 24 * 4):
+        bucket = START + timedelta(minutes=15 * i)
+        if gap and gap[0] <= bucket < gap[1]:
+            continue
+        for _ in range(rnd.randint(1, 3)):
+            price *= 1 + rnd.gauss(0, 0.01)
+            buckets.add(bucket, price)
+    return buckets
+
+
+class TestRollingAverages(unittest.TestCase):
+    def assertParity(self, buckets, times, allow_missing=False):
+        rolling = RollingAverages(buckets, HOURS)
+        for now in times:
+            expected = scan_averages(buckets, now, HOURS, allow_missing)
+            actual = rolling.averages(now, allow_missing)
+            if expected is None:
+                self.assertIsNone(actual, now)
+                continue
+            self.assertEqual(sorted(expected.keys()), sorted(actual.keys()))
+            for h, avg in expected.items():
+                self.assertAlmostEqual(avg, actual[h], delta=1e-12 * avg)
+
+    def test_stepping_forward(self):
+        rnd = random.Random(1)
+        buckets = make_buckets(rnd)
+        times = [START + timedelta(minutes=10 * i) for i in range(10 * 24 * 6)]
+        self.assertParity(buckets, times)
+        self.assertParity(buckets, times, allow_missing=True)
+
+    def test_uneven_steps(self):
+        rnd = random.Random(2)
+        buckets = make_buckets(rnd)
+        now = START
+        times = []
+        while now < START + timedelta(days=11):
+            now += timedelta(minutes=rnd.randint(1, 600), seconds=rnd.randint(0, 59))
+            times.append(now)
+        self.assertParity(buckets, times)
+
+    def test_going_backwards(self):
+        rnd = random.Random(3)
+        buckets = make_buckets(rnd)
+        times = [START + timedelta(hours=rnd.randint(0, 240)) for _ in range(200)]
+        self.assertParity(buckets, times)
+        self.assertParity(buckets, times, allow_missing=True)
+
+    def test_gap_in_data(self):
+        rnd = random.Random(4)
+        gap = (START + timedelta(days=2), START + timedelta(days=7))
+        buckets = make_buckets(rnd, gap=gap)
+        times = [START + timedelta(minutes=10 * i) for i in range(10 * 24 * 6)]
+        self.assertParity(buckets, times)
+        self.assertParity(buckets, times, allow_missing=True)
+
+    def test_missing_data(self):
+        buckets = to_buckets({START: [1.0],
+                              START + timedelta(minutes=15): [3.0]})
+        rolling = RollingAverages(buckets, HOURS)
+        now = START + timedelta(minutes=30)
+        self.assertIsNone(rolling.averages(now))
+        self.assertEqual(rolling.averages(now, allow_missing=True),
+                         {h: 2.0 for h in HOURS})
+        self.assertEqual(RollingAverages(Buckets(), HOURS).averages(now, True),
+                         {})
+
+    def test_edges(self):
+        buckets = to_buckets({START: [1.0], START + timedelta(hours=1): [3.0]})
+        now = START + timedelta(hours=1)
+        # buckets exactly at the window cutoff and at 'now' are both included
+        averages = RollingAverages(buckets, HOURS).averages(now, True)
+        self.assertEqual(averages[1], 2.0)
+        self.assertEqual(averages, scan_averages(buckets, now, HOURS, True))
+        # buckets after 'now' are not
+        averages = RollingAverages(buckets, HOURS) \
+            .averages(now - timedelta(seconds=1), True)
+        self.assertEqual(averages, {h: 1.0 for h in HOURS})
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+import random
+import unittest
+
+import numpy as np
+
+from .bucket_store import Buckets
+from .rolling import scan_averages
+from .signals import Signal, epochs
+from .test_rolling import HOURS, START, make_buckets
+
+WEAK = 1.0
+STRONG = 1.01
+
+
+def make_ticks(buckets):
+    # one raw tick per bucket, a few minutes after the bucket boundary
+    timestamps = [b + timedelta(minutes=3) for b in buckets.times()]
+    return epochs(timestamps), np.array(buckets.lasts)
+
+
+class TestSignal(unittest.TestCase):
+    def test_parity(self):
+        rnd = random.Random(5)
+        gap = (START + timedelta(days=6), START + timedelta(days=8))
+        buckets = make_buckets(rnd, days=12, gap=gap)
+        timestamps, asks = make_ticks(buckets)
+        step = timedelta(minutes=10)
+        start = START - timedelta(hours=1)
+        stop = START + timedelta(days=12)
+
+        signal = Signal.compute(buckets, timestamps, asks, start, stop, step,
+                                HOURS, WEAK, STRONG)
+        self.assertEqual(len(signal), 12 * 24 * 6 + 7)
+
+        saw_valid = saw_weak = saw_strong = False
+        for i in range(len(signal)):
+            now = start + i * step
+            self.assertEqual(signal.index(now), i)
+            averages = scan_averages(buckets, now, HOURS)
+            idx = np.searchsorted(timestamps, epochs([now])[0], 'right') - 1
+            if averages is None or averages.get(1) is None or idx < 0:
+                self.assertFalse(signal.valid[i], now)
+                continue
+            self.assertTrue(signal.valid[i], now)
+            saw_valid = True
+            price = asks[idx]
+            self.assertEqual(signal.prices[i], price)
+            strengths = [averages[h] / price for h in HOURS[1:]]
+            np.testing.assert_allclose(signal.strengths[i], strengths,
+                                       rtol=1e-12)
+            weak = all(s > WEAK for s in strengths[:3])
+            strong = weak and all(s > STRONG for s in strengths)
+            self.assertEqual(bool(signal.weak[i]), weak)
+            self.assertEqual(bool(signal.strong[i]), strong)
+            saw_weak = saw_weak or weak
+            saw_strong = saw_strong or strong
+        self.assertTrue(saw_valid and saw_weak and saw_strong)
+
+    def test_index(self):
+        step = timedelta(minutes=10)
+        signal = Signal.compute(Buckets(), epochs([]), np.array([]),
+                                START, START + timedelta(hours=1), step,
+                                HOURS, WEAK, STRONG)
+        self.assertEqual(len(signal), 7)
+        self.assertFalse(signal.valid.any())
+        self.assertEqual(signal.index(START + 6 * step), 6)
+        self.assertIsNone(signal.index(START + 7 * step))
+        self.assertIsNone(signal.index(START - step))
+        self.assertIsNone(signal.index(START + timedelta(minutes=5)))
+        self.assertIsNone(signal.index(datetime(2017, 1, 1)))
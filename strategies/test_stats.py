@@ -0,0 +1,48 @@
+import random
+import statistics as s
+import unittest
+
+from .stats import QuantileSketch, Summary
+
+
+class TestSummary(unittest.TestCase):
+    def test_matches_statistics(self):
+        rnd = random.Random(1)
+        values = [rnd.gauss(2, 10) for _ in range(500)]
+        summary = Summary()
+        summary.extend(values)
+        self.assertEqual(len(summary), 500)
+        self.assertAlmostEqual(summary.mean, s.mean(values))
+        self.assertAlmostEqual(summary.stdev, s.stdev(values))
+        self.assertEqual(summary.min, min(values))
+        self.assertEqual(summary.max, max(values))
+        # exact until the sketch has to compact
+        self.assertEqual(summary.median, s.median(values))
+
+    def test_small(self):
+        summary = Summary()
+        summary.add(3)
+        self.assertEqual((summary.mean, summary.stdev, summary.median),
+                         (3, 0.0, 3))
+        summary.add(4)
+        self.assertEqual(summary.median, 3.5)
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_bounded_and_close(self):
+        rnd = random.Random(2)
+        values = [rnd.expovariate(1) for _ in range(50000)]
+        sketch = QuantileSketch(size=200)
+        for v in values:
+            sketch.add(v)
+        self.assertLess(sum(len(level) for level in sketch.levels), 200 * 10)
+
+        ordered = sorted(values)
+        for q in [0.1, 0.5, 0.9]:
+            estimate = sketch.quantile(q)
+            rank = sum(1 for v in ordered if v < estimate) / len(ordered)
+            self.assertAlmostEqual(rank, q, delta=0.02)
+
+    def test_empty(self):
+        with self.assertRaises(s.StatisticsError):
+            QuantileSketch().median()
@@ -0,0 +1,92 @@
+from datetime import timedelta
+import random
+import unittest
+
+from .account import Account
+from .bot import Bot
+from .db import Peak, Ticker, create_db, insert_tickers, new_session
+from .fixtures import START, random_ticks, tick
+from .stop_loss import MIN_HOLD_TIME, PeakState, PeakTracker
+
+
+class TestPeakTracker(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+        insert_tickers(self.sess, random_ticks(random.Random(1), 'DCR', 6))
+        self.sess.commit()
+
+    def test_incremental_matches_full(self):
+        peaks = PeakTracker()
+        since = START + timedelta(hours=5)
+        now = since
+        rand = random.Random(2)
+        while now < START + timedelta(days=6):
+            now += timedelta(minutes=rand.randint(1, 180))
+            self.assertEqual(peaks.peak(self.sess, 'DCR', since, now),
+                             Ticker.peak(self.sess, 'DCR', since, now))
+        self.assertEqual(peaks.peaks['DCR'].through, now)
+
+    def test_reopen(self):
+        peaks = PeakTracker()
+        first, second = START + timedelta(hours=1), START + timedelta(days=3)
+        now = START + timedelta(days=4)
+        peaks.peak(self.sess, 'DCR', first, now)
+        peaks.close('DCR')
+        self.assertNotIn('DCR', peaks.peaks)
+        # a new position starts over rather than extending the old peak
+        peaks.peak(self.sess, 'DCR', first, now)
+        later = now + timedelta(hours=6)
+        self.assertEqual(peaks.peak(self.sess, 'DCR', second, later),
+                         Ticker.peak(self.sess, 'DCR', second, later))
+        self.assertEqual(peaks.peaks['DCR'].since, second)
+
+    def test_save_load(self):
+        peaks = PeakTracker(name='test', exchange='bittrex')
+        now = START + timedelta(days=2)
+        for coin in ['DCR', 'ETH']:
+            peaks.peak(self.sess, coin, START, now)
+        peaks.save(self.sess)
+        loaded = PeakTracker.from_db(self.sess, 'test', 'bittrex')
+        self.assertEqual(loaded.peaks, peaks.peaks)
+        self.assertEqual(PeakTracker.from_db(self.sess, 'other', 'bittrex')
+                         .peaks, {})
+
+        later = now + timedelta(hours=3)
+        self.assertEqual(loaded.peak(self.sess, 'DCR', START, later),
+                         Ticker.peak(self.sess, 'DCR', START, later))
+        loaded.close('ETH')
+        loaded.save(self.sess)
+        reloaded = PeakTracker.from_db(self.sess, 'test', 'bittrex')
+        self.assertEqual(reloaded.peaks, {
+            'DCR': PeakState(START, later, loaded.peaks['DCR'].peak)})
+        self.assertEqual(self.sess.query(Peak).count(), 1)
+
+
+class TestBotSells(unittest.TestCase):
+    def setUp(self):
+        self.sess = new_session(create_db('sqlite://'))
+        # up for a day, then down 10%
+        ticks = [tick('DCR', START + timedelta(hours=h), 1 + h / 100)
+                 for h in range(30)]
+        ticks += [tick('DCR', START + timedelta(hours=30), 1.2)]
+        insert_tickers(self.sess, ticks)
+        self.sess.commit()
+
+    def test_sell_closes_peak(self):
+        account = Account({'BTC': 1, 'DCR': 10}, period=START)
+        bot = Bot(self.sess, account)
+        opened = START + MIN_HOLD_TIME
+        self.assertFalse(bot.check_sells('DCR', opened + timedelta(hours=5)))
+        self.assertIn('DCR', bot.peaks.peaks)
+
+        self.assertTrue(bot.check_sells('DCR', opened + timedelta(hours=6)))
+        self.assertEqual(account.balance('DCR'), 0)
+        self.assertNotIn('DCR', bot.peaks.peaks)
+
+    def test_zero_balance_closes_peak(self):
+        account = Account({'BTC': 1, 'DCR': 10}, period=START)
+        bot = Bot(self.sess, account)
+        bot.peaks.peaks['DCR'] = PeakState(START, START, 1.0)
+        account.balances['DCR'] = 0
+        self.assertFalse(bot.check_sells('DCR', START + timedelta(days=2)))
+        self.assertNotIn('DCR', bot.peaks.peaks)
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from .backtest import run_strategy
+from .db import create_db, insert_tickers, new_session
+from .fixtures import make_db
+from .sweep import ResultCache, Sweeper, cache_key, combinations
+
+START = datetime(2018, 1, 1)
+SPACE = {'weak': [1.05, 1.07, 1.09], 'strong': [1.1, 1.2],
+         'hours': [[1, 6], [2, 12]]}
+INTERVAL = (START, START + timedelta(days=10))
+STEP = timedelta(minutes=10)
+BALANCES = {'BTC': 5}
+
+
+class TestCombinations(unittest.TestCase):
+    def test_grid(self):
+        combos = combinations(SPACE)
+        self.assertEqual(len(combos), 12)
+        self.assertEqual(combos[0], {'hours': [1, 6], 'strong': 1.1,
+                                     'weak': 1.05})
+        self.assertEqual(len(set(map(repr, combos))), 12)
+        self.assertEqual(combinations(SPACE, 'random', samples=12), combos)
+
+    def test_random(self):
+        combos = combinations(SPACE, 'random', 5, random.Random(1))
+        self.assertEqual(len(combos), 5)
+        self.assertEqual(len(set(map(repr, combos))), 5)
+        for params in combos:
+            self.assertIn(params, combinations(SPACE))
+        self.assertEqual(combinations(SPACE, 'random', 5, random.Random(1)),
+                         combos)
+        with self.assertRaises(ValueError):
+            combinations(SPACE, 'best', 5)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_cache_key(self):
+        params = {'weak': 1.05, 'strong': 1.1}
+        key = cache_key(params, INTERVAL, STEP, BALANCES)
+        self.assertEqual(key, cache_key({'strong': 1.1, 'weak': 1.05},
+                                        INTERVAL, STEP, BALANCES))
+        later = (INTERVAL[0] + STEP, INTERVAL[1] + STEP)
+        for other in [cache_key(dict(params, weak=1.07), INTERVAL, STEP,
+                                BALANCES),
+                      cache_key(params, later, STEP, BALANCES),
+                      cache_key(params, INTERVAL, 2 * STEP, BALANCES),
+                      cache_key(params, INTERVAL, STEP, {'BTC': 1})]:
+            self.assertNotEqual(key, other)
+
+    def test_hit_miss(self):
+        cache = ResultCache(self.dir)
+        key = cache_key({'weak': 1.05}, INTERVAL, STEP, BALANCES)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, {'return': 1.5, 'txns': 3})
+        self.assertEqual(cache.get(key), {'return': 1.5, 'txns': 3})
+        # results are kept between runs
+        self.assertEqual(ResultCache(self.dir).get(key),
+                         {'return': 1.5, 'txns': 3})
+        self.assertIsNone(cache.get(cache_key({'weak': 1.07}, INTERVAL, STEP,
+                                              BALANCES)))
+
+
+class TestIntervals(unittest.TestCase):
+    def test_independent_of_combinations(self):
+        sess = new_session(create_db('sqlite://'))
+        insert_tickers(sess, [
+            {'exchange': 'bittrex', 'coin': 'DCR', 'bid': 1.0, 'ask': 1.0,
+             'last': 1.0, 'volume': 1.0,
+             'timestamp': START + timedelta(days=d)} for d in range(60)])
+        sess.commit()
+        sweeper = Sweeper(sess, 'sqlite://')
+        intervals = sweeper.make_intervals(5, 10, seed=1)
+        # drawing from the global random state doesn't change them
+        random.random()
+        self.assertEqual(sweeper.make_intervals(5, 10, seed=1), intervals)
+        # more trials extend the same list of intervals
+        self.assertEqual(sweeper.make_intervals(8, 10, seed=1)[:5], intervals)
+        self.assertNotEqual(sweeper.make_intervals(5, 10, seed=2), intervals)
+        for start, end in intervals:
+            self.assertGreaterEqual(start, START)
+            self.assertLessEqual(end - start, timedelta(days=10))
+
+
+class TestRunSweep(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.db_loc, self.sess = make_db(os.path.join(self.dir, 'history.db'),
+                                         coins=3, days=6, ticks_per_hour=4)
+        self.addCleanup(self.sess.close)
+        self.cache = os.path.join(self.dir, 'cache')
+        self.space = {'weak': [1.01, 1.03], 'strong': [1.02],
+                      'hours': [[1, 6, 12, 24]]}
+
+    def sweep(self):
+        sweeper = Sweeper(self.sess, self.db_loc)
+        with mock.patch.object(Sweeper, 'report_sweep') as report:
+            sweeper.run_sweep(self.space, trials=2, trial_days=2,
+                              cache=self.cache, seed=3)
+        combos, results = report.call_args[0]
+        return sweeper, combos, results
+
+    def test_matches_backtest(self):
+        sweeper, combos, results = self.sweep()
+        self.assertEqual(len(combos), 2)
+        for i, params in enumerate(combos):
+            self.assertEqual(len(results[i]), 2)
+            for interval, result in results[i].items():
+                strat = run_strategy(interval, sweeper.coins, self.db_loc,
+                                     sweeper.step, sweeper.balances,
+                                     params=params)
+                self.assertEqual((result['return'], result['txns']),
+                                 (strat.percent_return, strat.num_txns))
+        self.assertTrue(any(r['txns'] > 0 for i in results
+                            for r in results[i].values()))
+
+    def test_cached(self):
+        _, combos, results = self.sweep()
+        with mock.patch.object(Sweeper, 'map_trials',
+                               return_value=iter([])) as map_trials:
+            _, cached_combos, cached = self.sweep()
+        # nothing left to run, every result came from the cache
+        self.assertEqual(map_trials.call_args[0][1], [])
+        self.assertEqual(cached_combos, combos)
+        self.assertEqual(cached, results)
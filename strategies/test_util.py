@@ -1,7 +1,8 @@
 import unittest
+from datetime import datetime, timedelta
 from decimal import Decimal
 
-from .util import crypto_truncate
+from .util import crypto_truncate, from_epoch, to_epoch
 
 
 class TestUtil(unittest.TestCase):
@@ -14,3 +15,9 @@ class TestUtil(unittest.TestCase):
                          float(crypto_truncate(11188.361401279999)))
         self.assertEqual(Decimal('-2162.60633012'),
                          crypto_truncate(-2162.60633012))
+
+    def test_epoch(self):
+        now = datetime(2018, 1, 2, 3, 4, 5, 678901)
+        self.assertEqual(to_epoch(datetime(1970, 1, 1, 0, 0, 1)), 1000000)
+        self.assertEqual(from_epoch(to_epoch(now)), now)
+        self.assertLess(to_epoch(now), to_epoch(now + timedelta(microseconds=1)))
@@ -1,12 +1,25 @@
+from datetime import datetime, timedelta
 from decimal import ROUND_DOWN, Decimal
 from subprocess import check_output
 
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
 
 def crypto_truncate(amount):
     d = Decimal(amount)
     return d.quantize(Decimal('0.00000001'), rounding=ROUND_DOWN)
 
 
+def to_epoch(dt):
+    """Microseconds since the unix epoch for a naive UTC datetime"""
+    return (dt - EPOCH) // MICROSECOND
+
+
+def from_epoch(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
 def run(args, split="\n"):
     output_byt = check_output(args)
     return output_byt.decode("utf-8").split(split)